@@ -0,0 +1,83 @@
+import argparse
+import time
+
+import torch
+
+from utils.spatial_utils import morton_order
+
+
+""" Benchmark of the gather-heavy stages of the view deformation, with the primitives in file order
+    (shuffled, as after training) and sorted along the Morton curve.
+    Run from the repository root: python -m benchmarks.gather_benchmark
+"""
+
+
+""" Build a regular triangulation of the image with cells of cell_size pixels """
+def grid_mesh(width, height, cell_size, device):
+    nx, ny = width // cell_size, height // cell_size
+    xs, ys = torch.meshgrid(torch.arange(nx + 1, device=device), torch.arange(ny + 1, device=device), indexing="xy")
+    vertices = torch.stack([xs.flatten(), ys.flatten()], dim=1).float() * cell_size
+
+    i, j = torch.meshgrid(torch.arange(nx, device=device), torch.arange(ny, device=device), indexing="xy")
+    v0 = (j * (nx + 1) + i).flatten()
+    v1, v2, v3 = v0 + 1, v0 + nx + 1, v0 + nx + 2
+    faces = torch.stack([torch.stack([v0, v1, v3], dim=1), torch.stack([v0, v3, v2], dim=1)], dim=1).reshape(-1, 3)
+
+    return vertices, faces, nx
+
+
+""" Time a function, in milliseconds per call """
+def timeit(function, repeats):
+    function()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) * 1000 / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb_points", type=int, default=5_000_000)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--cell_size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # Points on a noisy sphere in a random (training-like) order
+    points = torch.nn.functional.normalize(torch.randn(args.nb_points, 3, device=device), dim=1)
+    points += 0.01 * torch.randn_like(points)
+
+    vertices, faces, nx = grid_mesh(args.size, args.size, args.cell_size, device)
+    jacobians = torch.eye(2, device=device).repeat(len(faces), 1, 1)
+
+    for name, order in [("file order", None), ("morton order", morton_order(points))]:
+        ordered = points if order is None else points[order]
+
+        # Orthographic projection in the image and triangle containing each point
+        points2d = (ordered[:, :2] * 0.45 + 0.5) * (args.size - 1)
+        cells = (points2d / args.cell_size).long().clamp(0, nx - 1)
+        local = points2d / args.cell_size - cells
+        indices = 2 * (cells[:, 1] * nx + cells[:, 0]) + (local[:, 1] > local[:, 0]).long()
+        barycentric_coordinates = torch.full((len(ordered), 3, 1), 1.0 / 3.0, device=device)
+        embedding_operator = torch.sparse_csr_tensor(torch.arange(0, 3 * len(ordered) + 1, 3, device=device),
+                                                     faces[indices].flatten(), barycentric_coordinates.flatten(),
+                                                     size=(len(ordered), len(vertices)))
+
+        triangles_ms = timeit(lambda: vertices[faces[indices]], args.repeats)
+        jacobians_ms = timeit(lambda: jacobians[indices], args.repeats)
+        deform_ms = timeit(lambda: torch.sum(barycentric_coordinates * vertices[faces[indices]], dim=1),
+                           args.repeats)
+        operator_ms = timeit(lambda: embedding_operator @ vertices, args.repeats)
+
+        print(f"{name:>13}: triangles gather {triangles_ms:7.2f} ms | jacobians gather {jacobians_ms:7.2f} ms | "
+              f"barycentric deformation {deform_ms:7.2f} ms | embedding operator {operator_ms:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
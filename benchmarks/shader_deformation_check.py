@@ -0,0 +1,92 @@
+import os
+
+# Offscreen software rendering unless another pyrender platform is requested (e.g. PYOPENGL_PLATFORM=egl)
+os.environ.setdefault("PYOPENGL_PLATFORM", "osmesa")
+
+import argparse
+
+import numpy as np
+import pyrender
+import trimesh
+
+from rendering.mesh_render_context import PersistentOffscreenRenderer
+
+
+""" Check that the displacement shader renders the same image as the displaced positions written in the vertex
+    buffers, on a sphere (or a .glb given with --data_path) with smooth random displacements.
+    Run from the repository root: python -m benchmarks.shader_deformation_check
+"""
+
+
+""" Build a scene of the meshes with a camera looking at their bounding box, and its primitives """
+def build_scene(meshes):
+    scene = pyrender.Scene(bg_color=(255, 255, 255), ambient_light=np.array([0.4, 0.4, 0.4]))
+    nodes = [scene.add(pyrender.Mesh.from_trimesh(mesh, smooth=True)) for mesh in meshes]
+
+    bounds = np.concatenate([mesh.bounds for mesh in meshes])
+    center = (bounds.min(axis=0) + bounds.max(axis=0)) / 2
+    radius = np.linalg.norm(bounds.max(axis=0) - bounds.min(axis=0)) / 2
+    camera_pose = np.eye(4)
+    camera_pose[:3, 3] = center + np.array([0.0, 0.0, 2.5 * radius])
+    scene.add(pyrender.PerspectiveCamera(yfov=np.pi / 3), pose=camera_pose)
+    scene.add(pyrender.DirectionalLight(color=np.ones(3), intensity=2.0), pose=camera_pose)
+
+    primitives = [prim for node in nodes for prim in node.mesh.primitives]
+    return scene, primitives
+
+
+""" Render the scene with the displacements applied in the vertex shader or written in the vertex buffers """
+def render_displaced(scene, primitives, displacements, size, shader_deformation):
+    renderer = PersistentOffscreenRenderer(size, size, shader_deformation=shader_deformation)
+    rest_positions = [prim.positions.copy() for prim in primitives]
+    offsets = np.cumsum([0] + [len(positions) for positions in rest_positions])
+
+    # A first frame uploads the scene, the displacements are then applied as during the interactions
+    renderer.render(scene)
+    if shader_deformation:
+        renderer.set_vertex_offsets({prim: int(offset) for prim, offset in zip(primitives, offsets[:-1])})
+        renderer.upload_displacements(np.ascontiguousarray(displacements, dtype=np.float32))
+    else:
+        renderer.update_primitives(primitives, [positions + displacements[start:end] for positions, start, end in
+                                                zip(rest_positions, offsets[:-1], offsets[1:])])
+    color, _ = renderer.render(scene)
+
+    renderer.update_primitives(primitives, rest_positions)
+    renderer.delete()
+    return color
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, default=None)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--amplitude", type=float, default=0.1)
+    parser.add_argument("--tolerance", type=int, default=2)
+    args = parser.parse_args()
+
+    if args.data_path is None:
+        meshes = [trimesh.creation.icosphere(subdivisions=5)]
+    else:
+        meshes = list(trimesh.load(args.data_path, force="scene").dump())
+    scene, primitives = build_scene(meshes)
+
+    # Smooth displacements, at the scale of the model
+    positions = np.concatenate([prim.positions for prim in primitives])
+    scale = args.amplitude * np.linalg.norm(positions.max(axis=0) - positions.min(axis=0))
+    displacements = (scale * np.sin(3.0 * positions[:, [1, 2, 0]])).astype(np.float32)
+
+    cpu = render_displaced(scene, primitives, displacements, args.size, shader_deformation=False)
+    shader = render_displaced(scene, primitives, displacements, args.size, shader_deformation=True)
+    rest = render_displaced(scene, primitives, np.zeros_like(displacements), args.size, shader_deformation=False)
+
+    difference = np.abs(cpu.astype(np.int32) - shader.astype(np.int32)).max(axis=2)
+    mismatch = np.mean(difference > args.tolerance)
+    print(f"platform {os.environ['PYOPENGL_PLATFORM']}, {len(positions)} vertices, {args.size}x{args.size} pixels")
+    print(f"pixels changed by the displacements: {np.mean(np.any(cpu != rest, axis=2)):.2%}")
+    print(f"shader against buffers: max difference {difference.max()}, {mismatch:.4%} pixels above {args.tolerance}")
+    if mismatch > 0.001:
+        raise SystemExit("The displacement shader does not match the displaced vertex buffers")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import argparse
+
+import numpy as np
+import triangle as tr
+
+from deformation.weight_solvers import compare_weight_solvers
+
+
+""" Benchmark of the handle weight solvers of the 2D meshes: bounded biharmonic weights against the prefactored fast
+    weights, on a square mesh of the image with random handles.
+    Run from the repository root: python -m benchmarks.weight_solver_benchmark
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--max_area", type=float, default=20.0)
+    parser.add_argument("--nb_handles", type=int, nargs="+", default=[2, 5, 10])
+    args = parser.parse_args()
+
+    corners = np.array([[0, 0], [args.size, 0], [args.size, args.size], [0, args.size]], dtype=np.float64)
+    mesh = tr.triangulate({"vertices": corners}, f"qa{args.max_area}")
+    vertices, faces = mesh["vertices"], mesh["triangles"]
+    print(f"{len(vertices)} vertices, {len(faces)} faces")
+
+    random_state = np.random.RandomState(0)
+    for nb_handles in args.nb_handles:
+        handles_index = random_state.choice(len(vertices), nb_handles, replace=False)
+        comparison = compare_weight_solvers(vertices, faces, handles_index)
+        print(f"{nb_handles:3d} handles: bbw {comparison['bbw_time'] * 1000:9.1f} ms | "
+              f"fast {comparison['fast_time'] * 1000:7.1f} ms (factor {comparison['fast_factor_time'] * 1000:.1f} ms) "
+              f"| max error {comparison['max_error']:.3f} | mean error {comparison['mean_error']:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 import copy
 from abc import ABC, abstractmethod
 import numpy as np
+import torch
 
 from camera.abstract_camera import AbstractCamera
-from deformation.tools import BbwMeshTool
+from deformation.tools import BbwMeshTool, MeshGenerationJob, bbw_mesh_tool_from_bytes
 
 
 class AbstractViewDeformation(ABC):
@@ -21,6 +22,10 @@ class AbstractViewDeformation(ABC):
         self.need_update = False
 
         self.bbw_mesh_tool = None
+        self.mesh_job = None
+
+        # Saved 2D mesh tool of a loaded model (see BbwMeshTool.to_bytes), restored at its first use
+        self.saved_bbw_mesh_tool = None
 
     """ Change the azimuth variance of the gaussian """
     def change_variance_azimuth(self, variance_azimuth):
@@ -30,24 +35,60 @@ class AbstractViewDeformation(ABC):
     def change_variance_polar(self, variance_polar):
         self.variance_polar = variance_polar
 
-    """ Save the view deformation in 3D """
+    """ Save the view deformation in 3D (only for the primitives in indices if given). When the model is streamed,
+        resident_indices are the global indices of the resident primitives, whose saved deformation is replaced """
     @abstractmethod
-    def save_view_deformation(self, displacement_vectors, jacobians=None):
+    def save_view_deformation(self, displacement_vectors, jacobians=None, indices=None, resident_indices=None):
         pass
 
-    """ Select the 2D mesh tool to deform the 3D model """
-    def select_bbw_mesh_tool(self, image, points2d):
-        if self.bbw_mesh_tool is None:
+    """ Select the 2D mesh tool to deform the 3D model, embedding the projected points [P, 2] of the primitives (global
+        indices [P]).
+        background: generate the 2D mesh in a worker, the tool is attached once it is ready (see update_mesh_job).
+        Selecting it again while it is generated cancels the generation """
+    def select_bbw_mesh_tool(self, image, points2d, primitives, weight_solver="bbw", multires=False, background=False):
+        if self.mesh_job is not None:
+            self.delete_bbw_mesh_tool()
+        elif self.bbw_mesh_tool is None:
             vertices2d = points2d.cpu().numpy().astype(np.float32)
-            self.bbw_mesh_tool = BbwMeshTool()
-            self.bbw_mesh_tool.initialize_bbw_mesh(vertices2d, image)
+            primitives = primitives.cpu().numpy().astype(np.int64)
+            bbw_mesh_tool = BbwMeshTool(weight_solver, multires)
+            if background:
+                self.mesh_job = MeshGenerationJob(bbw_mesh_tool, vertices2d, image, primitives)
+            else:
+                bbw_mesh_tool.initialize_bbw_mesh(vertices2d, image, primitives)
+                self.bbw_mesh_tool = bbw_mesh_tool
         else:
             self.delete_bbw_mesh_tool()
 
-    """ Delete the 2D mesh tool """
+    """ Restore the saved 2D mesh tool, from_file_indices maps its primitives to the loading order """
+    def restore_bbw_mesh_tool(self, from_file_indices):
+        self.bbw_mesh_tool = bbw_mesh_tool_from_bytes(self.saved_bbw_mesh_tool, from_file_indices)
+        self.saved_bbw_mesh_tool = None
+
+    """ Get the 2D mesh tool as bytes to save it (None if there is none), to_file_indices maps its primitives to the
+        order of the source file """
+    def get_bbw_mesh_tool_bytes(self, to_file_indices):
+        if self.bbw_mesh_tool is not None:
+            return self.bbw_mesh_tool.to_bytes(to_file_indices)
+        return self.saved_bbw_mesh_tool
+
+    """ Attach the 2D mesh tool generated in the background once its generation stopped.
+        Returns True if it stopped since the last call, raises the error of a failed generation """
+    def update_mesh_job(self):
+        if self.mesh_job is None or not self.mesh_job.done():
+            return False
+        mesh_job, self.mesh_job = self.mesh_job, None
+        self.bbw_mesh_tool = mesh_job.get_tool()
+        return True
+
+    """ Delete the 2D mesh tool (and cancel its generation, or drop its saved version) """
     def delete_bbw_mesh_tool(self):
+        if self.mesh_job is not None:
+            self.mesh_job.cancel()
+            self.mesh_job = None
         del self.bbw_mesh_tool
         self.bbw_mesh_tool = None
+        self.saved_bbw_mesh_tool = None
 
     """ Select a handle to move """
     def select_handle(self, event):
@@ -80,10 +121,23 @@ class AbstractViewDeformation(ABC):
         if self.bbw_mesh_tool is not None:
             self.bbw_mesh_tool.bbw_mesh.compute_weight_matrix()
 
+    """ Get the image-space bounds (x_min, y_min, x_max, y_max) outside which the primitives are not deformed """
+    def get_image_bounds(self, camera: AbstractCamera):
+        if self.bbw_mesh_tool is not None:
+            return self.bbw_mesh_tool.get_image_bounds()
+        return 0.0, 0.0, camera.width, camera.height
+
+    """ Mask of the primitives (global indices) that can be deformed by the 2D mesh tool """
+    def is_deformable(self, primitives):
+        if self.bbw_mesh_tool is not None:
+            return self.bbw_mesh_tool.is_embedded(primitives)
+        return torch.ones(len(primitives), dtype=torch.bool, device=primitives.device)
+
     """ Get the deformation of the projected 2D points of the 3D model using the 2D mesh tool.
+        - primitives: global indices of the projected points (all the primitives if None)
         Here it is possible to add more tools to deform the 3D model """
     @abstractmethod
-    def deform(self, points2d):
+    def deform(self, points2d, primitives=None):
        pass
 
     """ Save the view deformation as a dict to save the view-dependent model """
@@ -15,12 +15,13 @@ class AbstractViewDeformer(ABC):
     def new_view_deformation(self, camera, nb_data, displacements, jacobians):
         pass
 
-    """ Get the interpolation data (In our case bivariate gaussian data) for each ViewDeformation """
+    """ Get the interpolation data (In our case bivariate gaussian data) for the first n ViewDeformations (all if None),
+        with their values for the primitives in indices (all the primitives if None) """
     @abstractmethod
-    def get_gaussian_data(self):
+    def get_gaussian_data(self, n=None, indices=None):
         pass
 
-    """ Interpolate the ViewDeformations """
+    """ Interpolate the ViewDeformations (only for the primitives in indices if given) """
     @abstractmethod
-    def get_interpolated_values(self, camera: AbstractCamera, n, nb_data):
+    def get_interpolated_values(self, camera: AbstractCamera, n, nb_data, indices=None):
         pass
\ No newline at end of file
@@ -1,83 +1,267 @@
-import math
-
-import igl
 import numpy as np
+import scipy.sparse as sp
 import torch
-
-from utils.utils import get_contour_mesh
-
-
-""" Class to represent a handle for the 2D mesh """
-class Handle:
-    def __init__(self, initial_position):
-        self.angle = 0.0
-        self.initial_position = initial_position
-        self.rotation_matrix = np.array([[1.0, 0.0], [0.0, 1.0]])
-        self.new_position = initial_position.copy()
-        self.delta = np.array([0.0, 0.0])
-
-    """ Compute the translation """
-    def compute_delta(self):
-        self.delta = self.new_position - np.dot(self.rotation_matrix, self.initial_position)
-
-    """ Update the rotation matrix of the handle """
-    def update_rotation_matrix(self, angle):
-        self.angle += angle
-        cos_theta = np.cos(self.angle)
-        sin_theta = np.sin(self.angle)
-        self.rotation_matrix = np.array([[cos_theta, -sin_theta],
-                                         [sin_theta, cos_theta]])
-        self.compute_delta()
-
-    """ Update the position of the handle """
-    def update_new_position(self, displacement):
-        self.new_position += displacement
-        self.compute_delta()
-
-    """ Get the Transformation matrix of the handle """
-    def get_transformation_matrix(self):
-        delta_reshaped = self.delta.reshape(2, 1)
-        combined_matrix = np.hstack((self.rotation_matrix, delta_reshaped))
-        return combined_matrix
-
-
-""" Class to represent the 2D mesh deformed using BBW """
+from scipy.spatial import cKDTree
+
+from deformation.weight_solvers import WEIGHT_SOLVERS, MultiresWeightSolver
+from utils.utils import get_contour_mesh, get_vertex_budget
+
+
+# Simplification tolerance and maximum triangle area (in pixels) of the coarse meshes of the multiresolution weights
+COARSE_EPSILON = 4.0
+COARSE_MAX_AREA = 960
+
+# Number of handles influencing each vertex in the skinning operator
+SKINNING_TOP_K = 4
+
+
+""" Handles of the 2D mesh stored as arrays: the initial and new positions [M, 2], the rotation angles [M] and
+    matrices [M, 2, 2], and the translations [M, 2] such that a point p follows the handle m as R_m p + delta_m """
+class HandleStore:
+    def __init__(self):
+        self.initial_positions = np.zeros((0, 2))
+        self.new_positions = np.zeros((0, 2))
+        self.angles = np.zeros(0)
+        self.rotation_matrices = np.zeros((0, 2, 2))
+        self.deltas = np.zeros((0, 2))
+
+    def __len__(self):
+        return len(self.angles)
+
+    """ Add a handle at a position """
+    def add(self, position):
+        self.initial_positions = np.vstack((self.initial_positions, position))
+        self.new_positions = np.vstack((self.new_positions, position))
+        self.angles = np.append(self.angles, 0.0)
+        self.rotation_matrices = np.concatenate((self.rotation_matrices, np.eye(2)[np.newaxis]))
+        self.deltas = np.vstack((self.deltas, np.zeros(2)))
+
+    """ Remove the handle at position index """
+    def remove(self, index):
+        self.initial_positions = np.delete(self.initial_positions, index, axis=0)
+        self.new_positions = np.delete(self.new_positions, index, axis=0)
+        self.angles = np.delete(self.angles, index)
+        self.rotation_matrices = np.delete(self.rotation_matrices, index, axis=0)
+        self.deltas = np.delete(self.deltas, index, axis=0)
+
+    """ Compute the translations """
+    def compute_deltas(self):
+        self.deltas = self.new_positions - np.einsum('mij,mj->mi', self.rotation_matrices, self.initial_positions)
+
+    """ Rotate the handles at positions indices by an angle """
+    def rotate(self, indices, angle):
+        self.angles[indices] += angle
+        cos_theta = np.cos(self.angles[indices])
+        sin_theta = np.sin(self.angles[indices])
+        self.rotation_matrices[indices] = np.stack([np.stack([cos_theta, -sin_theta], axis=-1),
+                                                    np.stack([sin_theta, cos_theta], axis=-1)], axis=-2)
+        self.compute_deltas()
+
+    """ Translate the handles at positions indices """
+    def translate(self, indices, displacement):
+        self.new_positions[indices] += displacement
+        self.compute_deltas()
+
+    """ Get the transformation matrices [M, 2, 3] of the handles """
+    def get_transformation_matrices(self):
+        return np.concatenate((self.rotation_matrices, self.deltas[:, :, np.newaxis]), axis=2)
+
+
+""" Get the inverses [F, 2, 2] of the edge matrices (edges v1 - v0 and v2 - v0 as columns) of the faces of a 2D mesh,
+    zero for the degenerate faces """
+def get_inverse_edge_matrices(vertices, faces):
+    origins = vertices[faces[:, 0]]
+    (a, c), (b, d) = (vertices[faces[:, 1]] - origins).T, (vertices[faces[:, 2]] - origins).T
+    determinants = a * d - b * c
+    valid = np.abs(determinants) > 1e-12
+    inverse_determinants = np.where(valid, 1.0 / np.where(valid, determinants, 1.0), 0.0)
+
+    inverses = np.stack([np.stack([d, -b], axis=-1), np.stack([-c, a], axis=-1)], axis=-2)
+    return inverses * inverse_determinants[:, np.newaxis, np.newaxis]
+
+
+""" Build the linear blend skinning operator [N, 3 M] of weights [N, M] for the augmented vertices [N, 3]: the
+    deformed vertices are the product of the operator with the stacked transposed transformations [3 M, 2] of the
+    handles. Only the top_k largest weights of each vertex are kept, rescaled to keep their sum.
+"""
+def get_skinning_operator(weights, vertices_augmented, top_k=SKINNING_TOP_K):
+    nb_vertices, nb_handles = weights.shape
+    top_k = min(top_k, nb_handles)
+    if top_k == 0:
+        return sp.csr_matrix((nb_vertices, 0))
+
+    top_handles = np.argpartition(-weights, top_k - 1, axis=1)[:, :top_k]
+    top_weights = np.take_along_axis(weights, top_handles, axis=1)
+    kept_sums = top_weights.sum(axis=1, keepdims=True)
+    top_weights *= np.where(kept_sums > 0, weights.sum(axis=1, keepdims=True) / np.clip(kept_sums, 1e-12, None), 0)
+
+    rows = np.repeat(np.arange(nb_vertices), 3 * top_k)
+    columns = 3 * top_handles[:, :, np.newaxis] + np.arange(3)
+    values = top_weights[:, :, np.newaxis] * vertices_augmented[:, np.newaxis, :]
+    operator = sp.csr_matrix((values.ravel(), (rows, columns.ravel())), shape=(nb_vertices, 3 * nb_handles))
+    operator.eliminate_zeros()
+    return operator
+
+
+""" Class to represent the 2D mesh deformed using BBW, with a vertex budget scaled to the image (see get_contour_mesh)
+    - weight_solver: "bbw" for the bounded biharmonic weights, "fast" for the prefactored fast weights
+      (see weight_solvers)
+    - multires: solve the weights on a coarse mesh of the same contour and prolongate them to this mesh
+    - mesh, coarse_mesh: (vertices, faces) of the 2D mesh and of the coarse mesh when they are already known (restored
+      state, see get_state), the image is then unused
+    - report: called with the progress (in [0, 0.5]) and stage of the construction, between the refinements of the
+      mesh and before the weight solver is prepared, it may raise to stop the construction. The preparation of the
+      weight solver (factorization) can not be stopped """
 class BbwMesh:
-    def __init__(self, image):
+    def __init__(self, image, weight_solver="bbw", multires=False, mesh=None, coarse_mesh=None,
+                 report=lambda progress, stage: None):
         self.old_angle = 0
 
-        self.bbw = igl.BBW()
-
-        self.vertices, self.faces = get_contour_mesh(image)
+        if mesh is None:
+            mesh = get_contour_mesh(image, vertex_budget=get_vertex_budget(np.array(image).shape),
+                                    report=lambda progress: report(0.3 * progress, "meshing"))
+        self.vertices, self.faces = mesh
         self.vertices_augmented = np.hstack((self.vertices.copy(), np.ones((self.vertices.shape[0], 1))))
         self.new_vertices = self.vertices.copy()
-        self.gradients = igl.grad(np.hstack([self.vertices, np.ones((self.vertices.shape[0], 1))]), self.faces)
         self.jacobians = torch.eye(2, dtype=torch.float32).repeat(len(self.faces), 1, 1)
 
+        # Inverse rest edge matrices [F, 2, 2] of the faces, the jacobians are only computed on the active faces
+        self.inverse_rest_edges = get_inverse_edge_matrices(self.vertices, self.faces)
+        self.active_faces = np.nonzero(np.any(self.inverse_rest_edges != 0, axis=(1, 2)))[0]
+
         self.new_vertices_tensor = torch.from_numpy(self.new_vertices).type(torch.float32)
 
+        # KD-tree over the deformed vertices for the picking, rebuilt at the first pick after a deformation
+        self.vertex_tree = None
+
         self.original_vertices = self.vertices.copy()
         self.original_vertices_augmented = np.hstack(
             (self.original_vertices, np.ones((self.original_vertices.shape[0], 1))))
 
         self.handles_index = np.array([])
-        self.handles = []
+        self.handles = HandleStore()
         self.selected_handles_index = np.array([])
 
         self.points2d = None
 
         self.weight_matrix = None
-
-    """ Compute the weight matrix based on the controllers (handles) """
+        self.skinning_operator = None
+
+        report(0.3, "weights")
+        if multires:
+            if coarse_mesh is None:
+                coarse_mesh = get_contour_mesh(image, COARSE_EPSILON, COARSE_MAX_AREA)
+            self.weight_solver = MultiresWeightSolver(self.original_vertices, self.faces, coarse_mesh[0],
+                                                      coarse_mesh[1], weight_solver)
+        else:
+            self.weight_solver = WEIGHT_SOLVERS[weight_solver](self.original_vertices, self.faces)
+        self.coarse_mesh = coarse_mesh
+
+        # Solved weights of each handle (vertex index -> column), keyed on the set of handles they were solved with
+        self.weight_cache = {}
+        self.weight_columns = {}
+        self.weight_job = None
+        self.rest_weights = None
+
+    """ Compute the weight matrix based on the controllers (handles).
+        The weights of a set of handles already solved are reused. Otherwise the BBW columns are solved in the
+        background, warm started from the previous weights of the same handles, and the previous weights are used
+        meanwhile (the new handles have no influence until their weights arrive, see update_weight_matrix).
+        The fast weights are solved immediately.
+    """
     def compute_weight_matrix(self):
-        identity_matrix = np.identity(len(self.handles))
-        self.weight_matrix = self.bbw.solve(self.original_vertices, self.faces, self.handles_index, identity_matrix)
-
-        row_sums = np.clip(self.weight_matrix.sum(axis=1, keepdims=True), a_min=1, a_max=None)
-        self.weight_matrix /= row_sums
+        handles_index = self.handles_index.astype(int)
+        key = frozenset(handles_index.tolist())
+        if key in self.weight_cache:
+            self.weight_job = None
+            self.set_weight_matrix(self.weight_cache[key])
+        elif not self.weight_solver.background:
+            self.weight_job = None
+            self.weight_cache[key] = self.weight_solver.solve(handles_index)
+            self.set_weight_matrix(self.weight_cache[key])
+        else:
+            if self.weight_job is None or self.weight_job[0] != key:
+                self.weight_job = (key, handles_index, self.weight_solver.submit(handles_index, self.weight_columns))
+            self.set_weight_matrix(self.weight_columns, provisional=True)
 
         self.vertices = self.new_vertices.copy()
 
+    """ Use the weights of the background solve once all its columns arrived. Returns True if they changed """
+    def update_weight_matrix(self):
+        if self.weight_job is None:
+            return False
+        key, handles_index, futures = self.weight_job
+        if not all(future.done() for future in futures.values()):
+            return False
+
+        self.weight_job = None
+        self.weight_cache[key] = self.weight_solver.collect(handles_index, futures)
+        if key != frozenset(self.handles_index.astype(int).tolist()):
+            return False
+        self.set_weight_matrix(self.weight_cache[key])
+        return True
+
+    """ Build the weight matrix and the skinning operator of the current handles from weight columns
+        (vertex index -> column).
+        provisional: the columns may miss handles, the weight missing to sum to 1 keeps the vertices at rest """
+    def set_weight_matrix(self, columns, provisional=False):
+        self.weight_columns = columns
+        self.weight_matrix = np.zeros((len(self.original_vertices), len(self.handles)))
+        for i, handle in enumerate(self.handles_index.astype(int).tolist()):
+            if handle in columns:
+                self.weight_matrix[:, i] = columns[handle]
+
+        row_sums = self.weight_matrix.sum(axis=1, keepdims=True)
+        self.weight_matrix /= np.clip(row_sums, a_min=1, a_max=None)
+        self.rest_weights = np.clip(1 - row_sums, a_min=0, a_max=None) if provisional else None
+        self.skinning_operator = get_skinning_operator(self.weight_matrix, self.original_vertices_augmented)
+
+    """ Get the state of the mesh as arrays: rest and deformed vertices, faces, handles and the solved weights of the
+        current handles (float32) """
+    def get_state(self):
+        handles = [handle for handle in self.handles_index.astype(int).tolist() if handle in self.weight_columns]
+        state = {
+            "rest_vertices": self.original_vertices,
+            "faces": self.faces,
+            "vertices": self.vertices,
+            "new_vertices": self.new_vertices,
+            "handles_index": self.handles_index,
+            "selected_handles_index": self.selected_handles_index,
+            "handle_initial_positions": self.handles.initial_positions,
+            "handle_new_positions": self.handles.new_positions,
+            "handle_angles": self.handles.angles,
+            "weight_handles": np.array(handles, dtype=np.int64),
+            "weights": np.stack([self.weight_columns[handle] for handle in handles], axis=1).astype(np.float32)
+            if len(handles) > 0 else np.zeros((len(self.original_vertices), 0), dtype=np.float32),
+            "weights_complete": frozenset(self.handles_index.astype(int).tolist()) in self.weight_cache,
+        }
+        if self.coarse_mesh is not None:
+            state["coarse_vertices"], state["coarse_faces"] = self.coarse_mesh
+        return state
+
+    """ Restore the deformation, the handles and the weights of a state (see get_state) on the same mesh """
+    def set_state(self, state):
+        self.vertices = state["vertices"]
+        self.new_vertices = state["new_vertices"]
+        self.new_vertices_tensor = torch.from_numpy(self.new_vertices).type(torch.float32)
+        self.vertex_tree = None
+
+        self.handles_index = state["handles_index"]
+        self.selected_handles_index = state["selected_handles_index"]
+        self.handles = HandleStore()
+        for position in state["handle_initial_positions"]:
+            self.handles.add(position)
+        self.handles.new_positions = state["handle_new_positions"].copy()
+        self.handles.rotate(np.arange(len(self.handles)), state["handle_angles"])
+
+        columns = {handle: state["weights"][:, i].astype(np.float64)
+                   for i, handle in enumerate(state["weight_handles"].tolist())}
+        if state["weights_complete"]:
+            self.weight_cache[frozenset(self.handles_index.astype(int).tolist())] = columns
+        if len(self.handles) > 0:
+            self.set_weight_matrix(columns, provisional=not state["weights_complete"])
+        self.compute_jacobians()
+
     """ Check if handle is selectable """
     def check_handle(self, event):
         if len(self.selected_handles_index) < 1:
@@ -100,64 +284,71 @@ class BbwMesh:
             displacement = np.array([dx, dy])
             angle = 0.0
 
+        # Switch to the solved weights if they arrived
+        self.update_weight_matrix()
+
         # Update positions of the selected handles
-        for i, selected_handle in enumerate(self.selected_handles_index):
-            index = int(selected_handle)
-            if deformation_type == 'rotation':
-                self.handles[index].update_rotation_matrix(angle)
-            else:
-                self.handles[index].update_new_position(displacement)
-
-        # Get all the transformation matrices
-        transformation_matrices = np.array([handle.get_transformation_matrix() for handle in self.handles])
-        transformed_points = np.einsum('mij,nj->mni', transformation_matrices, self.original_vertices_augmented)
-
-        # Calculate new vertices based on the weight matrix
-        result = self.weight_matrix[:, :, np.newaxis] * transformed_points.transpose(1, 0, 2)
-        self.new_vertices = np.sum(result, axis=1)
+        selected = self.selected_handles_index.astype(int)
+        if deformation_type == 'rotation':
+            self.handles.rotate(selected, angle)
+        else:
+            self.handles.translate(selected, displacement)
+
+        # Blend the stacked transformations [3 M, 2] of the handles with the skinning operator
+        transformation_matrices = self.handles.get_transformation_matrices()
+        self.new_vertices = self.skinning_operator @ transformation_matrices.transpose(0, 2, 1).reshape(-1, 2)
+        if self.rest_weights is not None:
+            self.new_vertices += self.rest_weights * self.original_vertices
         self.new_vertices_tensor = torch.from_numpy(self.new_vertices).type(torch.float32)
+        self.vertex_tree = None
         self.compute_jacobians()
 
-    """ Find the closest vertex to the click event """
-    def find_closest_vertex(self, event, vertices):
-        x = event.x
-        y = event.y
-        distances = [math.sqrt((vx - x) ** 2 + (vy - y) ** 2) for vx, vy in vertices]
-        closest_index = distances.index(min(distances))
+    """ Find the closest deformed vertex to the click event """
+    def find_closest_vertex(self, event):
+        if self.vertex_tree is None:
+            self.vertex_tree = cKDTree(self.new_vertices)
+        _, closest_index = self.vertex_tree.query([event.x, event.y])
+
+        return int(closest_index)
+
+    """ Find the closest handle to the click event """
+    def find_closest_handle(self, event):
+        handles = self.new_vertices[self.handles_index.astype(int)]
+        distances = np.sum((handles - np.array([event.x, event.y])) ** 2, axis=1)
 
-        return closest_index
+        return int(np.argmin(distances))
 
     """ Add or remove a handle based on the click event """
     def add_or_remove_handle(self, event):
-        closest_index = self.find_closest_vertex(event, self.new_vertices)
+        closest_index = self.find_closest_vertex(event)
 
         if closest_index in self.handles_index:
             index = np.where(self.handles_index == closest_index)[0]
             self.selected_handles_index = self.selected_handles_index[self.selected_handles_index != closest_index]
             self.handles_index = np.delete(self.handles_index, index)
-            self.handles.pop(index[0])
+            self.handles.remove(index[0])
         else:
             self.handles_index = np.append(self.handles_index, closest_index)
-            handle = Handle(self.new_vertices[closest_index])
-            self.handles.append(handle)
+            self.handles.add(self.new_vertices[closest_index])
 
     """ Select a handle based on the click event """
     def select_handle(self, event):
-        handles = self.new_vertices[self.handles_index.astype(int)]
-        closest_index = self.find_closest_vertex(event, handles)
+        closest_index = self.find_closest_handle(event)
 
         # Toggle presence of closest_index
         self.selected_handles_index = np.setxor1d(self.selected_handles_index, [closest_index])
 
-    """ Compute the jacobians of the triangle faces """
-    def compute_jacobians(self):
-        jacobians = self.gradients * np.hstack([self.new_vertices, np.ones((self.new_vertices.shape[0], 1))])
-        rows_to_keep = 2 * jacobians.shape[0] // 3
-        jacobians = jacobians[:rows_to_keep, :2].T
+    """ Restrict the computation of the jacobians to faces (the faces containing primitives), the other faces and the
+        degenerate ones keep identity jacobians """
+    def set_active_faces(self, faces):
+        faces = np.asarray(faces, dtype=np.int64)
+        self.active_faces = faces[np.any(self.inverse_rest_edges[faces] != 0, axis=(1, 2))]
 
-        n = len(self.faces)
-        x_part = jacobians[:, :n]
-        y_part = jacobians[:, n:]
+    """ Compute the jacobians of the active triangle faces: J = Ds Dm^-1 with Ds the deformed edges """
+    def compute_jacobians(self):
+        faces = self.faces[self.active_faces]
+        origins = self.new_vertices[faces[:, 0]]
+        edges = np.stack([self.new_vertices[faces[:, 1]] - origins, self.new_vertices[faces[:, 2]] - origins], axis=2)
 
-        jacobians2d = torch.from_numpy(np.stack([x_part, y_part], axis=1)).type(torch.float32)
-        self.jacobians = jacobians2d.permute(2, 0, 1)
+        jacobians = edges @ self.inverse_rest_edges[self.active_faces]
+        self.jacobians[self.active_faces] = torch.from_numpy(jacobians).type(torch.float32)
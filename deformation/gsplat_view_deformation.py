@@ -2,6 +2,7 @@ import torch
 
 from camera.abstract_camera import AbstractCamera
 from deformation.abstract_view_deformation import AbstractViewDeformation
+from utils.utils import find_sorted
 
 
 class GsplatViewDeformation(AbstractViewDeformation):
@@ -9,32 +10,69 @@ class GsplatViewDeformation(AbstractViewDeformation):
                  camera: AbstractCamera,
                  nb_data,
                  displacements=None,
-                 jacobians=None):
+                 jacobians=None,
+                 indices=None):
         super().__init__(camera, nb_data)
 
-        if displacements is None:
-            self.displacements = torch.zeros((nb_data, 3), device='cuda')
-        else:
-            self.displacements = displacements
-        if jacobians is None:
-            self.jacobians = torch.eye(3, device='cuda').repeat(nb_data, 1, 1)
+        # Only the primitives deformed in this view are stored: their sorted global indices [M], displacements [M, 3]
+        # and jacobians [M, 3, 3]. The other primitives are not displaced and keep identity jacobians
+        self.indices = torch.zeros(0, dtype=torch.long, device='cuda')
+        self.displacements = torch.zeros((0, 3), device='cuda')
+        self.jacobians = torch.zeros((0, 3, 3), device='cuda')
+        if displacements is not None:
+            self.set_deformation(displacements, jacobians, indices)
+
+    """ Set the displacements and jacobians of the primitives in indices (global indices, all the primitives if None),
+        only the deformed ones are stored """
+    def set_deformation(self, displacements, jacobians, indices=None):
+        if indices is None:
+            indices = torch.arange(len(displacements), device=displacements.device)
+        identity = torch.eye(3, device=jacobians.device).flatten()
+        deformed = torch.any(displacements != 0, dim=1) | torch.any(jacobians.flatten(1) != identity, dim=1)
+        indices, displacements, jacobians = indices[deformed], displacements[deformed], jacobians[deformed]
+
+        order = torch.argsort(indices)
+        self.indices = indices[order]
+        self.displacements = displacements[order]
+        self.jacobians = jacobians[order]
+
+    """ Save the 3D displacements and 3x3 jacobians of the primitives in indices (global indices, all the primitives if
+        None). The saved deformation of the resident primitives (global indices, all the primitives if None) is
+        replaced, the other primitives keep theirs """
+    def save_view_deformation(self, displacement_vectors, jacobians=None, indices=None, resident_indices=None):
+        if resident_indices is not None:
+            kept = ~torch.isin(self.indices, resident_indices)
+            displacement_vectors = torch.cat((self.displacements[kept], displacement_vectors))
+            jacobians = torch.cat((self.jacobians[kept], jacobians))
+            indices = torch.cat((self.indices[kept], indices))
+        self.set_deformation(displacement_vectors, jacobians, indices)
+
+    """ Get the saved values [N, ...] of primitives (global indices, all the primitives if None), the primitives not
+        deformed in this view get the default value """
+    def get_values(self, values, default, indices=None):
+        nb_values = self.nb_data if indices is None else len(indices)
+        result = default.repeat(nb_values, *([1] * default.dim()))
+        if indices is None:
+            result[self.indices] = values
         else:
-            self.jacobians = jacobians
+            positions, found = find_sorted(self.indices, indices)
+            result[found] = values[positions[found]]
+        return result
+
+    """ Get the displacements [N, 3] of primitives (global indices, all the primitives if None) """
+    def get_displacements(self, indices=None):
+        return self.get_values(self.displacements, torch.zeros(3, device='cuda'), indices)
 
-    """ Save the 3D displacements and 3x3 jacobians associated with this view deformation """
-    def save_view_deformation(self, displacement_vectors, jacobians=None):
-        self.displacements = displacement_vectors
-        self.jacobians = jacobians
-        print(displacement_vectors)
+    """ Get the jacobians [N, 3, 3] of primitives (global indices, all the primitives if None) """
+    def get_jacobians(self, indices=None):
+        return self.get_values(self.jacobians, torch.eye(3, device='cuda'), indices)
 
     """ Deform the 2D points based on the 2D mesh associated with this view deformation """
-    def deform(self, points2d):
+    def deform(self, points2d, primitives=None):
         if self.bbw_mesh_tool is not None:
-            triangles = self.bbw_mesh_tool.get_triangles('cuda')
-
             # Compute the displacement for the 2D means
-            displacements =  torch.sum(self.bbw_mesh_tool.barycentric_coordinates * triangles, dim=1) - points2d
-            jacobians = self.bbw_mesh_tool.bbw_mesh.jacobians[self.bbw_mesh_tool.indices].to('cuda')
+            displacements = self.bbw_mesh_tool.get_deformed_points('cuda', primitives) - points2d
+            jacobians = self.bbw_mesh_tool.get_jacobians('cuda', primitives)
 
             points2d += displacements
 
@@ -51,6 +89,7 @@ class GsplatViewDeformation(AbstractViewDeformation):
             "variance_azimuth": self.variance_azimuth,
             "variance_polar": self.variance_polar,
             "nb_data": self.nb_data,
-            "displacements": self.displacements.cpu().numpy() if self.displacements is not None else None,
-            "jacobians": self.jacobians.cpu().numpy() if self.jacobians is not None else None,
+            "indices": self.indices.cpu().numpy(),
+            "displacements": self.displacements.cpu().numpy(),
+            "jacobians": self.jacobians.cpu().numpy(),
         }
\ No newline at end of file
@@ -13,13 +13,14 @@ class GsplatViewDeformer(AbstractViewDeformer):
         view_deformation = GsplatViewDeformation(camera, nb_data, displacements, jacobians)
         self.view_deformations.append(view_deformation)
 
-    """ Get the interpolation data (In our case bivariate gaussian data) for each GsplatViewDeformation """
-    def get_gaussian_data(self):
+    """ Get the interpolation data (In our case bivariate gaussian data) for the first n GsplatViewDeformations (all if
+        None), with their values for the primitives in indices (all the primitives if None) """
+    def get_gaussian_data(self, n=None, indices=None):
         gaussian_data = []
         displacements = []
         jacobians = []
 
-        for view_deformation in self.view_deformations:
+        for view_deformation in self.view_deformations[:n]:
             gaussian_data.append([
                 view_deformation.mean_azimuth,
                 view_deformation.mean_polar,
@@ -29,21 +30,22 @@ class GsplatViewDeformer(AbstractViewDeformer):
 
             assert isinstance(view_deformation, GsplatViewDeformation)
 
-            displacements.append(view_deformation.displacements)
-            jacobians.append(view_deformation.jacobians)
+            displacements.append(view_deformation.get_displacements(indices))
+            jacobians.append(view_deformation.get_jacobians(indices))
 
         return gaussian_data, displacements, jacobians
 
     """ Interpolate the GsplatViewDeformations """
-    def get_interpolated_values(self, camera: AbstractCamera, n, nb_data):
-        gaussian_data, displacements, jacobians = self.get_gaussian_data()
+    def get_interpolated_values(self, camera: AbstractCamera, n, nb_data, indices=None):
+        gaussian_data, displacements, jacobians = self.get_gaussian_data(n, indices)
+        nb_values = nb_data if indices is None else len(indices)
 
         interpolated_displacements = get_interpolated_displacements(camera.azimuth, camera.polar,
                                                                     gaussian_data, displacements,
-                                                                    n, nb_data)
+                                                                    n, nb_values)
 
         interpolated_jacobians = get_interpolated_jacobians(camera.azimuth, camera.polar,
                                                             gaussian_data, jacobians,
-                                                            n, nb_data)
+                                                            n, nb_values)
 
         return interpolated_displacements, interpolated_jacobians
\ No newline at end of file
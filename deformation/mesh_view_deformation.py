@@ -18,16 +18,23 @@ class MeshViewDeformation(AbstractViewDeformation):
             self.displacements = displacements
 
     """ Save the 3D displacements associated with this view deformation """
-    def save_view_deformation(self, displacement_vectors, jacobians=None):
+    def save_view_deformation(self, displacement_vectors, jacobians=None, indices=None, resident_indices=None):
+        if indices is not None:
+            self.displacements[indices] = displacement_vectors
+            return
         self.displacements = displacement_vectors
 
+    """ Get the displacements [N, 3] of vertices (global indices, all the vertices if None) """
+    def get_displacements(self, indices=None):
+        if indices is None:
+            return self.displacements
+        return self.displacements[indices]
+
     """ Deform the 2D points based on the 2D mesh associated with this view deformation """
-    def deform(self, points2d):
+    def deform(self, points2d, primitives=None):
         if self.bbw_mesh_tool is not None:
-            triangles = self.bbw_mesh_tool.get_triangles('cuda')
-
-             # Compute the displacement for the 2D vertices
-            displacements = torch.sum(self.bbw_mesh_tool.barycentric_coordinates * triangles, dim=1) - points2d
+            # Compute the displacement for the 2D vertices
+            displacements = self.bbw_mesh_tool.get_deformed_points('cuda', primitives) - points2d
 
             points2d += displacements
 
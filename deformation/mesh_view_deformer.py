@@ -13,12 +13,13 @@ class MeshViewDeformer(AbstractViewDeformer):
         view_deformation = MeshViewDeformation(camera, nb_data, displacements)
         self.view_deformations.append(view_deformation)
 
-    """ Get the interpolation data (In our case bivariate gaussian data) for each GsplatViewDeformation """
-    def get_gaussian_data(self):
+    """ Get the interpolation data (In our case bivariate gaussian data) for the first n MeshViewDeformations (all if
+        None), with their values for the primitives in indices (all the primitives if None) """
+    def get_gaussian_data(self, n=None, indices=None):
         gaussian_data = []
         displacements = []
 
-        for view_deformation in self.view_deformations:
+        for view_deformation in self.view_deformations[:n]:
             gaussian_data.append([
                 view_deformation.mean_azimuth,
                 view_deformation.mean_polar,
@@ -28,16 +29,17 @@ class MeshViewDeformer(AbstractViewDeformer):
 
             assert isinstance(view_deformation, MeshViewDeformation)
 
-            displacements.append(view_deformation.displacements)
+            displacements.append(view_deformation.get_displacements(indices))
 
         return gaussian_data, displacements
 
     """ Interpolate the MeshViewDeformations """
-    def get_interpolated_values(self, camera: AbstractCamera, n, nb_data):
-        gaussian_data, displacements = self.get_gaussian_data()
+    def get_interpolated_values(self, camera: AbstractCamera, n, nb_data, indices=None):
+        gaussian_data, displacements = self.get_gaussian_data(n, indices)
+        nb_values = nb_data if indices is None else len(indices)
 
         interpolated_displacements = get_interpolated_displacements(camera.azimuth, camera.polar,
                                                                     gaussian_data, displacements,
-                                                                    n, nb_data)
+                                                                    n, nb_values)
 
         return interpolated_displacements
\ No newline at end of file
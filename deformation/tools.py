@@ -1,32 +1,242 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import torch
 from gpytoolbox import barycentric_coordinates, in_element_aabb
 
 from deformation.bbw_mesh import BbwMesh
+from deformation.weight_solvers import compare_weight_solvers
+from utils.utils import find_sorted, locate_points
+
+
+# The 2D meshes are generated in worker threads (the tools hold device tensors, which can not move between processes),
+# several view deformations at a time
+MESH_WORKERS = 2
+mesh_executor = None
+
+
+""" Get the pool of worker threads generating the 2D meshes, started at the first generation """
+def get_mesh_executor():
+    global mesh_executor
+    if mesh_executor is None:
+        mesh_executor = ThreadPoolExecutor(max_workers=MESH_WORKERS)
+    return mesh_executor
 
 
-""" 2D Mesh tool using BBW for the deformations """
+""" Build the sparse embedding operator [N, V] of points in a 2D mesh, on device: each row holds the barycentric
+    coordinates [N, 3] of a point on the vertices of its triangle (indices [N], empty rows for the points not embedded).
+    The positions of the points on the deformed mesh are then operator @ vertices """
+def get_embedding_operator(indices, bary_coordinates, faces, nb_vertices, device):
+    embedded = indices >= 0
+    crow_indices = np.concatenate([[0], np.cumsum(3 * embedded)])
+    col_indices = faces[indices[embedded]].ravel()
+    values = bary_coordinates[embedded].ravel()
+
+    return torch.sparse_csr_tensor(torch.from_numpy(crow_indices).to(device),
+                                   torch.from_numpy(col_indices.astype(np.int64)).to(device),
+                                   torch.from_numpy(values.astype(np.float32)).to(device),
+                                   size=(len(indices), nb_vertices), check_invariants=False)
+
+
+""" 2D Mesh tool using BBW for the deformations.
+    - weight_solver: solver of the handle weights, "bbw" (bounded biharmonic weights) or "fast" (prefactored fast
+      weights, interactive on fine meshes but may spread further from the handles, see compare_weight_solvers)
+    - multires: solve the weights on a coarse mesh and prolongate them to the 2D mesh
+    - point_location: how the primitives are located in the triangles of the 2D mesh, "raster" (triangle indices
+      rasterized in the image, see locate_points) or "aabb" (AABB tree of the triangles).
+      The primitives outside the 2D mesh are not embedded and are unaffected by the deformations, only the embedded
+      ones are kept (by global index) """
 class BbwMeshTool:
-    def __init__(self):
+    def __init__(self, weight_solver="bbw", multires=False, point_location="raster"):
+        self.weight_solver = weight_solver
+        self.multires = multires
+        self.point_location = point_location
         self.bbw_mesh = None
+        self.primitives = None
         self.barycentric_coordinates = None
         self.indices = None
 
-    """ Initialize the tool by generating a 2D mesh using the rendered image of the 3D model """
-    def initialize_bbw_mesh(self, points2d, image):
-        self.bbw_mesh = BbwMesh(image)
-        indices = in_element_aabb(points2d, self.bbw_mesh.vertices, self.bbw_mesh.faces)
-        triangles = self.bbw_mesh.vertices[self.bbw_mesh.faces[indices]].astype(np.float32)
-        bary_coordinates = barycentric_coordinates(points2d,
+        # Device-resident embedding of the primitives, and deformed positions and jacobians of the primitives refreshed
+        # only when the 2D mesh is deformed (tracked by its vertices tensor)
+        self.device_primitives = None
+        self.embedding_operator = None
+        self.device_indices = None
+        self.deformed_vertices = None
+        self.deformed_points = None
+        self.device_jacobians = None
+
+    """ Initialize the tool by generating a 2D mesh using the rendered image of the 3D model, and embed the projected
+        points [P, 2] of the primitives (global indices [P], all the primitives if None) in it.
+        job: MeshGenerationJob running the initialization in the background, which gets the progress and can cancel it
+        between the stages and the refinements of the 2D mesh """
+    def initialize_bbw_mesh(self, points2d, image, primitives=None, job=None):
+        report = job.report if job is not None else lambda progress, stage: None
+        if primitives is None:
+            primitives = np.arange(len(points2d))
+
+        report(0.0, "meshing")
+        self.bbw_mesh = BbwMesh(image, self.weight_solver, self.multires, report=report)
+
+        # Points culled during the projection are not finite and can not be embedded in the 2D mesh
+        report(0.5, "locating")
+        if self.point_location == "raster":
+            indices = locate_points(points2d, self.bbw_mesh.vertices, self.bbw_mesh.faces, np.array(image).shape)
+        else:
+            valid = np.isfinite(points2d).all(axis=1)
+            indices = np.full(len(points2d), -1, dtype=np.int64)
+            indices[valid] = in_element_aabb(points2d[valid], self.bbw_mesh.vertices, self.bbw_mesh.faces)
+
+        report(0.8, "embedding")
+        embedded = indices >= 0
+        triangles = self.bbw_mesh.vertices[self.bbw_mesh.faces[indices[embedded]]].astype(np.float32)
+        bary_coordinates = barycentric_coordinates(points2d[embedded],
                                                    np.ascontiguousarray(triangles[:, 0]),
                                                    np.ascontiguousarray(triangles[:, 1]),
-                                                   np.ascontiguousarray(triangles[:, 2]))
+                                                   np.ascontiguousarray(triangles[:, 2])).astype(np.float32)
 
-        self.barycentric_coordinates = torch.from_numpy(bary_coordinates[:, :, np.newaxis]).to('cuda')
-        self.indices = indices
+        self.set_embedding(primitives[embedded], indices[embedded], bary_coordinates)
         self.bbw_mesh.points2d = points2d
+        report(1.0, "done")
+
+    """ Embed the primitives (global indices [E]) in the triangles of the 2D mesh (indices [E]) with their barycentric
+        coordinates [E, 3], the other primitives are not embedded """
+    def set_embedding(self, primitives, indices, bary_coordinates):
+        order = np.argsort(primitives, kind="stable")
+        self.primitives = primitives[order]
+        self.indices = indices[order]
+        self.barycentric_coordinates = bary_coordinates[order]
+        self.device_primitives = torch.from_numpy(self.primitives).to('cuda')
+        self.embedding_operator = get_embedding_operator(self.indices, self.barycentric_coordinates,
+                                                         self.bbw_mesh.faces, len(self.bbw_mesh.vertices), 'cuda')
+        self.device_indices = torch.from_numpy(self.indices).to('cuda')
+        self.deformed_vertices = None
+        self.bbw_mesh.set_active_faces(np.unique(self.indices))
+
+    """ Save the tool (2D mesh, handles, weights and embedding of the primitives) as compressed npz bytes.
+        to_file_indices maps the primitives to the order of the source file (see AbstractRenderer.to_file_indices) """
+    def to_bytes(self, to_file_indices=lambda indices: indices):
+        state = self.bbw_mesh.get_state()
+        state.update(weight_solver=self.weight_solver, multires=self.multires, point_location=self.point_location,
+                     primitives=to_file_indices(self.primitives).astype(np.int64),
+                     indices=self.indices.astype(np.int32), barycentric_coordinates=self.barycentric_coordinates)
+
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **state)
+        return buffer.getvalue()
+
+    """ Compare the speed and the weights of the two weight solvers for the current handles """
+    def compare_weight_solvers(self):
+        return compare_weight_solvers(self.bbw_mesh.original_vertices, self.bbw_mesh.faces,
+                                      self.bbw_mesh.handles_index.astype(int))
+
+    """ Mask of the primitives (global indices) that are embedded in the 2D mesh """
+    def is_embedded(self, primitives):
+        return find_sorted(self.device_primitives, primitives)[1]
+
+    """ Get the image-space bounds (x_min, y_min, x_max, y_max) of the 2D mesh """
+    def get_image_bounds(self):
+        min_coords = self.bbw_mesh.original_vertices.min(axis=0)
+        max_coords = self.bbw_mesh.original_vertices.max(axis=0)
+        return min_coords[0], min_coords[1], max_coords[0], max_coords[1]
+
+    """ Get the triangle indices of a subset of primitives (global indices, all the embedded primitives if None), -1 for
+        the primitives not embedded """
+    def get_indices(self, primitives=None):
+        if primitives is None:
+            return self.indices
+        positions, found = find_sorted(self.device_primitives, primitives)
+        return np.where(found.cpu().numpy(), self.indices[positions.cpu().numpy()], -1)
+
+    """ Upload the deformed vertices [V, 2] and jacobians of the 2D mesh if it was deformed since the last call, and
+        move all the primitives with the embedding operator """
+    def update_deformed_points(self, device):
+        if self.deformed_vertices is self.bbw_mesh.new_vertices_tensor:
+            return
+        self.deformed_vertices = self.bbw_mesh.new_vertices_tensor
+        self.deformed_points = self.embedding_operator @ self.deformed_vertices.to(device)
+        self.device_jacobians = self.bbw_mesh.jacobians.to(device)
+
+    """ Get the positions on the deformed 2D mesh of a subset of embedded primitives (global indices, all the embedded
+        primitives if None) """
+    def get_deformed_points(self, device, primitives=None):
+        self.update_deformed_points(device)
+        if primitives is None:
+            return self.deformed_points
+        return self.deformed_points[find_sorted(self.device_primitives, primitives)[0]]
+
+    """ Get the jacobians of the triangles containing a subset of embedded primitives (global indices, all the embedded
+        primitives if None) """
+    def get_jacobians(self, device, primitives=None):
+        self.update_deformed_points(device)
+        if primitives is None:
+            return self.device_jacobians[self.device_indices]
+        return self.device_jacobians[self.device_indices[find_sorted(self.device_primitives, primitives)[0]]]
+
+
+""" Restore a tool saved with BbwMeshTool.to_bytes, without generating its mesh, locating the primitives or solving
+    its weights again. from_file_indices maps the primitives to the loading order (see AbstractRenderer.from_file_indices)
+"""
+def bbw_mesh_tool_from_bytes(data, from_file_indices=lambda indices: indices):
+    with np.load(io.BytesIO(data)) as arrays:
+        state = dict(arrays)
+
+    multires = bool(state["multires"])
+    bbw_mesh_tool = BbwMeshTool(str(state["weight_solver"]), multires, str(state["point_location"]))
+    coarse_mesh = (state["coarse_vertices"], state["coarse_faces"]) if multires else None
+    bbw_mesh_tool.bbw_mesh = BbwMesh(None, bbw_mesh_tool.weight_solver, multires,
+                                     (state["rest_vertices"], state["faces"]), coarse_mesh)
+    # Older tools saved the embedding of all the primitives, in the order of the file (-1 for the ones not embedded)
+    if "primitives" in state:
+        primitives, indices = state["primitives"], state["indices"]
+        bary_coordinates = state["barycentric_coordinates"]
+    else:
+        primitives = np.flatnonzero(state["indices"] >= 0)
+        indices, bary_coordinates = state["indices"][primitives], state["barycentric_coordinates"][primitives]
+    bbw_mesh_tool.set_embedding(from_file_indices(primitives).astype(np.int64), indices.astype(np.int64),
+                                bary_coordinates)
+    bbw_mesh_tool.bbw_mesh.set_state(state)
+
+    return bbw_mesh_tool
+
+
+""" Raised in the worker generating a 2D mesh when its job is cancelled """
+class MeshGenerationCancelled(Exception):
+    pass
+
+
+""" Handle of the generation of the 2D mesh of a tool in the background (see BbwMeshTool.initialize_bbw_mesh).
+    progress (in [0, 1]) and stage report the current stage of the generation. cancel stops it at the next refinement of
+    the 2D mesh or at the next stage: the preparation of the weight solver and the point location are not interrupted """
+class MeshGenerationJob:
+    def __init__(self, tool, points2d, image, primitives=None):
+        self.tool = tool
+        self.progress = 0.0
+        self.stage = "queued"
+        self.cancelled = False
+        self.future = get_mesh_executor().submit(tool.initialize_bbw_mesh, points2d, image, primitives, self)
+
+    """ Report the progress of the generation, from the worker """
+    def report(self, progress, stage):
+        if self.cancelled:
+            raise MeshGenerationCancelled()
+        self.progress = progress
+        self.stage = stage
+
+    """ Cancel the generation """
+    def cancel(self):
+        self.cancelled = True
+        self.future.cancel()
+
+    """ Check if the generation stopped (finished, failed or cancelled) """
+    def done(self):
+        return self.future.done()
 
-    """ get the new triangle's positions to compute the barycentric coordinates """
-    def get_triangles(self, device):
-        new_triangles = self.bbw_mesh.new_vertices_tensor[self.bbw_mesh.faces[self.indices]].to(device)
-        return new_triangles
\ No newline at end of file
+    """ Get the generated tool, None if the generation was cancelled. Raises the error of a failed generation """
+    def get_tool(self):
+        if self.cancelled or self.future.cancelled():
+            return None
+        error = self.future.exception()
+        if error is not None:
+            raise error
+        return self.tool
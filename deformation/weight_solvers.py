@@ -0,0 +1,281 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import igl
+import numpy as np
+import scipy.sparse as sp
+from gpytoolbox import barycentric_coordinates
+from scipy.sparse.linalg import splu
+from scipy.spatial import cKDTree
+
+try:
+    from sksparse.cholmod import cholesky
+except ImportError:
+    cholesky = None
+
+
+# The weights of the handles are solved column by column in worker processes: the igl bindings hold the GIL, so the
+# solves would freeze the interface (and run one at a time) in threads
+BBW_WORKERS = max(min(os.cpu_count() or 1, 8) - 1, 1)
+bbw_executor = None
+
+# Regularization of the biharmonic energy of the fast weights, relative to its scale (the energy alone does not change
+# when a constant is added to the weights)
+FAST_WEIGHTS_REGULARIZATION = 1e-8
+
+# Smoothing iterations on the fine mesh after the prolongation of coarse weights, around the handles pinned to their
+# exact values (0 disables the refinement)
+REFINEMENT_ITERATIONS = 10
+
+
+""" Get the pool of worker processes solving the weights, started at the first solve """
+def get_bbw_executor():
+    global bbw_executor
+    if bbw_executor is None:
+        bbw_executor = ProcessPoolExecutor(max_workers=BBW_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return bbw_executor
+
+
+""" Solve the bounded biharmonic weights [V] of the handle at position column in handles_index (the other handles are
+    fixed to 0). The newer bindings (igl.bbw) are warm started from initial_weights [V], the older ones (igl.BBW) solve
+    from scratch.
+"""
+def solve_bbw_column(vertices, faces, handles_index, column, initial_weights=None):
+    handles_index = np.asarray(handles_index, dtype=np.int64)
+    boundary_conditions = np.zeros((len(handles_index), 1))
+    boundary_conditions[column] = 1.0
+
+    if hasattr(igl, "bbw"):
+        if initial_weights is None:
+            initial_weights = np.zeros((0, 0))
+        else:
+            initial_weights = initial_weights.reshape(-1, 1).copy()
+            initial_weights[handles_index] = boundary_conditions
+        weights = igl.bbw(vertices, np.asarray(faces, dtype=np.int64), handles_index, boundary_conditions,
+                          initial_weights)
+    else:
+        weights = igl.BBW().solve(vertices, faces, handles_index, boundary_conditions)
+    return weights[:, 0]
+
+
+""" Bounded biharmonic weights: a quadratic program with the weights bounded in [0, 1], solved per handle column in
+    worker processes (see solve_bbw_column). Slow, but the weights are smooth, local and never negative.
+"""
+class BbwWeightSolver:
+    background = True
+
+    def __init__(self, vertices, faces):
+        self.vertices = vertices
+        self.faces = faces
+
+    """ Start the solves of the columns of the handles. Returns the futures of the columns (vertex index -> future).
+        initial_columns: previous weights of the handles (vertex index -> column) used as warm starts """
+    def submit(self, handles_index, initial_columns=None):
+        initial_columns = initial_columns or {}
+        return {handle: get_bbw_executor().submit(solve_bbw_column, self.vertices, self.faces, handles_index, column,
+                                                  initial_columns.get(handle))
+                for column, handle in enumerate(handles_index.tolist())}
+
+    """ Get the columns (vertex index -> column) of the futures returned by submit, once they are all done """
+    def collect(self, handles_index, futures):
+        return {handle: future.result() for handle, future in futures.items()}
+
+    """ Solve the weights of the handles. Returns the columns (vertex index -> column) """
+    def solve(self, handles_index, initial_columns=None):
+        return self.collect(handles_index, self.submit(handles_index, initial_columns))
+
+
+""" Fast weights: the biharmonic energy w^T K w (K = L^T M^-1 L + regularization) is minimized under the handle
+    constraints only, without the bounds of the BBW quadratic program, then clamped to [0, 1] and normalized.
+    K is factored once per 2D mesh (CHOLMOD when scikit-sparse is installed, SuperLU otherwise). With Z = K^-1 P^T the
+    response to the handles (one back-substitution per handle, cached) and S = P Z, the constrained minimizer for the
+    identity boundary conditions is W = Z S^-1, so a new handle configuration only costs its new back-substitutions.
+"""
+class FastWeightSolver:
+    background = False
+
+    def __init__(self, vertices, faces, regularization=FAST_WEIGHTS_REGULARIZATION):
+        faces = np.asarray(faces, dtype=np.int64)
+        laplacian = igl.cotmatrix(vertices, faces)
+        mass = igl.massmatrix(vertices, faces, type=igl.MASSMATRIX_TYPE_VORONOI)
+        inverse_mass = sp.diags(1.0 / np.clip(mass.diagonal(), 1e-12, None))
+
+        bilaplacian = (laplacian.T @ inverse_mass @ laplacian).tocsc()
+        scale = regularization * bilaplacian.diagonal().sum() / mass.diagonal().sum()
+        system = (bilaplacian + scale * mass).tocsc()
+
+        if cholesky is not None:
+            self.factor = cholesky(system)
+        else:
+            self.factor = splu(system).solve
+
+        self.nb_vertices = len(vertices)
+        self.responses = {}
+
+    """ Get the responses Z [V, H] of the handles, back-substituting only the handles not seen before """
+    def get_responses(self, handles_index):
+        new_handles = [handle for handle in handles_index.tolist() if handle not in self.responses]
+        if len(new_handles) > 0:
+            rhs = np.zeros((self.nb_vertices, len(new_handles)))
+            rhs[new_handles, np.arange(len(new_handles))] = 1.0
+            solutions = self.factor(rhs)
+            for i, handle in enumerate(new_handles):
+                self.responses[handle] = solutions[:, i]
+
+        return np.stack([self.responses[handle] for handle in handles_index.tolist()], axis=1)
+
+    """ Solve the weights of the handles. Returns the columns (vertex index -> column) """
+    def solve(self, handles_index, initial_columns=None):
+        responses = self.get_responses(handles_index)
+        weights = np.linalg.solve(responses[handles_index].T, responses.T).T
+
+        weights = np.clip(weights, 0.0, 1.0)
+        weights /= np.clip(weights.sum(axis=1, keepdims=True), 1e-12, None)
+        return {handle: weights[:, i] for i, handle in enumerate(handles_index.tolist())}
+
+
+WEIGHT_SOLVERS = {"bbw": BbwWeightSolver, "fast": FastWeightSolver}
+
+
+""" Multiresolution weights: the weights are solved (with the "bbw" or "fast" solver) on a coarse mesh of the same
+    contour and prolongated to the fine mesh through the barycentric coordinates of the fine vertices in the coarse
+    mesh (the fine vertices outside the coarse mesh use the closest point of the coarse mesh).
+    Each handle is constrained at its closest free coarse vertex, the refinement pass then pins the fine handles to
+    their exact values and smooths their neighbourhoods for refinement_iterations iterations. With more handles than
+    coarse vertices, the weights are solved on the fine mesh instead.
+    The prolongation runs in collect, on the thread polling the futures, as it updates the warm starts.
+"""
+class MultiresWeightSolver:
+    def __init__(self, vertices, faces, coarse_vertices, coarse_faces, solver="bbw",
+                 refinement_iterations=REFINEMENT_ITERATIONS):
+        self.vertices = vertices
+        self.faces = faces
+        self.solver_type = solver
+        self.fine_solver = None
+        self.solver = WEIGHT_SOLVERS[solver](coarse_vertices, coarse_faces)
+        self.background = self.solver.background
+        self.refinement_iterations = refinement_iterations
+        self.coarse_tree = cKDTree(coarse_vertices)
+
+        # Prolongation operator [V, V_coarse] from the barycentric embedding of the fine vertices
+        coarse_faces = np.asarray(coarse_faces, dtype=np.int64)
+        _, closest_faces, closest_points = igl.point_mesh_squared_distance(np.asarray(vertices, dtype=np.float64),
+                                                                           coarse_vertices, coarse_faces)
+        triangles = coarse_vertices[coarse_faces[closest_faces]]
+        coordinates = np.clip(barycentric_coordinates(np.ascontiguousarray(closest_points),
+                                                      np.ascontiguousarray(triangles[:, 0]),
+                                                      np.ascontiguousarray(triangles[:, 1]),
+                                                      np.ascontiguousarray(triangles[:, 2])), 0.0, None)
+        coordinates /= np.clip(coordinates.sum(axis=1, keepdims=True), 1e-12, None)
+        self.prolongation = sp.csr_matrix((coordinates.ravel(), (np.repeat(np.arange(len(vertices)), 3),
+                                                                  coarse_faces[closest_faces].ravel())),
+                                          shape=(len(vertices), len(coarse_vertices)))
+
+        # Averaging over the neighbours of each fine vertex, for the refinement
+        adjacency = igl.adjacency_matrix(np.asarray(faces, dtype=np.int64)).astype(np.float64)
+        degrees = np.clip(np.asarray(adjacency.sum(axis=1)).ravel(), 1, None)
+        self.smoothing = (sp.diags(1.0 / degrees) @ adjacency).tocsr()
+
+        # Last coarse weights of each fine handle, used as warm starts
+        self.coarse_columns = {}
+
+    """ Get the solver of the fine mesh, used when the handles do not fit on the coarse mesh (see get_coarse_handles) """
+    def get_fine_solver(self, handles_index):
+        if len(handles_index) <= self.coarse_tree.n:
+            return None
+        if self.fine_solver is None:
+            self.fine_solver = WEIGHT_SOLVERS[self.solver_type](self.vertices, self.faces)
+        return self.fine_solver
+
+    """ Get a distinct coarse vertex for each handle, the closest one not already taken (each handle has as many
+        candidates as there are handles, so one of them is free when the coarse mesh has enough vertices) """
+    def get_coarse_handles(self, handles_index):
+        if len(handles_index) > self.coarse_tree.n:
+            raise ValueError(f"{len(handles_index)} handles do not fit on a coarse mesh of {self.coarse_tree.n} "
+                             f"vertices")
+        _, candidates = self.coarse_tree.query(self.vertices[handles_index], k=len(handles_index))
+        candidates = candidates.reshape(len(handles_index), len(handles_index))
+
+        coarse_handles = []
+        for row in candidates.tolist():
+            coarse_handles.append(next(candidate for candidate in row if candidate not in coarse_handles))
+        return np.array(coarse_handles, dtype=np.int64)
+
+    """ Prolongate the coarse weights of the handle at position column to the fine mesh and refine them """
+    def prolongate(self, handles_index, column, coarse_weights):
+        self.coarse_columns[handles_index[column]] = coarse_weights
+        constraints = np.zeros(len(handles_index))
+        constraints[column] = 1.0
+
+        weights = self.prolongation @ coarse_weights
+        for _ in range(self.refinement_iterations):
+            weights[handles_index] = constraints
+            weights = self.smoothing @ weights
+        weights[handles_index] = constraints
+        return np.clip(weights, 0.0, 1.0)
+
+    """ Get the coarse warm starts of the handles (coarse vertex index -> column) """
+    def get_initial_columns(self, handles_index, coarse_handles):
+        return {coarse_handle: self.coarse_columns[handle] for handle, coarse_handle in
+                zip(handles_index.tolist(), coarse_handles.tolist()) if handle in self.coarse_columns}
+
+    """ Start the solves of the columns of the handles on the coarse mesh.
+        Returns the futures of the coarse columns (vertex index -> future), prolongated by collect """
+    def submit(self, handles_index, initial_columns=None):
+        fine_solver = self.get_fine_solver(handles_index)
+        if fine_solver is not None:
+            return fine_solver.submit(handles_index, initial_columns)
+
+        coarse_handles = self.get_coarse_handles(handles_index)
+        coarse_futures = self.solver.submit(coarse_handles, self.get_initial_columns(handles_index, coarse_handles))
+        return {handle: coarse_futures[coarse_handle]
+                for handle, coarse_handle in zip(handles_index.tolist(), coarse_handles.tolist())}
+
+    """ Get the prolongated columns (vertex index -> column) of the futures returned by submit, once they are all
+        done """
+    def collect(self, handles_index, futures):
+        fine_solver = self.get_fine_solver(handles_index)
+        if fine_solver is not None:
+            return fine_solver.collect(handles_index, futures)
+
+        return {handle: self.prolongate(handles_index, column, futures[handle].result())
+                for column, handle in enumerate(handles_index.tolist())}
+
+    """ Solve the weights of the handles. Returns the columns (vertex index -> column) """
+    def solve(self, handles_index, initial_columns=None):
+        fine_solver = self.get_fine_solver(handles_index)
+        if fine_solver is not None:
+            return fine_solver.solve(handles_index, initial_columns)
+
+        coarse_handles = self.get_coarse_handles(handles_index)
+        coarse_columns = self.solver.solve(coarse_handles, self.get_initial_columns(handles_index, coarse_handles))
+        return {handle: self.prolongate(handles_index, column, coarse_columns[coarse_handle])
+                for column, (handle, coarse_handle) in enumerate(zip(handles_index.tolist(), coarse_handles.tolist()))}
+
+
+""" Compare the fast weights to the bounded biharmonic weights of a 2D mesh and handles.
+    Returns the time of each solve (in seconds, including the factorization of the fast weights) and the maximum and
+    mean absolute differences of the weights.
+"""
+def compare_weight_solvers(vertices, faces, handles_index):
+    handles_index = np.asarray(handles_index, dtype=np.int64)
+
+    start = time.perf_counter()
+    bbw_columns = BbwWeightSolver(vertices, faces).solve(handles_index)
+    bbw_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fast_solver = FastWeightSolver(vertices, faces)
+    factor_time = time.perf_counter() - start
+    fast_columns = fast_solver.solve(handles_index)
+    fast_time = time.perf_counter() - start
+
+    bbw_weights = np.stack([bbw_columns[handle] for handle in handles_index.tolist()], axis=1)
+    bbw_weights /= np.clip(bbw_weights.sum(axis=1, keepdims=True), 1, None)
+    fast_weights = np.stack([fast_columns[handle] for handle in handles_index.tolist()], axis=1)
+    errors = np.abs(bbw_weights - fast_weights)
+
+    return {"bbw_time": bbw_time, "fast_time": fast_time, "fast_factor_time": factor_time,
+            "max_error": float(errors.max()), "mean_error": float(errors.mean())}
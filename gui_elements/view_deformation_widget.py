@@ -68,6 +68,14 @@ class DeformationWidget(tk.Frame):
         print("Optional button clicked")
         update_callback()
 
+    """ Show the progress of the generation of the 2D mesh on its button (job is None once it stopped), clicking the
+        button meanwhile cancels it """
+    def show_mesh_job(self, job):
+        if job is None:
+            self.mesh_button.configure(text="Generate 2D mesh")
+        else:
+            self.mesh_button.configure(text=f"Cancel 2D mesh ({job.stage} {job.progress:.0%})")
+
     """ Show the generate 2D mesh button """
     def show_mesh_button(self):
         self.mesh_button.pack(fill="x", padx=3, pady=(5, 1))
@@ -4,6 +4,7 @@ import pickle
 import numpy as np
 
 from camera.abstract_camera import AbstractCamera
+from utils.gsplat_utils import MIN_OPACITY
 from utils.gui_utils import ask_for_filename, draw_mesh
 from utils.initializer import initialize_camera, initialize_renderer, initialize_vd, initialize_view_deformer
 
@@ -11,11 +12,28 @@ from utils.initializer import initialize_camera, initialize_renderer, initialize
     - handles both Mesh and Gsplat renderers.
     - handles the deformations.
     - handles the interpolation of the deformations 
+    - lod, min_opacity, min_scale and max_scale select the level of detail and the pruning of Gaussian models,
+      sh_storage the storage of their higher-order SH coefficients ("float32", "float16" or "codebook")
+    - reorder sorts the primitives along the Morton curve (on by default), the saved deformations stay in file order
+    - out_of_core streams Gaussian models from spatial chunks on disk, the deformations are indexed by .ply vertex
+    - shader_deformation applies the displacements of meshes in the vertex shader
+    - weight_solver selects the solver of the handle weights of the 2D meshes ("bbw" or "fast"), multires_weights
+      solves them on coarse meshes
 """
 class Manager:
-    def __init__(self, data_path, renderer_type, data):
+    def __init__(self, data_path, renderer_type, data, lod=0, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None,
+                 reorder=True, sh_storage="float32", out_of_core=False, shader_deformation=False, weight_solver="bbw",
+                 multires_weights=False):
         self.data_path = data_path
         self.renderer_type = renderer_type
+        self.lod = lod
+        self.min_opacity = min_opacity
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.sh_storage = sh_storage
+        self.out_of_core = out_of_core
+        self.weight_solver = weight_solver
+        self.multires_weights = multires_weights
 
         self.deformation_window_width = 400
         self.deformation_window_height = 400
@@ -25,7 +43,9 @@ class Manager:
 
         self.deformation_camera = initialize_camera(renderer_type, self.window_width, self.window_height)
 
-        self.renderer = initialize_renderer(renderer_type, 0, 0, 1, data_path, self.deformation_camera)
+        self.renderer = initialize_renderer(renderer_type, 0, 0, 1, data_path, self.deformation_camera,
+                                            lod, min_opacity, min_scale, max_scale, reorder, sh_storage, out_of_core,
+                                            shader_deformation)
 
         self.view_deformer = initialize_view_deformer(renderer_type)
         self.initialize_view_deformer(data)
@@ -69,21 +89,54 @@ class Manager:
     def checkout_view_deformation(self, i):
         self.deformation_camera.update(self.view_deformer.view_deformations[i].camera)
 
-    """ Generate the 2D mesh for the ith view deformation"""
+    """ Generate the 2D mesh for the ith view deformation in the background (see update_mesh_jobs), or cancel its
+        generation. The saved 2D mesh of a loaded view deformation is restored instead """
     def mesh_generation_callback(self, i):
-        (self.view_deformer.view_deformations[i]
-        .select_bbw_mesh_tool(
-            self.renderer.image1_data,
-            self.renderer.get_points2d(
-                self.view_deformer,
-                self.view_deformer.view_deformations[i].camera
-            )[0]
-        ))
+        view_deformation = self.view_deformer.view_deformations[i]
+        if view_deformation.bbw_mesh_tool is None and view_deformation.saved_bbw_mesh_tool is not None:
+            view_deformation.restore_bbw_mesh_tool(self.renderer.from_file_indices)
+        else:
+            points2d, _, primitives = self.renderer.get_points2d(self.view_deformer, view_deformation.camera)
+            view_deformation.select_bbw_mesh_tool(
+                np.array(self.renderer.image1_data),
+                points2d,
+                primitives,
+                self.weight_solver,
+                self.multires_weights,
+                background=True
+            )
         self.movable = False
 
+    """ Attach the 2D meshes generated in the background. Returns True if a generation stopped, and the errors of the
+        generations that failed """
+    def update_mesh_jobs(self):
+        stopped = False
+        errors = []
+        for view_deformation in self.view_deformer.view_deformations:
+            try:
+                stopped |= view_deformation.update_mesh_job()
+            except Exception as error:
+                stopped = True
+                errors.append(error)
+        return stopped, errors
+
+    """ Compare the weight solvers on the 2D mesh and the handles of the edited view deformation (see
+        compare_weight_solvers). Returns None without a 2D mesh with handles """
+    def compare_weight_solvers(self):
+        if self.view_deformation is None:
+            return None
+        bbw_mesh_tool = self.view_deformer.view_deformations[self.view_deformation].bbw_mesh_tool
+        if bbw_mesh_tool is None or len(bbw_mesh_tool.bbw_mesh.handles_index) == 0:
+            return None
+        return bbw_mesh_tool.compare_weight_solvers()
+
+    """ Check if 2D meshes are generated in the background """
+    def has_mesh_jobs(self):
+        return any(view_deformation.mesh_job is not None for view_deformation in self.view_deformer.view_deformations)
+
     """ Delete a view deformation from the view deformer"""
     def delete_view_deformation(self, index):
-        self.view_deformer.view_deformations.pop(index)
+        self.view_deformer.view_deformations.pop(index).delete_bbw_mesh_tool()
         if self.view_deformation is not None:
             if index == self.view_deformation:
                 self.view_deformation = None
@@ -95,7 +148,13 @@ class Manager:
         data_to_save = {
             "renderer_type": self.renderer_type,
             "data_path": self.data_path,
-            "view_deformations": [vd.to_dict() for vd in self.view_deformer.view_deformations],
+            "lod": self.lod,
+            "min_opacity": self.min_opacity,
+            "min_scale": self.min_scale,
+            "max_scale": self.max_scale,
+            "sh_storage": self.sh_storage,
+            "out_of_core": self.out_of_core,
+            "view_deformations": [self.view_deformation_to_dict(vd) for vd in self.view_deformer.view_deformations],
         }
 
         file_name = ask_for_filename("Save Model", "Please Enter a File Name")
@@ -114,6 +173,17 @@ class Manager:
         with open(save_path, "wb") as file:
             pickle.dump(data_to_save, file)
 
+    """ Save a view deformation as a dict, with its per-primitive data (or the indices of its deformed primitives) in
+        the order of the source file """
+    def view_deformation_to_dict(self, view_deformation):
+        vd_data = view_deformation.to_dict()
+        if vd_data.get("indices") is not None:
+            vd_data["indices"] = self.renderer.to_file_indices(vd_data["indices"])
+        else:
+            vd_data["displacements"] = self.renderer.to_file_order(vd_data["displacements"])
+        vd_data["bbw_mesh_tool"] = view_deformation.get_bbw_mesh_tool_bytes(self.renderer.to_file_indices)
+        return vd_data
+
     """ Initialize the view deformer when loading a view-dependent model."""
     def initialize_view_deformer(self, data):
         if data is not None:
@@ -121,7 +191,14 @@ class Manager:
                 camera_data = vd['camera']
                 camera = initialize_camera(self.renderer_type, self.window_width, self.window_height,
                                            camera_data['azimuth'], camera_data['polar'])
+                vd = dict(vd)
+                if vd.get("indices") is not None:
+                    vd["indices"] = self.renderer.from_file_indices(vd["indices"])
+                else:
+                    vd["displacements"] = self.renderer.from_file_order(vd["displacements"])
+                    vd["jacobians"] = self.renderer.from_file_order(vd.get("jacobians"))
                 view_deformation = initialize_vd(camera, vd)
+                view_deformation.saved_bbw_mesh_tool = vd.get("bbw_mesh_tool")
                 self.view_deformer.view_deformations.append(view_deformation)
 
     """ Resize the camera size when resizing the deformation rendering window """
@@ -137,14 +214,16 @@ class Manager:
                 self.view_deformer.view_deformations[self.view_deformation].select_handle(event)
         else:
             if self.view_deformation is None:
-                # Get position for camera movement
+                # Get position for camera movement, the renderer switches to its interactive mode during the orbit
                 self.last_mouse_position = np.array([event.x, event.y])
+                self.renderer.set_interactive(True)
             if self.view_deformation is not None and not self.movable:
                 # Add the closest vertex to the handles list
                 self.view_deformer.view_deformations[self.view_deformation].add_or_remove_handle(event)
             if self.view_deformation is not None and self.movable:
-                # Get position for handle movement
+                # Get position for handle movement, the renderer switches to its interactive mode during the drag
                 self.mouse_position = np.array([event.x, event.y])
+                self.renderer.set_interactive(True)
                 # Get the closest handle to move it
                 self.view_deformer.view_deformations[self.view_deformation].check_handle(event)
 
@@ -172,6 +251,7 @@ class Manager:
 
     """ Mouse release event """
     def mouse_release_event(self, event):
+        self.renderer.set_interactive(False)
         if event.num == 1:  # Left mouse button
             self.last_mouse_position = None
         if self.view_deformation is not None and self.movable:
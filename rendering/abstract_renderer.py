@@ -2,6 +2,9 @@ from abc import ABC, abstractmethod
 
 import tkinter as tk
 
+import numpy as np
+import torch
+
 from camera.abstract_camera import AbstractCamera
 from deformation.abstract_view_deformation import AbstractViewDeformation
 from deformation.abstract_view_deformer import AbstractViewDeformer
@@ -14,10 +17,51 @@ class AbstractRenderer(ABC):
 
         self.nb_data = 0
 
+        # Permutation applied to the primitives at load time (None when they are kept in file order)
+        self.permutation = None
+        self.inverse_permutation = None
+
     """ Returns the number of primitives """
     def get_nb_data(self):
         return self.nb_data
 
+    """ Set the permutation applied to the primitives at load time: primitive i is primitive permutation[i] of the file """
+    def set_permutation(self, permutation):
+        self.permutation = permutation
+        self.inverse_permutation = torch.argsort(permutation)
+
+    """ Reorder per-primitive values (tensor or array) from the loading order to the order of the source file """
+    def to_file_order(self, values):
+        if self.inverse_permutation is None or values is None:
+            return values
+        if isinstance(values, np.ndarray):
+            return values[self.inverse_permutation.cpu().numpy()]
+        return values[self.inverse_permutation.to(values.device)]
+
+    """ Reorder per-primitive values (tensor or array) from the order of the source file to the loading order """
+    def from_file_order(self, values):
+        if self.permutation is None or values is None:
+            return values
+        if isinstance(values, np.ndarray):
+            return values[self.permutation.cpu().numpy()]
+        return values[self.permutation.to(values.device)]
+
+    """ Map indices of primitives (tensor or array) in the loading order to the order of the source file """
+    def to_file_indices(self, indices):
+        if self.permutation is None or indices is None:
+            return indices
+        if isinstance(indices, np.ndarray):
+            return self.permutation.cpu().numpy()[indices]
+        return self.permutation.to(indices.device)[indices]
+
+    """ Map indices of primitives (tensor or array) in the order of the source file to the loading order """
+    def from_file_indices(self, indices):
+        if self.inverse_permutation is None or indices is None:
+            return indices
+        if isinstance(indices, np.ndarray):
+            return self.inverse_permutation.cpu().numpy()[indices]
+        return self.inverse_permutation.to(indices.device)[indices]
+
     """ Renders the view-dependent model """
     @abstractmethod
     def render(self, camera: AbstractCamera, view_deformer: AbstractViewDeformer,
@@ -40,6 +84,10 @@ class AbstractRenderer(ABC):
     def get_view_deform(self, *args, **kwargs):
         pass
 
+    """ Start or end an interaction (mouse down), the renderer may render a lighter model meanwhile """
+    def set_interactive(self, interactive):
+        pass
+
     """ Update the rendering size of the renderer (if needed) """
     def update_renderer_size(self, *args, **kwargs):
         pass
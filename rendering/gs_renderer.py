@@ -4,48 +4,85 @@ import tkinter as tk
 import numpy as np
 import torch
 from PIL import ImageTk, Image
-from gsplat import rasterization, quat_scale_to_covar_preci
+from gsplat import rasterization
 
 from camera.gsplat_camera import GsplatCamera
 from deformation.gsplat_view_deformation import GsplatViewDeformation
 from deformation.gsplat_view_deformer import GsplatViewDeformer
 from rendering.abstract_renderer import AbstractRenderer
-from utils.gsplat_utils import load_ply
-
-
-""" Gsplat Renderer for View-Dependent Gaussian Splatting Models """
+from utils.chunk_store import open_chunk_store, DEFAULT_MEMORY_BUDGET
+from utils.gsplat_utils import load_prepared_gaussians, transform_covars, triu_to_covars, MIN_OPACITY
+from utils.spatial_utils import Octree
+
+
+""" Gsplat Renderer for View-Dependent Gaussian Splatting Models
+    - lod: level-of-detail tier of the model (0 is the full model)
+    - min_opacity: gaussians with a lower opacity are pruned at load time
+    - min_scale, max_scale: gaussians whose largest scale is out of these bounds (if given) are pruned at load time
+    - reorder: sort the gaussians along the Morton curve so that the deformation gathers are spatially coherent
+    - sh_storage: storage of the higher-order SH coefficients, "float32", "float16" or "codebook".
+      The compressed ones are decoded for each rendering.
+    - out_of_core: stream the scene from spatial chunks stored on disk (see GaussianChunkStore), for scenes that do
+      not fit in memory. Only the chunks in the frustum are paged in, within memory_budget bytes. The lod, reorder
+      and sh_storage options are not used in this mode: the level of detail is chosen per chunk.
+    Only the derived data is kept resident: the colors (or sh0 and the compressed shN), the opacities and the
+    covariances as their 6 unique values. The quaternions and scales are dropped once the covariances are computed.
+"""
 class GaussianSplattingRenderer(AbstractRenderer):
-    def __init__(self, data_path, local_rank, world_rank, world_size):
+    def __init__(self, data_path, local_rank, world_rank, world_size, lod=0, min_opacity=MIN_OPACITY, min_scale=None,
+                 max_scale=None, reorder=False, sh_storage="float32", out_of_core=False,
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
         super().__init__()
         self.device = torch.device("cuda", local_rank)
+        self.lod = lod
+        self.min_opacity = min_opacity
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.sh_storage = sh_storage
+        self.world_rank = world_rank
+        self.world_size = world_size
 
-        xyz, opacities, scales, rots, features_dc, features_extra = load_ply(data_path)
-        self.means = torch.tensor(xyz, dtype=torch.float32, device=self.device).contiguous()
-        self.sh0 = torch.tensor(features_dc, dtype=torch.float32, device=self.device).transpose(1, 2).contiguous()
-        self.shN = torch.tensor(features_extra, dtype=torch.float32, device=self.device).transpose(1, 2).contiguous()
-        self.opacities = torch.sigmoid(torch.tensor(opacities, dtype=torch.float32, device=self.device)).squeeze()
-        self.scales = torch.exp(torch.tensor(scales, dtype=torch.float32, device=self.device)).contiguous()
-        self.quats = torch.nn.functional.normalize(torch.tensor(rots, dtype=torch.float32, device=self.device)).contiguous()
-
-        # # Normalization of the colors
-        max_values_per_channel, _ = torch.max(self.sh0, dim=-1, keepdim=True)
-        max_values_per_channel = torch.clamp(max_values_per_channel, min=1.0)  # Prevent division by 0
-
-        # Normalize each channel separately
-        self.sh0 = self.sh0 / max_values_per_channel
+        # Global indices of the resident gaussians, None when the whole scene is resident
+        self.chunk_store = None
+        self.resident_indices = None
+        if out_of_core:
+            self.chunk_store = open_chunk_store(data_path, self.device, min_opacity, min_scale, max_scale, memory_budget)
+            self.nb_data = self.chunk_store.nb_data
+            self.sh_degree = self.chunk_store.sh_degree
+            self.sh0 = self.shN = self.sh_codebook = self.sh_codes = None
+            self.octree = None
+            return
+
+        # Prepared tensors, loaded from the binary cache next to the .ply file when it is up to date
+        gaussians = load_prepared_gaussians(data_path, self.device, lod, min_opacity, min_scale, max_scale, reorder,
+                                            sh_storage)
+        self.means = gaussians["means"]
+        self.opacities = gaussians["opacities"]
+        self.covars = gaussians["covars"]  # Upper-triangular covariances [N, 6]
+        self.colors = gaussians.get("colors")
+        self.sh0 = gaussians.get("sh0")
+        self.shN = gaussians.get("shN")
+        self.sh_codebook = gaussians.get("sh_codebook")
+        self.sh_codes = gaussians.get("sh_codes")
+        if "permutation" in gaussians:
+            self.set_permutation(gaussians["permutation"])
 
         self.nb_data = len(self.means)
 
-        self.covars, _ = quat_scale_to_covar_preci(self.quats, self.scales, True)
-        self.colors = torch.cat((self.sh0, self.shN), dim=1)
-        self.sh_degree = int(math.sqrt(self.colors.shape[-2]) - 1)
+        if self.colors is not None:
+            nb_coefficients = self.colors.shape[-2]
+        else:
+            nb_coefficients = 1 + (self.shN if self.shN is not None else self.sh_codebook).shape[-2]
+        self.sh_degree = int(math.sqrt(nb_coefficients) - 1)
 
-        self.world_rank = world_rank
-        self.world_size = world_size
+        # Spatial hierarchy used to cull the gaussians before the view deformation
+        self.octree = Octree(self.means)
 
     """ Renders the view-dependent GSplat """
     def render(self, deformation_camera: GsplatCamera, view_deformer: GsplatViewDeformer,
                view_deformation: GsplatViewDeformation = None):
+        self.page_in(deformation_camera)
+
         # Do the deformation of the gaussian. This handles the interpolation of the deformation
         deformed_means, deformed_covars = self.deform_model(deformation_camera, view_deformation, view_deformer)
 
@@ -53,24 +90,25 @@ class GaussianSplattingRenderer(AbstractRenderer):
         self.render_image(deformation_camera, deformed_means, deformed_covars,
                           'image1_data', 'image1')
 
-    """ Renders the image based on the configuration and parameters defined in the provided model """
+    """ Renders the image based on the configuration and parameters defined in the provided model.
+        The covariances are given as their upper-triangular values [N, 6] """
     def render_image(self, camera, means, covars, image_attr, photo_image_attr):
         viewmats, Ks = self.get_matrices(camera)
 
         # Render the deformed gaussian
         render_colors, render_alphas, meta = rasterization(
             means,  # [N, 3]
-            self.quats,  # [N, 4]
-            self.scales,  # [N, 3]
+            None,  # quats, unused with covars
+            None,  # scales, unused with covars
             self.opacities,  # [N]
-            self.colors,  # [N, 3]
+            self.get_colors(),  # [N, K, 3]
             viewmats,  # [C, 4, 4]
             Ks,  # [C, 3, 3]
             camera.width,
             camera.height,
             render_mode="RGB",
             sh_degree=self.sh_degree,
-            covars=covars,
+            covars=triu_to_covars(covars),  # gsplat takes [N, 3, 3] and keeps their upper-triangular values
             backgrounds=torch.ones(3, device=self.device)
         )
         render_rgbs = render_colors[0, ..., 0:3].cpu().numpy()
@@ -85,24 +123,30 @@ class GaussianSplattingRenderer(AbstractRenderer):
         nb_deformations = len(view_deformer.view_deformations)
         nb_deformations -= 1 if view_deformation else 0
 
-        displacements, jacobians = view_deformer.get_interpolated_values(camera, nb_deformations, self.nb_data)
+        displacements, jacobians = view_deformer.get_interpolated_values(camera, nb_deformations, self.nb_data,
+                                                                         self.resident_indices)
         interpolated_means = self.means + displacements
-        interpolated_covars = jacobians @ self.covars @ jacobians.transpose(1, 2)
+        interpolated_covars = transform_covars(self.covars, jacobians)
 
         if view_deformation:
-            return self.get_view_deform(camera, view_deformation, interpolated_means, interpolated_covars)
+            return self.get_view_deform(camera, view_deformation, interpolated_means, interpolated_covars,
+                                        displacements)
 
         return interpolated_means, interpolated_covars
 
-    """ Get the deformation for a specific viewpoint (View-Deformation) """
+    """ Get the deformation for a specific viewpoint (View-Deformation).
+        Only the gaussians inside the frustum and the 2D mesh bounds are projected, deformed and unprojected """
     def get_view_deform(self, camera: GsplatCamera, view_deformation: GsplatViewDeformation,
-                             interpolated_means, interpolated_covars):
+                             interpolated_means, interpolated_covars, displacements=None):
+        visible = self.cull(camera, view_deformation.get_image_bounds(camera), displacements)
+        visible = visible[view_deformation.is_deformable(self.get_global_indices(visible))]
+
         # Project the means and covariance matrices onto the image plane of the camera
-        cam_means = camera.world_to_cam(interpolated_means)
+        cam_means = camera.world_to_cam(interpolated_means[visible])
         proj_means, depths = camera.proj(cam_means)
 
         # Get the 2D deformation using the deformation tools activated for view_deformation
-        deform_proj_means, jacobians = view_deformation.deform(proj_means)
+        deform_proj_means, jacobians = view_deformation.deform(proj_means, self.get_global_indices(visible))
 
         # Compute the jacobians for the 2D covariance matrix
         jacobians_3d = torch.zeros((jacobians.shape[0], 3, 3), device=self.device)
@@ -111,31 +155,85 @@ class GaussianSplattingRenderer(AbstractRenderer):
 
         # Unproject the means and jacobians
         un_proj_means = camera.un_proj(deform_proj_means, depths)
-        deformed_means, world_jacobians = camera.cam_to_world(un_proj_means, jacobians_3d)
+        visible_means, visible_jacobians = camera.cam_to_world(un_proj_means, jacobians_3d)
+
+        # The culled gaussians keep their interpolated means and covariance matrices
+        deformed_means = interpolated_means.clone()
+        deformed_means[visible] = visible_means
 
         # Get the 3D deformation
-        deformed_covars = world_jacobians @ interpolated_covars @ world_jacobians.transpose(1, 2)
+        deformed_covars = interpolated_covars.clone()
+        deformed_covars[visible] = transform_covars(interpolated_covars[visible], visible_jacobians)
 
+        # Only the deformed gaussians are saved, the deformation of the resident ones is replaced
         if view_deformation.need_update:
-            view_deformation.save_view_deformation(deformed_means - interpolated_means, world_jacobians)
+            visible_displacements = visible_means - interpolated_means[visible]
+            visible_indices = self.get_global_indices(visible)
+            resident_indices = self.resident_indices
+            if self.chunk_store is not None:
+                # The gaussians merged at a coarse level of detail all get the deformation of their merged gaussian
+                counts, visible_indices = self.chunk_store.get_members(visible)
+                visible_displacements = visible_displacements.repeat_interleave(counts, dim=0)
+                visible_jacobians = visible_jacobians.repeat_interleave(counts, dim=0)
+                _, resident_indices = self.chunk_store.get_members()
+            view_deformation.save_view_deformation(visible_displacements, visible_jacobians, visible_indices,
+                                                   resident_indices)
             view_deformation.need_update = False
 
         return deformed_means, deformed_covars
 
-    """ Get the 2D projected means of the actual view-dependent 3DGS model """
+    """ Get the 2D projected means of the actual view-dependent 3DGS model.
+        Only the (resident) gaussians inside the frustum are projected: returns their projected means, depths and
+        global indices """
     def get_points2d(self, view_deformer: GsplatViewDeformer, camera: GsplatCamera):
-        initial_means = self.means.clone()
+        self.page_in(camera)
+        initial_means = self.means
+        displacements = None
         if len(view_deformer.view_deformations) > 0:
             displacements, _ = view_deformer.get_interpolated_values(camera,
                                                                      len(view_deformer.view_deformations) - 1,
-                                                                     self.nb_data)
-            initial_means += displacements
+                                                                     self.nb_data, self.resident_indices)
+            initial_means = initial_means + displacements
 
-        # Project the means and covariance matrices onto the image plane of the camera
-        cam_vertices = camera.world_to_cam(initial_means)  # Camera space
-        proj_vertices = camera.proj(cam_vertices)  # Image space
+        visible = self.cull(camera, (0.0, 0.0, camera.width, camera.height), displacements)
 
-        return proj_vertices
+        # Project the means and covariance matrices onto the image plane of the camera
+        cam_vertices = camera.world_to_cam(initial_means[visible])  # Camera space
+        visible_proj, visible_depths = camera.proj(cam_vertices)  # Image space
+
+        return visible_proj.type(torch.float32), visible_depths, self.get_global_indices(visible)
+
+    """ Page in the chunks needed for the camera view when streaming the scene """
+    def page_in(self, camera: GsplatCamera):
+        if self.chunk_store is None:
+            return
+        resident = self.chunk_store.gather(camera)
+        self.means = resident["means"]
+        self.opacities = resident["opacities"]
+        self.covars = resident["covars"]
+        self.colors = resident["colors"]
+        self.resident_indices = resident["indices"]
+
+    """ Get the (resident) gaussians that may project inside the image-space bounds of the camera """
+    def cull(self, camera: GsplatCamera, bounds, displacements=None):
+        if self.octree is None:
+            # The resident chunks are already culled against the frustum
+            return torch.arange(len(self.means), device=self.device)
+        return self.octree.cull(camera, bounds, displacements)
+
+    """ Map indices of resident gaussians to global indices """
+    def get_global_indices(self, indices):
+        if self.resident_indices is None:
+            return indices
+        return self.resident_indices[indices]
+
+    """ Get the SH coefficients of the gaussians [N, K, 3], decoding the compressed higher-order ones """
+    def get_colors(self):
+        if self.colors is not None:
+            return self.colors
+        if self.sh_storage == "float16":
+            return torch.cat((self.sh0, self.shN.float()), dim=1)
+        return torch.cat((self.sh0, torch.index_select(self.sh_codebook, 0, self.sh_codes)), dim=1)
 
     """ Get the extrinsic and intrinsic matrices of the camera """
     def get_matrices(self, camera: GsplatCamera):
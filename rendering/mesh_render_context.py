@@ -0,0 +1,264 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pyrender
+from OpenGL.GL import (GL_ARRAY_BUFFER, GL_FRAGMENT_SHADER, GL_GEOMETRY_SHADER, GL_R32F, GL_STREAM_DRAW, GL_TEXTURE0,
+                       GL_TEXTURE_BUFFER, GL_VERTEX_SHADER, glActiveTexture, glAttachShader, glBindBuffer,
+                       glBindTexture, glBindVertexArray, glBufferData, glBufferSubData, glCreateProgram,
+                       glDeleteBuffers, glDeleteShader, glDeleteTextures, glGenBuffers, glGenTextures,
+                       glGenVertexArrays, glGetUniformLocation, glLinkProgram, glTexBuffer, glUniform1i, glUseProgram)
+from OpenGL.GL.shaders import ShaderProgram as GLShaderProgram, compileShader
+from pyrender.shader_program import ShaderProgram, ShaderProgramCache
+
+
+# The framebuffers are allocated by steps of FRAMEBUFFER_BUCKET pixels and the FRAMEBUFFER_POOL_SIZE most recently
+# used ones are kept, so that resizing the window does not reallocate them at every event
+FRAMEBUFFER_BUCKET = 128
+FRAMEBUFFER_POOL_SIZE = 4
+
+# Vertex shader replacing pyrender's mesh.vert when the displacements are applied on the GPU
+DISPLACED_MESH_SHADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shaders", "displaced_mesh.vert")
+
+# Texture unit reserved to the displacement buffer: pyrender allocates the units of the material and shadow textures
+# from 0 and the unset samplers also refer to unit 0, which a sampler of another type must not share
+DISPLACEMENT_TEXTURE_UNIT = 15
+
+
+""" Round a resolution up to its framebuffer bucket """
+def get_bucket(width, height):
+    return (-(-int(width) // FRAMEBUFFER_BUCKET) * FRAMEBUFFER_BUCKET,
+            -(-int(height) // FRAMEBUFFER_BUCKET) * FRAMEBUFFER_BUCKET)
+
+
+""" Interleaved vertex data of a primitive, in the layout of its pyrender vertex buffer """
+def get_vertex_data(primitive):
+    attributes = [primitive.positions, primitive.normals, primitive.tangents, primitive.texcoord_0,
+                  primitive.texcoord_1, primitive.color_0]
+    return np.ascontiguousarray(np.hstack([a for a in attributes if a is not None]).astype(np.float32))
+
+
+""" Pyrender renderer keeping a pool of offscreen framebuffers bucketed by resolution.
+    The viewport is rendered in the lower-left corner of its bucket and only this region is read back.
+"""
+class PooledRenderer(pyrender.Renderer):
+    def __init__(self, viewport_width, viewport_height, point_size=1.0):
+        super().__init__(viewport_width, viewport_height, point_size)
+        self.framebuffers = OrderedDict()
+
+    def _configure_main_framebuffer(self):
+        bucket = get_bucket(self.viewport_width, self.viewport_height)
+        if bucket not in self.framebuffers:
+            # Let pyrender allocate the framebuffers at the size of the bucket
+            width, height = self._viewport_width, self._viewport_height
+            self._main_fb = None
+            self._main_fb_dims = bucket
+            self._viewport_width, self._viewport_height = bucket
+            super()._configure_main_framebuffer()
+            self._viewport_width, self._viewport_height = width, height
+
+            self.framebuffers[bucket] = (self._main_fb, self._main_cb, self._main_db,
+                                         self._main_fb_ms, self._main_cb_ms, self._main_db_ms)
+            while len(self.framebuffers) > FRAMEBUFFER_POOL_SIZE:
+                self.delete_framebuffers(*self.framebuffers.popitem(last=False)[1])
+
+        self.framebuffers.move_to_end(bucket)
+        (self._main_fb, self._main_cb, self._main_db,
+         self._main_fb_ms, self._main_cb_ms, self._main_db_ms) = self.framebuffers[bucket]
+        self._main_fb_dims = (self.viewport_width, self.viewport_height)
+
+    def _delete_main_framebuffer(self):
+        for framebuffers in self.framebuffers.values():
+            self.delete_framebuffers(*framebuffers)
+        self.framebuffers.clear()
+        super()._delete_main_framebuffer()
+
+    """ Delete one set of framebuffers of the pool """
+    def delete_framebuffers(self, fb, cb, db, fb_ms, cb_ms, db_ms):
+        self._main_fb, self._main_cb, self._main_db = fb, cb, db
+        self._main_fb_ms, self._main_cb_ms, self._main_db_ms = fb_ms, cb_ms, db_ms
+        super()._delete_main_framebuffer()
+
+
+""" Shader program of the displaced meshes. PyOpenGL validates the programs right after linking, when all the samplers
+    still refer to unit 0: the displacement buffer is moved to its own unit before the validation, otherwise the
+    programs of textured materials fail with samplers of different types on the same unit.
+"""
+class DisplacedShaderProgram(ShaderProgram):
+    def _add_to_context(self):
+        if self._program_id is not None:
+            raise ValueError('Shader program already in context')
+        shader_ids = [compileShader(self._load(self.vertex_shader), GL_VERTEX_SHADER),
+                      compileShader(self._load(self.fragment_shader), GL_FRAGMENT_SHADER)]
+        if self.geometry_shader is not None:
+            shader_ids.append(compileShader(self._load(self.geometry_shader), GL_GEOMETRY_SHADER))
+
+        # Empty VAO bound while linking, as in pyrender
+        if self._vao_id is None:
+            self._vao_id = glGenVertexArrays(1)
+        glBindVertexArray(self._vao_id)
+
+        program = GLShaderProgram(glCreateProgram())
+        for shader_id in shader_ids:
+            glAttachShader(program, shader_id)
+        glLinkProgram(program)
+        program.check_linked()
+
+        glUseProgram(program)
+        glUniform1i(glGetUniformLocation(program, "displacements"), DISPLACEMENT_TEXTURE_UNIT)
+        program.check_validate()
+        glUseProgram(0)
+        for shader_id in shader_ids:
+            glDeleteShader(shader_id)
+
+        glBindVertexArray(0)
+        self._program_id = program
+
+
+""" Shader cache using the displaced mesh vertex shader in place of pyrender's mesh.vert """
+class DisplacedShaderProgramCache(ShaderProgramCache):
+    def get_program(self, vertex_shader, fragment_shader, geometry_shader=None, defines=None):
+        if vertex_shader != "mesh.vert":
+            return super().get_program(vertex_shader, fragment_shader, geometry_shader, defines)
+
+        program = super().get_program(DISPLACED_MESH_SHADER, fragment_shader, geometry_shader,
+                                      dict(defines or {}, DISPLACEMENT_BUFFER=1))
+        # The programs are created by pyrender's cache, only their linking differs
+        program.__class__ = DisplacedShaderProgram
+        return program
+
+
+""" Pooled renderer applying per-vertex displacements in the vertex shader.
+    The displacements of all the vertices [N, 3] are uploaded once per frame in a buffer texture and each primitive
+    reads them from its offset in the concatenated vertices, so the vertex buffers and the scene are never modified.
+"""
+class DisplacedMeshRenderer(PooledRenderer):
+    def __init__(self, viewport_width, viewport_height, point_size=1.0):
+        super().__init__(viewport_width, viewport_height, point_size)
+        self._program_cache = DisplacedShaderProgramCache()
+        self.vertex_offsets = {}
+        self.displacement_buffer = None
+        self.displacement_texture = None
+
+    """ Upload the displacements [N, 3] (float32) of the concatenated vertices, the context must be current """
+    def upload_displacements(self, displacements):
+        if self.displacement_buffer is None:
+            self.displacement_buffer = glGenBuffers(1)
+            self.displacement_texture = glGenTextures(1)
+
+        glBindBuffer(GL_TEXTURE_BUFFER, self.displacement_buffer)
+        glBufferData(GL_TEXTURE_BUFFER, displacements.nbytes, displacements, GL_STREAM_DRAW)
+        glBindTexture(GL_TEXTURE_BUFFER, self.displacement_texture)
+        glTexBuffer(GL_TEXTURE_BUFFER, GL_R32F, self.displacement_buffer)
+        glBindTexture(GL_TEXTURE_BUFFER, 0)
+        glBindBuffer(GL_TEXTURE_BUFFER, 0)
+
+    def _bind_and_draw_primitive(self, primitive, pose, program, flags):
+        if program.vertex_shader == DISPLACED_MESH_SHADER:
+            # The buffer texture is always bound to its own unit, so that its sampler never shares one with a 2D texture
+            if self.displacement_texture is None:
+                self.upload_displacements(np.zeros((1, 3), dtype=np.float32))
+            glActiveTexture(GL_TEXTURE0 + DISPLACEMENT_TEXTURE_UNIT)
+            glBindTexture(GL_TEXTURE_BUFFER, self.displacement_texture)
+            program.set_uniform("displacements", DISPLACEMENT_TEXTURE_UNIT)
+            program.set_uniform("vertex_offset", self.vertex_offsets.get(primitive, -1))
+        super()._bind_and_draw_primitive(primitive, pose, program, flags)
+
+    def delete(self):
+        if self.displacement_buffer is not None:
+            glDeleteTextures([self.displacement_texture])
+            glDeleteBuffers(1, [self.displacement_buffer])
+            self.displacement_buffer = None
+            self.displacement_texture = None
+        super().delete()
+
+
+""" Offscreen renderer keeping a single GL context alive for the lifetime of the mesh renderer.
+    - resizing reuses pooled framebuffers (EGL, pyglet) or pooled software buffers (OSMesa, which has no
+      framebuffer support and would otherwise recreate its context).
+    - the vertex buffers of the primitives are updated in place instead of re-uploading the whole scene.
+    - shader_deformation: the displacements are applied in the vertex shader instead (see DisplacedMeshRenderer).
+"""
+class PersistentOffscreenRenderer(pyrender.OffscreenRenderer):
+    def __init__(self, viewport_width, viewport_height, point_size=1.0, shader_deformation=False):
+        self.software_buffers = OrderedDict()
+        self.vertex_data = {}
+        self.shader_deformation = shader_deformation
+        super().__init__(viewport_width, viewport_height, point_size)
+
+    def _create(self):
+        super()._create()
+        self._renderer.delete()
+        renderer_class = DisplacedMeshRenderer if self.shader_deformation else PooledRenderer
+        self._renderer = renderer_class(self.viewport_width, self.viewport_height, self.point_size)
+
+    """ Change the rendering size without recreating the context """
+    def resize(self, width, height):
+        self.viewport_width = width
+        self.viewport_height = height
+        if self._platform.supports_framebuffers():
+            return
+
+        from OpenGL import arrays
+        bucket = get_bucket(width, height)
+        if bucket not in self.software_buffers:
+            self.software_buffers[bucket] = arrays.GLubyteArray.zeros((bucket[1], bucket[0], 4))
+            while len(self.software_buffers) > FRAMEBUFFER_POOL_SIZE:
+                self.software_buffers.popitem(last=False)
+        self.software_buffers.move_to_end(bucket)
+
+        self._platform._buffer = self.software_buffers[bucket]
+        self._platform.viewport_width = self.viewport_width
+        self._platform.viewport_height = self.viewport_height
+
+    """ Update the positions (and normals, None for the primitives without normals) of primitives, in place in their
+        vertex buffers. The primitives not yet uploaded to the context only get their attributes updated.
+    """
+    def update_primitives(self, primitives, positions, normals=None):
+        self._platform.make_current()
+        for i, primitive in enumerate(primitives):
+            primitive.positions = positions[i]
+            if normals is not None and normals[i] is not None:
+                primitive.normals = normals[i]
+            if not primitive._in_context():
+                self.vertex_data.pop(primitive, None)
+                continue
+
+            vertex_data = self.vertex_data.get(primitive)
+            if vertex_data is None:
+                vertex_data = self.vertex_data[primitive] = get_vertex_data(primitive)
+            else:
+                vertex_data[:, :3] = positions[i]
+                if normals is not None and normals[i] is not None:
+                    vertex_data[:, 3:6] = normals[i]
+
+            glBindBuffer(GL_ARRAY_BUFFER, primitive._buffers[0])
+            glBufferSubData(GL_ARRAY_BUFFER, 0, vertex_data.nbytes, vertex_data)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self._platform.make_uncurrent()
+
+    """ Replace the sources of textures (list of (texture, source)), re-uploading those already in the context """
+    def update_textures(self, textures):
+        self._platform.make_current()
+        for texture, source in textures:
+            in_context = texture._in_context()
+            if in_context:
+                texture.delete()
+            texture.source = source
+            if in_context:
+                texture._add_to_context()
+        self._platform.make_uncurrent()
+
+    """ Set the offset of each primitive (dict) in the concatenated vertices read by the displacement shader """
+    def set_vertex_offsets(self, vertex_offsets):
+        self._renderer.vertex_offsets = vertex_offsets
+
+    """ Upload the displacements [N, 3] (float32) of the concatenated vertices for the displacement shader """
+    def upload_displacements(self, displacements):
+        self._platform.make_current()
+        self._renderer.upload_displacements(displacements)
+        self._platform.make_uncurrent()
+
+    def delete(self):
+        self.vertex_data.clear()
+        super().delete()
@@ -9,24 +9,44 @@ from camera.mesh_camera import MeshCamera
 from deformation.mesh_view_deformation import MeshViewDeformation
 from deformation.mesh_view_deformer import MeshViewDeformer
 from rendering.abstract_renderer import AbstractRenderer
-from utils.mesh_utils import load_scene
-
-
+from rendering.mesh_render_context import PersistentOffscreenRenderer
+from utils.mesh_utils import compute_vertex_normals, load_mesh_assets, load_mesh_proxies, select_mip
+from utils.spatial_utils import Octree, morton_order
+
+
+# Meshes with more faces get a decimated proxy of about PROXY_FACES faces, rendered during the interactions
+PROXY_FACES = 100_000
+
+
+""" Mesh Renderer for View-Dependent Meshes
+    - reorder: sort the vertices along the Morton curve so that the deformation gathers are spatially coherent.
+      The pyrender primitives keep the order of the file.
+    - shader_deformation: upload the displacement field once per frame and apply it in the vertex shader,
+      instead of writing the deformed positions in the vertex buffers.
+    - recompute_normals: recompute the vertex normals of the deformed mesh, for "all" the vertices at each frame or only
+      around the vertices that moved ("changed"). None keeps the normals of the file. Not used with shader_deformation.
+    - proxy_faces: meshes with more faces get decimated proxies with about proxy_faces faces in total, rendered instead
+      of the full mesh while the camera orbits or a handle is dragged (see set_interactive). None disables the proxies.
+    A single GL context is kept alive: the deformed positions are written in place in the vertex buffers of the
+    primitives that moved since the previous frame.
+"""
 class MeshRenderer(AbstractRenderer):
-    def __init__(self, data_path, camera: MeshCamera):
+    def __init__(self, data_path, camera: MeshCamera, reorder=False, shader_deformation=False,
+                 recompute_normals="changed", proxy_faces=PROXY_FACES):
         super().__init__()
         self.device = torch.device("cuda")
+        self.shader_deformation = shader_deformation
+        self.recompute_normals = recompute_normals
 
         self.width = camera.width
         self.height = camera.height
 
-        # Load and normalize the scene with descriptive naming
-        scene = load_scene(data_path)
+        # Load the normalized scene from its cache, with the textures at the level matched to the window
+        meshes, self.textures = load_mesh_assets(data_path, max(self.width, self.height))
 
-        # Convert to pyrender scene
-        self.scene = pyrender.Scene.from_trimesh_scene(scene)
+        self.scene = pyrender.Scene()
         self.scene.bg_color = (255, 255, 255)
-        self.renderer = pyrender.OffscreenRenderer(self.width, self.height)
+        self.renderer = PersistentOffscreenRenderer(self.width, self.height, shader_deformation=shader_deformation)
 
         # Add camera
         self.camera = pyrender.PerspectiveCamera(yfov=camera.f_rad)
@@ -36,31 +56,70 @@ class MeshRenderer(AbstractRenderer):
         # Add the lightning of the scene
         self.add_lightning()
 
-        # Get ordered mesh nodes based on geometry metadata
-        ordered_geom_names = list(scene.geometry.keys())
-        self.mesh_nodes = self.get_ordered_mesh_nodes(ordered_geom_names)
+        # One node per geometry, in the order of the file
+        self.mesh_nodes = [self.scene.add(mesh, name=mesh.name) for mesh in meshes]
 
         # Extract vertices
-        self.vertices_list = []
-        for node in self.mesh_nodes:
-            for prim in node.mesh.primitives:
-                self.vertices_list.append(torch.tensor(prim.positions, dtype=torch.float32, device=self.device))
+        self.primitives = [prim for node in self.mesh_nodes for prim in node.mesh.primitives]
+        self.vertices_list = [torch.tensor(prim.positions, dtype=torch.float32, device=self.device)
+                              for prim in self.primitives]
 
         self.all_vertices = torch.cat(self.vertices_list, dim=0)
         self.nb_data = len(self.all_vertices)
         self.mesh_shapes = [v.shape[0] for v in self.vertices_list]
         print(self.mesh_shapes)
 
+        # Vertex ranges of the primitives, and positions of the last upload (file order)
+        self.primitive_offsets = torch.cumsum(torch.tensor([0] + self.mesh_shapes, device=self.device), dim=0)
+        self.uploaded_vertices = None
+
+        # Host buffer receiving the deformed vertices in a single transfer, the primitives read views of it
+        self.host_vertices = torch.empty((self.nb_data, 3), dtype=torch.float32,
+                                         pin_memory=torch.cuda.is_available())
+        self.host_vertices_list = np.split(self.host_vertices.numpy(), np.cumsum(self.mesh_shapes)[:-1])
+        self.renderer.set_vertex_offsets({prim: offset for prim, offset in
+                                          zip(self.primitives, self.primitive_offsets[:-1].tolist())})
+
+        # Triangles and normals of the concatenated vertices (file order), for the recomputation of the normals
+        self.rest_vertices = self.all_vertices
+        self.faces = torch.cat([self.get_primitive_faces(prim, offset) for prim, offset in
+                                zip(self.primitives, self.primitive_offsets[:-1].tolist())])
+        self.has_normals = [prim.normals is not None for prim in self.primitives]
+        self.vertex_normals = torch.cat([torch.tensor(prim.normals, dtype=torch.float32, device=self.device)
+                                         if prim.normals is not None else torch.zeros_like(vertices)
+                                         for prim, vertices in zip(self.primitives, self.vertices_list)])
+        self.host_normals = torch.empty((self.nb_data, 3), dtype=torch.float32, pin_memory=torch.cuda.is_available())
+        self.host_normals_list = np.split(self.host_normals.numpy(), np.cumsum(self.mesh_shapes)[:-1])
+
+        if reorder:
+            self.set_permutation(morton_order(self.all_vertices))
+            self.all_vertices = self.all_vertices[self.permutation].contiguous()
+
+        # Spatial hierarchy used to cull the vertices before the view deformation
+        self.octree = Octree(self.all_vertices)
+
+        # Decimated proxy meshes, in the same scene but hidden until an interaction starts
+        self.interactive = False
+        self.proxy_primitives = None
+        if proxy_faces is not None and len(self.faces) > proxy_faces:
+            self.build_proxies(data_path, proxy_faces)
+
     """ Renders the view-dependent mesh """
     def render(self, deformation_camera: MeshCamera, view_deformer: MeshViewDeformer,
                view_deformation: MeshViewDeformation = None):
-        deformed_vertices = self.deform_model(deformation_camera, view_deformation, view_deformer)
-        self.update_all_mesh_vertices(deformed_vertices)
+        # The view deformations are saved at full resolution
+        if self.interactive and self.proxy_primitives is not None and not (view_deformation and
+                                                                           view_deformation.need_update):
+            self.update_proxy_vertices(deformation_camera, view_deformation, view_deformer)
+            self.set_camera_pose(self.cam_node, deformation_camera)
+            self.render_image('image1_data', 'image1')
+            return
 
-        # This is time-consuming and could be much better with another mesh rendering library
-        # This is done to update the vertex positions in the gpu
-        self.renderer.delete()
-        self.renderer = pyrender.OffscreenRenderer(self.width, self.height)
+        deformed_vertices = self.deform_model(deformation_camera, view_deformation, view_deformer)
+        if self.shader_deformation:
+            self.update_displacements(deformed_vertices)
+        else:
+            self.update_all_mesh_vertices(deformed_vertices)
 
         self.set_camera_pose(self.cam_node, deformation_camera)
         self.render_image('image1_data', 'image1')
@@ -82,48 +141,175 @@ class MeshRenderer(AbstractRenderer):
         interpolated_vertices = self.all_vertices + displacements
 
         if view_deformation:
-            return self.get_view_deform(camera, view_deformation, interpolated_vertices)
+            return self.get_view_deform(camera, view_deformation, interpolated_vertices, displacements)
 
         return interpolated_vertices
 
-    """ Get the deformation for a specific viewpoint (View-Deformation) """
-    def get_view_deform(self, camera: MeshCamera, view_deformation: MeshViewDeformation, interpolated_vertices):
+    """ Get the deformation for a specific viewpoint (View-Deformation).
+        Only the vertices inside the frustum and the 2D mesh bounds are projected, deformed and unprojected """
+    def get_view_deform(self, camera: MeshCamera, view_deformation: MeshViewDeformation, interpolated_vertices,
+                        displacements=None):
+        visible = self.octree.cull(camera, view_deformation.get_image_bounds(camera), displacements)
+
+        # The culled vertices keep their interpolated positions
+        deformed_vertices = interpolated_vertices.clone()
+        deformed_vertices[visible] = self.view_deform_vertices(camera, view_deformation, interpolated_vertices[visible],
+                                                               visible)
+
+        if view_deformation.need_update:
+            view_deformation.save_view_deformation(deformed_vertices - interpolated_vertices)
+            view_deformation.need_update = False
+
+        return deformed_vertices
+
+    """ Project, deform with the 2D tool and unproject vertices (given with their global indices).
+        The vertices that can not be deformed by the tool are kept as is """
+    def view_deform_vertices(self, camera: MeshCamera, view_deformation: MeshViewDeformation, vertices, indices):
+        deformable = view_deformation.is_deformable(indices)
+
         # Project the means and covariance matrices onto the image plane of the camera
-        cam_vertices = camera.world_to_cam(interpolated_vertices)  # Camera space
+        cam_vertices = camera.world_to_cam(vertices[deformable])  # Camera space
         proj_vertices, depths = camera.proj(cam_vertices)  # Image space
 
-        deform_proj_vertices = view_deformation.deform(proj_vertices)
+        deform_proj_vertices = view_deformation.deform(proj_vertices, indices[deformable])
 
         un_proj_vertices = camera.un_proj(deform_proj_vertices, depths)
 
-        deformed_vertices = camera.cam_to_world(un_proj_vertices, None)
+        deformed_vertices = vertices.clone()
+        deformed_vertices[deformable] = camera.cam_to_world(un_proj_vertices, None)
+        return deformed_vertices
 
-        if view_deformation.need_update:
-            view_deformation.save_view_deformation(deformed_vertices - interpolated_vertices)
-            view_deformation.need_update = False
+    """ Switch between the proxy meshes (while the camera orbits or a handle is dragged) and the full meshes """
+    @override
+    def set_interactive(self, interactive):
+        self.interactive = interactive
+        if self.proxy_primitives is None:
+            return
+        for node in self.mesh_nodes:
+            node.mesh.is_visible = not interactive
+        for node in self.proxy_nodes:
+            node.mesh.is_visible = interactive
+
+    """ Build the decimated proxy of each mesh node with about proxy_faces faces in total, the decimation and the
+        mapping are cached next to the file (see load_mesh_proxies).
+        Each proxy vertex is mapped to the closest point of the full mesh: its displacement is the barycentric
+        interpolation of the displacements of the 3 full resolution vertices of the closest triangle.
+    """
+    def build_proxies(self, data_path, proxy_faces):
+        offsets = self.primitive_offsets[:-1].tolist()
+        primitive_index = {prim: i for i, prim in enumerate(self.primitives)}
+        proxies = load_mesh_proxies(data_path, [prim.positions for prim in self.primitives],
+                                    [self.get_primitive_faces(prim, 0).cpu().numpy() for prim in self.primitives],
+                                    proxy_faces)
+
+        self.proxy_nodes = []
+        self.proxy_primitives = []
+        proxy_vertices, proxy_faces_list, sources, weights = [], [], [], []
+        nb_proxy_vertices = 0
+        for node in self.mesh_nodes:
+            primitives = []
+            for prim in node.mesh.primitives:
+                i = primitive_index[prim]
+                if i not in proxies:
+                    continue
+                vertices, decimated_faces, indices, barycentric_weights = proxies[i]
+
+                # Attributes interpolated from the full resolution primitive
+                attributes = {}
+                for name in ["texcoord_0", "color_0"]:
+                    values = getattr(prim, name)
+                    if values is not None:
+                        attributes[name] = np.sum(barycentric_weights[..., None] * values[indices], axis=1)
+                normals = compute_vertex_normals(torch.tensor(vertices), torch.tensor(decimated_faces)).numpy()
+                primitives.append(pyrender.Primitive(positions=vertices, normals=normals, indices=decimated_faces,
+                                                     material=prim.material, mode=pyrender.GLTF.TRIANGLES,
+                                                     **attributes))
+
+                proxy_vertices.append(vertices)
+                proxy_faces_list.append(decimated_faces + nb_proxy_vertices)
+                sources.append(indices + offsets[i])
+                weights.append(barycentric_weights)
+                nb_proxy_vertices += len(vertices)
+
+            if len(primitives) > 0:
+                proxy_node = pyrender.Node(mesh=pyrender.Mesh(primitives=primitives, is_visible=False),
+                                           matrix=self.scene.get_pose(node))
+                self.scene.add_node(proxy_node)
+                self.proxy_nodes.append(proxy_node)
+                self.proxy_primitives.extend(primitives)
+
+        self.proxy_rest_vertices = torch.tensor(np.concatenate(proxy_vertices), dtype=torch.float32,
+                                                device=self.device)
+        self.proxy_faces = torch.tensor(np.concatenate(proxy_faces_list), dtype=torch.long, device=self.device)
+        self.proxy_weights = torch.tensor(np.concatenate(weights), dtype=torch.float32, device=self.device)
+
+        # Only the full resolution vertices used by the proxies are deformed during the interactions
+        sources = torch.tensor(np.concatenate(sources), dtype=torch.long, device=self.device)
+        self.proxy_sources, self.proxy_source_map = torch.unique(self.from_file_indices(sources),
+                                                                 return_inverse=True)
+
+        proxy_shapes = [len(prim.positions) for prim in self.proxy_primitives]
+        self.proxy_host_vertices = torch.empty((nb_proxy_vertices, 3), dtype=torch.float32,
+                                               pin_memory=torch.cuda.is_available())
+        self.proxy_host_normals = torch.empty((nb_proxy_vertices, 3), dtype=torch.float32,
+                                              pin_memory=torch.cuda.is_available())
+        self.proxy_host_vertices_list = np.split(self.proxy_host_vertices.numpy(), np.cumsum(proxy_shapes)[:-1])
+        self.proxy_host_normals_list = np.split(self.proxy_host_normals.numpy(), np.cumsum(proxy_shapes)[:-1])
+
+    """ Deform the proxy meshes: only the full resolution vertices they are mapped to are interpolated and deformed """
+    def update_proxy_vertices(self, camera: MeshCamera, view_deformation: MeshViewDeformation,
+                              view_deformer: MeshViewDeformer):
+        nb_deformations = len(view_deformer.view_deformations)
+        nb_deformations -= 1 if view_deformation else 0
 
-        return deformed_vertices
+        rest_vertices = self.all_vertices[self.proxy_sources]
+        displacements = view_deformer.get_interpolated_values(camera, nb_deformations, self.nb_data,
+                                                              self.proxy_sources)
+        vertices = rest_vertices + displacements
+        if view_deformation:
+            vertices = self.view_deform_vertices(camera, view_deformation, vertices, self.proxy_sources)
+
+        source_displacements = (vertices - rest_vertices)[self.proxy_source_map]  # [P, 3, 3]
+        proxy_vertices = self.proxy_rest_vertices + torch.sum(self.proxy_weights.unsqueeze(2) * source_displacements,
+                                                              dim=1)
+        self.proxy_host_vertices.copy_(proxy_vertices)
+        self.proxy_host_normals.copy_(compute_vertex_normals(proxy_vertices, self.proxy_faces))
+        self.renderer.update_primitives(self.proxy_primitives, self.proxy_host_vertices_list,
+                                        self.proxy_host_normals_list)
 
     """ Update the rendering size of the renderer """
     @override
     def update_renderer_size(self, camera: MeshCamera):
-        self.renderer.delete()
         self.width = camera.width
         self.height = camera.height
-        self.renderer = pyrender.OffscreenRenderer(self.width, self.height)
-
-    """ Get the 2D projected points of the actual view-dependent mesh """
+        self.renderer.resize(self.width, self.height)
+        self.update_textures(max(self.width, self.height))
+
+    """ Upload the textures whose level matched to the window size changed """
+    def update_textures(self, window_size):
+        changed = []
+        for texture, mips in self.textures:
+            source = mips[select_mip(mips, window_size)]
+            if texture.source.shape[:2] != source.shape[:2]:
+                changed.append((texture, source))
+        if len(changed) > 0:
+            self.renderer.update_textures(changed)
+
+    """ Get the 2D projected points of the actual view-dependent mesh.
+        Only the vertices inside the frustum are projected: returns their projected points, depths and indices """
     def get_points2d(self, view_deformer: MeshViewDeformer, camera: MeshCamera):
         displacements = view_deformer.get_interpolated_values(camera,
                                                                  len(view_deformer.view_deformations) - 1,
                                                                  self.nb_data)
         interpolated_vertices = self.all_vertices + displacements
 
+        visible = self.octree.cull(camera, (0.0, 0.0, camera.width, camera.height), displacements)
+
         # Project the means and covariance matrices onto the image plane of the camera
-        cam_vertices = camera.world_to_cam(interpolated_vertices)  # Camera space
-        proj_vertices, depths = camera.proj(cam_vertices)  # Image space
+        cam_vertices = camera.world_to_cam(interpolated_vertices[visible])  # Camera space
+        visible_proj, visible_depths = camera.proj(cam_vertices)  # Image space
 
-        return proj_vertices, - depths
+        return visible_proj.type(torch.float32), - visible_depths, visible
 
     """ Set the camera pose in the pyrender scene """
     def set_camera_pose(self, camera_node, camera):
@@ -131,39 +317,60 @@ class MeshRenderer(AbstractRenderer):
         self.scene.set_pose(camera_node, pose=updated_pose)
         return updated_pose
 
-    """ update the mesh vertices of the pyrender scene """
+    """ update the mesh vertices of the pyrender scene, only for the primitives that moved """
     def update_all_mesh_vertices(self, deformed_vertices):
-        deformed_vertices_list = torch.split(deformed_vertices, self.mesh_shapes)
-        for i, node in enumerate(self.mesh_nodes):
-            for prim in node.mesh.primitives:
-                prim.positions = deformed_vertices_list[i].cpu().numpy()
-
-    """ Order the meshes of the model during the loading """
-    def get_ordered_mesh_nodes(self, ordered_geom_names):
-        mesh_nodes = []
-        used_nodes = set()
-
-        # Create a map of vertex counts from geometry names
-        geom_vertex_counts = {
-            name: int(name.split('_v')[1].split('_')[0]) for name in ordered_geom_names
-        }
-
-        for geom_name in ordered_geom_names:
-            target_vcount = geom_vertex_counts[geom_name]
-            matched = False
-            for node in self.scene.mesh_nodes:
-                if node in used_nodes:
-                    continue
-                total_verts = sum(len(prim.positions) for prim in node.mesh.primitives)
-                if total_verts == target_vcount:
-                    mesh_nodes.append(node)
-                    used_nodes.add(node)
-                    matched = True
-                    break
-            if not matched:
-                print(
-                    f"⚠️ Warning: Could not match mesh node for geometry '{geom_name}' with vertex count {target_vcount}")
-        return mesh_nodes
+        deformed_vertices = self.to_file_order(deformed_vertices)
+        changed = self.get_changed_primitives(deformed_vertices)
+        if len(changed) == 0:
+            return
+
+        normals = None
+        if self.recompute_normals is not None:
+            self.update_vertex_normals(deformed_vertices)
+            self.host_normals.copy_(self.vertex_normals)
+            normals = [self.host_normals_list[i] if self.has_normals[i] else None for i in changed]
+        self.uploaded_vertices = deformed_vertices
+
+        self.host_vertices.copy_(deformed_vertices)
+        self.renderer.update_primitives([self.primitives[i] for i in changed],
+                                        [self.host_vertices_list[i] for i in changed], normals)
+
+    """ Recompute the vertex normals of the deformed vertices (file order) """
+    def update_vertex_normals(self, deformed_vertices):
+        if self.recompute_normals == "all":
+            self.vertex_normals = compute_vertex_normals(deformed_vertices, self.faces)
+            return
+
+        # Only around the vertices moved since the last upload, the vertices never moved keep the normals of the file
+        previous_vertices = self.uploaded_vertices if self.uploaded_vertices is not None else self.rest_vertices
+        moved = torch.any(deformed_vertices != previous_vertices, dim=1)
+        if torch.any(moved):
+            self.vertex_normals = compute_vertex_normals(deformed_vertices, self.faces, self.vertex_normals, moved)
+
+    """ Upload the displacements of the vertices for the displacement shader, the primitives keep their rest positions """
+    def update_displacements(self, deformed_vertices):
+        self.host_vertices.copy_(self.to_file_order(deformed_vertices - self.all_vertices))
+        self.renderer.upload_displacements(self.host_vertices.numpy())
+
+    """ Get the triangles of a primitive [F, 3] as indices in the concatenated vertices """
+    def get_primitive_faces(self, primitive, offset):
+        if primitive.mode != pyrender.GLTF.TRIANGLES:
+            return torch.empty((0, 3), dtype=torch.long, device=self.device)
+        if primitive.indices is None:
+            faces = np.arange(len(primitive.positions)).reshape(-1, 3)
+        else:
+            faces = primitive.indices
+        return torch.tensor(faces, dtype=torch.long, device=self.device) + offset
+
+    """ Get the indices of the primitives with at least one vertex moved since the last upload """
+    def get_changed_primitives(self, deformed_vertices):
+        if self.uploaded_vertices is None:
+            return list(range(len(self.primitives)))
+
+        moved = torch.any(deformed_vertices != self.uploaded_vertices, dim=1)
+        counts = torch.cat((torch.zeros(1, dtype=torch.long, device=self.device), torch.cumsum(moved, dim=0)))
+        moved_per_primitive = counts[self.primitive_offsets[1:]] - counts[self.primitive_offsets[:-1]]
+        return torch.nonzero(moved_per_primitive).squeeze(1).tolist()
 
     """ Add lightning to the scene """
     def add_lightning(self):
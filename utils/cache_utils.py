@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# Binary cache layout: magic, header size (uint64), json header, then the arrays aligned on ALIGNMENT bytes
+CACHE_MAGIC = b"VDDFCACHE1"
+ALIGNMENT = 64
+
+# Content hash of the source file: its first and last blocks and HASH_SAMPLES evenly spaced blocks
+HASH_BLOCK_SIZE = 1 << 20
+HASH_SAMPLES = 16
+
+
+""" Get the identity of a source file: size, mtime and a content hash of sampled blocks.
+    Sampling keeps the hash cheap on multi-GB files while still catching rewrites that preserve size and mtime.
+"""
+def get_file_key(path):
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        positions = np.linspace(0, max(stat.st_size - HASH_BLOCK_SIZE, 0), HASH_SAMPLES + 2).astype(np.int64)
+        for position in np.unique(positions):
+            file.seek(int(position))
+            digest.update(file.read(HASH_BLOCK_SIZE))
+
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": digest.hexdigest()}
+
+
+""" Path of a cache next to the source file, one per set of loading options """
+def get_cache_path(path, options):
+    options_hash = hashlib.blake2b(json.dumps(options, sort_keys=True).encode(), digest_size=4).hexdigest()
+    return f"{os.path.splitext(path)[0]}.{options_hash}.vdcache"
+
+
+""" Write arrays (dict of name -> array) and json metadata to a memory-mappable binary cache """
+def write_cache(cache_path, key, arrays, metadata=None):
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({"key": key, "arrays": entries, "metadata": metadata or {}}).encode()
+    data_start = -(-(len(CACHE_MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    # Written to a temporary file first so that an interrupted write never leaves a valid-looking cache
+    temporary_path = cache_path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(CACHE_MAGIC)
+        file.write(np.uint64(len(header)).tobytes())
+        file.write(header)
+        for name, array in arrays.items():
+            file.seek(data_start + entries[name]["offset"])
+            file.write(np.ascontiguousarray(array).tobytes())
+        file.truncate(data_start + offset)
+    os.replace(temporary_path, cache_path)
+
+
+""" Read a binary cache written by write_cache.
+    Returns (arrays, metadata) where the arrays are copy-on-write views of the mapped file,
+    or None if the cache is missing or was built from another version of the source file.
+"""
+def read_cache(cache_path, key):
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, "rb") as file:
+        if file.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        header_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(header_size))
+
+    if header["key"] != key:
+        return None
+
+    data_start = -(-(len(CACHE_MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+    mapped = np.memmap(cache_path, dtype=np.uint8, mode="c")
+
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        start = data_start + entry["offset"]
+        arrays[name] = mapped[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+
+    return arrays, header["metadata"]
@@ -0,0 +1,352 @@
+import copy
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from utils.cache_utils import get_file_key, read_cache, write_cache
+from utils.gsplat_utils import PlyReader, get_grid_clusters, get_pruning_mask, merge_clusters, quat_to_rotmat, sigmoid, \
+    MIN_OPACITY
+from utils.spatial_utils import Octree, OUTSIDE
+
+
+# Target number of gaussians per spatial chunk
+CHUNK_SIZE = 1 << 16
+
+# Each level of detail keeps at most a quarter of the gaussians of the previous one, merged on a grid whose cells grow
+# by LOD_CELL_GROWTH until they are few enough. A chunk is rendered at full detail when it covers at least LOD_PIXELS
+# pixels on screen.
+LOD_LEVELS = 4
+LOD_PIXELS = 256.0
+LOD_CELL_GROWTH = 1.25
+
+DEFAULT_MEMORY_BUDGET = 2 << 30
+
+# Arrays stored for each level of detail of a chunk (as "<name>_<lod>"), the indices are the global indices of the
+# gaussians in the .ply file. The coarser levels also store the members of their merged gaussians (see merge_chunk),
+# which are only read from disk when a deformation is saved.
+CHUNK_ARRAYS = ("means", "opacities", "covars", "colors", "indices")
+MEMBER_ARRAYS = ("members", "member_counts")
+
+
+""" Directory of the chunk store next to the .ply file """
+def get_store_dir(data_path):
+    return f"{os.path.splitext(data_path)[0]}.chunks"
+
+
+""" Prepare a batch of raw gaussians read from the .ply file (see prepare_gaussians), on the CPU """
+def prepare_chunk(xyz, opacities, scales, rots, features_dc, features_extra):
+    alphas = sigmoid(opacities[:, 0].astype(np.float32))
+    sigmas = np.exp(scales.astype(np.float32))
+    quats = rots.astype(np.float32)
+    quats /= np.clip(np.linalg.norm(quats, axis=1, keepdims=True), 1e-12, None)
+
+    rotmats = quat_to_rotmat(quats)
+    covars = (rotmats * (sigmas ** 2)[:, None, :]) @ rotmats.transpose(0, 2, 1)
+    rows, columns = np.triu_indices(3)
+
+    sh0 = features_dc.astype(np.float32).transpose(0, 2, 1)
+    sh0 = sh0 / np.clip(sh0.max(axis=-1, keepdims=True), 1.0, None)
+    colors = np.concatenate((sh0, features_extra.astype(np.float32).transpose(0, 2, 1)), axis=1)
+
+    return {"means": xyz.astype(np.float32), "opacities": alphas, "covars": covars[:, rows, columns],
+            "colors": colors}, alphas * np.prod(sigmas, axis=1)
+
+
+""" Merge the gaussians of a chunk (raw arrays of load_ply sorted by decreasing importance, and their global indices)
+    down to at most target gaussians, on the finest grid that is coarse enough (see merge_clusters).
+    The opacities and covariances of the merged gaussians account for all the gaussians of their cell, and each one
+    keeps the global index of the most important gaussian of its cell.
+    Returns the merged gaussians, their global indices, the global indices of their members (grouped by merged
+    gaussian) and the number of members of each merged gaussian.
+"""
+def merge_chunk(gaussians, indices, target):
+    xyz = gaussians[0]
+    extent = max(float(np.max(xyz.max(axis=0) - xyz.min(axis=0))), 1e-12)
+    cell_size = extent / max(math.sqrt(target), 1.0)
+    clusters = get_grid_clusters(xyz, cell_size)
+    while clusters.max() + 1 > target:
+        cell_size *= LOD_CELL_GROWTH
+        clusters = get_grid_clusters(xyz, cell_size)
+
+    # The first gaussian of each cluster is the most important one
+    _, first, counts = np.unique(clusters, return_index=True, return_counts=True)
+    members = indices[np.argsort(clusters, kind="stable")]
+    return merge_clusters(gaussians, clusters), indices[first], members, counts.astype(np.int32)
+
+
+""" Split the gaussians of a .ply file into spatial chunks stored on disk, without loading the whole scene.
+    - the .ply file is read by rows (see PlyReader), in batches to compute the bounding box and the chunk of each
+      gaussian, then chunk by chunk. Compressed files are decoded for these rows only.
+    - each level of detail of a chunk merges its gaussians (see merge_chunk) and is stored separately, so that only
+      this level has to be paged in. The members of the merged gaussians are stored alongside, but not paged in.
+    - each chunk is written as a binary cache (see cache_utils), the index.json lists their bounding boxes.
+"""
+def build_chunk_store(data_path, store_dir, key, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None,
+                      chunk_size=CHUNK_SIZE, batch_size=1 << 20):
+    reader = PlyReader(data_path)
+    nb_data = reader.nb_data
+
+    min_coords = np.full(3, np.inf, dtype=np.float32)
+    max_coords = np.full(3, -np.inf, dtype=np.float32)
+    for start in range(0, nb_data, batch_size):
+        batch = reader.read_positions(np.arange(start, min(start + batch_size, nb_data)))
+        min_coords = np.minimum(min_coords, batch.min(axis=0))
+        max_coords = np.maximum(max_coords, batch.max(axis=0))
+
+    # Regular grid with around chunk_size gaussians per occupied cell
+    resolution = max(int(math.ceil((nb_data / chunk_size) ** (1.0 / 3.0))), 1)
+    extent = np.clip(max_coords - min_coords, 1e-12, None)
+    cells = np.empty(nb_data, dtype=np.int64)
+    for start in range(0, nb_data, batch_size):
+        batch = reader.read_positions(np.arange(start, min(start + batch_size, nb_data)))
+        grid = np.clip(((batch - min_coords) / extent * resolution).astype(np.int64), 0, resolution - 1)
+        cells[start:start + batch_size] = (grid[:, 0] * resolution + grid[:, 1]) * resolution + grid[:, 2]
+
+    order = np.argsort(cells, kind="stable")
+    _, starts, counts = np.unique(cells[order], return_index=True, return_counts=True)
+    del cells
+
+    os.makedirs(store_dir, exist_ok=True)
+    chunks = []
+    for start, count in zip(starts, counts):
+        # Sorted so that the memory-mapped file is read forward
+        indices = np.sort(order[start:start + count])
+        gaussians = reader.read(indices)
+        arrays, importance = prepare_chunk(*gaussians)
+
+        kept = np.nonzero(get_pruning_mask(gaussians, min_opacity, min_scale, max_scale))[0]
+        if len(kept) == 0:
+            continue
+        kept = kept[np.argsort(-importance[kept], kind="stable")]
+        gaussians = tuple(array[kept] for array in gaussians)
+        indices = indices[kept].astype(np.int64)
+
+        levels = [(arrays, indices)]
+        lod_arrays = {}
+        for lod in range(1, LOD_LEVELS):
+            merged, merged_indices, members, member_counts = merge_chunk(gaussians, indices,
+                                                                         int(math.ceil(len(kept) / 4 ** lod)))
+            levels.append((prepare_chunk(*merged)[0], merged_indices))
+            lod_arrays.update({f"members_{lod}": members, f"member_counts_{lod}": member_counts})
+
+        for lod, (level_arrays, level_indices) in enumerate(levels):
+            if lod == 0:
+                level_arrays = {name: array[kept] for name, array in level_arrays.items()}
+            level_arrays["indices"] = level_indices
+            lod_arrays.update({f"{name}_{lod}": level_arrays[name] for name in CHUNK_ARRAYS})
+
+        file_name = f"chunk_{len(chunks):06d}.vdcache"
+        write_cache(os.path.join(store_dir, file_name), key, lod_arrays)
+        chunks.append({"file": file_name, "counts": [len(level_indices) for _, level_indices in levels],
+                       "min": lod_arrays["means_0"].min(axis=0).tolist(),
+                       "max": lod_arrays["means_0"].max(axis=0).tolist()})
+
+    index = {"key": key, "nb_data": nb_data, "sh_degree": reader.sh_degree, "chunks": chunks}
+    temporary_path = os.path.join(store_dir, "index.json.tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(index, file)
+    os.replace(temporary_path, os.path.join(store_dir, "index.json"))
+
+
+# Version of the layout of the chunks, the stores of older versions are rebuilt
+STORE_VERSION = 2
+
+
+""" Open the chunk store of a .ply file, building it if it is missing or out of date """
+def open_chunk_store(data_path, device, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None,
+                     memory_budget=DEFAULT_MEMORY_BUDGET):
+    store_dir = get_store_dir(data_path)
+    key = dict(get_file_key(data_path), min_opacity=min_opacity, min_scale=min_scale, max_scale=max_scale,
+               chunk_size=CHUNK_SIZE, lod_levels=LOD_LEVELS, version=STORE_VERSION)
+
+    index_path = os.path.join(store_dir, "index.json")
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path) as file:
+            index = json.load(file)
+    if index is None or index["key"] != key:
+        build_chunk_store(data_path, store_dir, key, min_opacity, min_scale, max_scale)
+
+    return GaussianChunkStore(store_dir, device, memory_budget)
+
+
+""" Out-of-core store of the gaussians of a scene split into spatial chunks (see build_chunk_store).
+    - only the chunks intersecting the view frustum are paged in, at a level of detail chosen from their size on
+      screen, and kept in an LRU cache bounded by memory_budget bytes. The concatenated copy of the visible chunks
+      handed to the renderer counts in the budget.
+    - the chunks visible from the camera extrapolated along its path are prefetched by background threads.
+    - the gathered gaussians carry their global indices, so the view deformations still apply per global index. A
+      merged gaussian carries the index of its most important member, its saved deformation goes to all its members
+      (see get_members).
+"""
+class GaussianChunkStore:
+    def __init__(self, store_dir, device, memory_budget=DEFAULT_MEMORY_BUDGET, nb_workers=2):
+        with open(os.path.join(store_dir, "index.json")) as file:
+            index = json.load(file)
+
+        self.store_dir = store_dir
+        self.device = device
+        self.memory_budget = memory_budget
+        self.key = index["key"]
+        self.nb_data = index["nb_data"]
+        self.sh_degree = index["sh_degree"]
+        self.chunks = index["chunks"]
+
+        mins = np.array([chunk["min"] for chunk in self.chunks], dtype=np.float32).reshape(-1, 3)
+        maxs = np.array([chunk["max"] for chunk in self.chunks], dtype=np.float32).reshape(-1, 3)
+        self.centers = (mins + maxs) / 2.0
+        self.sizes = np.max(maxs - mins, axis=1)
+        self.mins = torch.tensor(mins, device=device)
+        self.maxs = torch.tensor(maxs, device=device)
+
+        # LRU cache of the resident chunks: (chunk, lod) -> tensors
+        self.resident = OrderedDict()
+        self.resident_bytes = 0
+        self.protected = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=nb_workers)
+
+        self.gathered_keys = None
+        self.gathered = None
+        self.gathered_bytes = 0
+        self.previous_position = None
+
+        # Gathered tensors when no chunk is visible
+        nb_coefficients = (self.sh_degree + 1) ** 2
+        self.empty = {"means": torch.empty((0, 3), device=device), "opacities": torch.empty((0,), device=device),
+                      "covars": torch.empty((0, 6), device=device),
+                      "colors": torch.empty((0, nb_coefficients, 3), device=device),
+                      "indices": torch.empty((0,), dtype=torch.int64, device=device)}
+
+    """ Get the indices of the chunks intersecting the view frustum """
+    def get_visible_chunks(self, camera):
+        if len(self.chunks) == 0:
+            return []
+        state = Octree.classify(camera, (0.0, 0.0, camera.width, camera.height), self.mins, self.maxs)
+        return torch.nonzero(state != OUTSIDE).squeeze(1).tolist()
+
+    """ Get the level of detail of each chunk from its size on screen """
+    def get_lods(self, camera, chunk_ids):
+        distances = np.linalg.norm(self.centers[chunk_ids] - camera.eye, axis=1)
+        pixels = camera.fx * self.sizes[chunk_ids] / np.maximum(distances, camera.z_near)
+        lods = np.ceil(np.log2(LOD_PIXELS / np.maximum(pixels, 1e-6)) / 2.0)
+        return np.clip(lods, 0, LOD_LEVELS - 1).astype(np.int64).tolist()
+
+    """ Get the (chunk, lod) keys needed to render the camera view """
+    def get_keys(self, camera):
+        chunk_ids = self.get_visible_chunks(camera)
+        return list(zip(chunk_ids, self.get_lods(camera, chunk_ids)))
+
+    """ Read a chunk at a level of detail and copy it to the device """
+    def read_chunk(self, key):
+        chunk_id, lod = key
+        arrays, _ = read_cache(os.path.join(self.store_dir, self.chunks[chunk_id]["file"]), self.key)
+        return {name: torch.from_numpy(np.ascontiguousarray(arrays[f"{name}_{lod}"])).to(self.device)
+                for name in CHUNK_ARRAYS}
+
+    """ Add a chunk to the LRU cache and evict the least recently used ones above the memory budget """
+    def insert(self, key, tensors):
+        with self.lock:
+            self.pending.pop(key, None)
+            if key in self.resident:
+                return self.resident[key]
+            self.resident[key] = tensors
+            self.resident_bytes += sum(tensor.nbytes for tensor in tensors.values())
+            self.evict({key})
+            return tensors
+
+    """ Evict the least recently used chunks, except the protected ones and keep, until the resident chunks and the
+        gathered copy fit in the memory budget. The lock must be held """
+    def evict(self, keep=(), extra_bytes=0):
+        for old_key in list(self.resident.keys()):
+            if self.resident_bytes + self.gathered_bytes + extra_bytes <= self.memory_budget:
+                break
+            if old_key in self.protected or old_key in keep:
+                continue
+            old_tensors = self.resident.pop(old_key)
+            self.resident_bytes -= sum(tensor.nbytes for tensor in old_tensors.values())
+
+    """ Get a chunk, waiting for its prefetch or reading it if it is not resident """
+    def load(self, key):
+        with self.lock:
+            if key in self.resident:
+                self.resident.move_to_end(key)
+                return self.resident[key]
+            future = self.pending.get(key)
+
+        if future is not None:
+            return future.result()
+        return self.insert(key, self.read_chunk(key))
+
+    """ Read chunks in the background """
+    def prefetch(self, keys):
+        with self.lock:
+            for key in keys:
+                if key not in self.resident and key not in self.pending:
+                    self.pending[key] = self.executor.submit(lambda k=key: self.insert(k, self.read_chunk(k)))
+
+    """ Get the gaussians of the visible chunks, concatenated, and prefetch the chunks further along the camera path """
+    def gather(self, camera):
+        keys = self.get_keys(camera)
+        with self.lock:
+            self.protected = set(keys)
+
+        if keys != self.gathered_keys:
+            # The previous copy is released first, and room is made for the new one among the cached chunks
+            self.gathered = None
+            self.gathered_bytes = 0
+            tensors = [self.load(key) for key in keys]
+            if len(tensors) == 0:
+                self.gathered = self.empty
+            elif len(tensors) == 1:
+                self.gathered = tensors[0]
+            else:
+                nb_bytes = sum(tensor.nbytes for chunk in tensors for tensor in chunk.values())
+                with self.lock:
+                    self.evict(extra_bytes=nb_bytes)
+                self.gathered = {name: torch.cat([chunk[name] for chunk in tensors]) for name in CHUNK_ARRAYS}
+                self.gathered_bytes = nb_bytes
+            self.gathered_keys = keys
+
+        # Extrapolate the orbit of the camera by one step
+        position = (camera.azimuth, camera.polar)
+        if self.previous_position is not None and position != self.previous_position:
+            predicted = copy.deepcopy(camera)
+            predicted.update_position(2 * position[0] - self.previous_position[0],
+                                      2 * position[1] - self.previous_position[1])
+            self.prefetch([key for key in self.get_keys(predicted) if key not in self.protected])
+        self.previous_position = position
+
+        return self.gathered
+
+    """ Get the gaussians merged into gathered gaussians (positions in the gathered tensors, all of them if None), read
+        from the memory-mapped chunks. The gaussians of full-detail chunks are their only member.
+        Returns the number of members of each gaussian and the global indices of the members, grouped by gaussian """
+    def get_members(self, positions=None):
+        counts = []
+        members = []
+        for chunk_id, lod in self.gathered_keys or []:
+            arrays, _ = read_cache(os.path.join(self.store_dir, self.chunks[chunk_id]["file"]), self.key)
+            if lod == 0:
+                members.append(arrays["indices_0"])
+                counts.append(np.ones(len(arrays["indices_0"]), dtype=np.int32))
+            else:
+                members.append(arrays[f"members_{lod}"])
+                counts.append(arrays[f"member_counts_{lod}"])
+        counts = torch.from_numpy(np.concatenate(counts) if counts else np.zeros(0, np.int32)).long().to(self.device)
+        members = torch.from_numpy(np.concatenate(members) if members else np.zeros(0, np.int64)).to(self.device)
+        if positions is None:
+            return counts, members
+
+        # Position of the first member of each gaussian, shifted to the selected members
+        starts = torch.cumsum(counts, 0) - counts
+        counts = counts[positions]
+        offsets = torch.repeat_interleave(starts[positions] - (torch.cumsum(counts, 0) - counts), counts)
+        return counts, members[offsets + torch.arange(len(offsets), device=self.device)]
@@ -1,13 +1,231 @@
 import math
+import os
 
 import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
 from plyfile import PlyData
 import torch
-from gsplat import rasterization
+from gsplat import rasterization, quat_scale_to_covar_preci
 from PIL import Image
 
-""" Function to load the Gsplat model from the .ply file """
+from utils.cache_utils import get_cache_path, get_file_key, read_cache, write_cache
+from utils.spatial_utils import morton_order
+
+# Numpy types of the .ply scalar properties
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+
+
+""" Read the header of a .ply file.
+    Returns the format, the elements as (name, count, [(property, type)]) and the size of the header.
+    The type of list properties is None.
+"""
+def read_ply_header(path):
+    with open(path, "rb") as file:
+        if file.readline().strip() != b"ply":
+            raise ValueError(f"Not a .ply file: {path}")
+
+        ply_format = None
+        elements = []
+        while True:
+            line = file.readline()
+            if not line:
+                raise ValueError(f"Invalid .ply header: {path}")
+
+            words = line.decode("ascii").split()
+            if not words:
+                continue
+            if words[0] == "format":
+                ply_format = words[1]
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property":
+                elements[-1][2].append((words[-1], None if words[1] == "list" else words[1]))
+            elif words[0] == "end_header":
+                return ply_format, elements, file.tell()
+
+
+# Compressed splat .ply files: 256 gaussians per chunk and SH_C0 to convert the colors to the SH band 0
+COMPRESSED_CHUNK_SIZE = 256
+SH_C0 = 0.28209479177387814
+
+
+""" Memory-map the elements of a binary little-endian .ply file as structured arrays (dict of name -> array).
+    Returns None when the file can not be mapped (other encodings or list properties).
+"""
+def map_ply_elements(path):
+    ply_format, elements, offset = read_ply_header(path)
+    if ply_format != "binary_little_endian":
+        return None
+
+    mapped = {}
+    for name, count, properties in elements:
+        if any(property_type is None for _, property_type in properties):
+            return None
+
+        dtype = np.dtype([(property_name, "<" + PLY_TYPES[property_type])
+                          for property_name, property_type in properties])
+        mapped[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+        offset += count * dtype.itemsize
+
+    return mapped if "vertex" in mapped else None
+
+
+""" Get a group of properties of the mapped vertices as a float32 [N, len(names)] array.
+    When the properties are consecutive float32 it is a strided view of the file, otherwise a single copy.
+"""
+def get_ply_fields(vertices, names):
+    fields = vertices.dtype.fields
+    offsets = [fields[name][1] for name in names]
+    consecutive = offsets == list(range(offsets[0], offsets[0] + 4 * len(names), 4))
+
+    if consecutive and all(fields[name][0] == np.float32 for name in names):
+        return np.ndarray((len(vertices), len(names)), dtype="<f4", buffer=vertices, offset=offsets[0],
+                          strides=(vertices.dtype.itemsize, 4))
+
+    return structured_to_unstructured(vertices[names], dtype=np.float32)
+
+
+""" Sort the names of the properties starting with prefix by their index """
+def get_sorted_names(names, prefix):
+    return sorted([name for name in names if name.startswith(prefix)], key=lambda x: int(x.split('_')[-1]))
+
+
+""" Unpack normalized 11-10-11 bits triplets """
+def unpack_111011(values):
+    return np.stack([((values >> 21) & 0x7FF) / 2047.0,
+                     ((values >> 11) & 0x3FF) / 1023.0,
+                     (values & 0x7FF) / 2047.0], axis=1).astype(np.float32)
+
+
+""" Unpack normalized 8-8-8-8 bits quadruplets """
+def unpack_8888(values):
+    return np.stack([(values >> shift) & 0xFF for shift in (24, 16, 8, 0)], axis=1).astype(np.float32) / 255.0
+
+
+""" Unpack the 2-10-10-10 bits rotations: index of the largest component, then the three others """
+def unpack_rotations(values):
+    smallest = np.stack([(values >> 20) & 0x3FF, (values >> 10) & 0x3FF, values & 0x3FF], axis=1)
+    smallest = (smallest.astype(np.float32) / 1023.0 - 0.5) * np.float32(np.sqrt(2.0))
+    largest = (values >> 30).astype(np.int64)
+
+    rots = np.empty((len(values), 4), dtype=np.float32)
+    rows = np.arange(len(values))
+    rots[rows, largest] = np.sqrt(np.clip(1.0 - np.sum(smallest ** 2, axis=1), 0.0, None))
+    others = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])[largest]
+    rots[rows[:, np.newaxis], others] = smallest
+
+    return rots
+
+
+""" Decode the positions [len(rows), 3] of rows (index array) of a chunk-quantized compressed splat .ply file """
+def decode_compressed_positions(elements, rows):
+    table = elements["chunk"][rows // COMPRESSED_CHUNK_SIZE]
+    position_min = structured_to_unstructured(table[["min_x", "min_y", "min_z"]], dtype=np.float32)
+    position_max = structured_to_unstructured(table[["max_x", "max_y", "max_z"]], dtype=np.float32)
+    packed = elements["vertex"]["packed_position"][rows]
+    return position_min + unpack_111011(packed) * (position_max - position_min)
+
+
+""" Decode rows (index array) of a chunk-quantized compressed splat .ply file (elements chunk, vertex with packed_*
+    words and optional sh) to the same arrays as load_ply """
+def decode_compressed_rows(elements, rows):
+    chunks, sh = elements["chunk"], elements.get("sh")
+    table = chunks[rows // COMPRESSED_CHUNK_SIZE]
+    batch = elements["vertex"][rows]
+
+    def get_range(prefix, names):
+        minimum = structured_to_unstructured(table[[f"min_{prefix}{name}" for name in names]], dtype=np.float32)
+        maximum = structured_to_unstructured(table[[f"max_{prefix}{name}" for name in names]], dtype=np.float32)
+        return minimum, maximum - minimum
+
+    position_min, position_range = get_range("", "xyz")
+    scale_min, scale_range = get_range("scale_", "xyz")
+    xyz = position_min + unpack_111011(batch["packed_position"]) * position_range
+    scales = scale_min + unpack_111011(batch["packed_scale"]) * scale_range
+    rots = unpack_rotations(batch["packed_rotation"])
+
+    # The color ranges are optional, colors are stored in [0, 1] without them
+    colors = unpack_8888(batch["packed_color"])
+    if "min_r" in chunks.dtype.names:
+        color_min, color_range = get_range("", "rgb")
+        rgb = color_min + colors[:, :3] * color_range
+    else:
+        rgb = colors[:, :3]
+    features_dc = ((rgb - 0.5) / SH_C0)[:, :, np.newaxis].astype(np.float32)
+    alphas = np.clip(colors[:, 3], 1e-6, 1.0 - 1e-6)
+    opacities = (-np.log(1.0 / alphas - 1.0))[:, np.newaxis].astype(np.float32)
+
+    # 8 bits SH coefficients in [-4, 4]
+    sh_names = get_sorted_names(sh.dtype.names, "f_rest_") if sh is not None else []
+    if sh_names:
+        quantized = structured_to_unstructured(sh[rows][sh_names], dtype=np.float32)
+        normalized = np.where(quantized == 0, 0.0, np.where(quantized == 255, 1.0, (quantized + 0.5) / 256.0))
+        features_extra = ((normalized - 0.5) * 8.0).astype(np.float32)
+    else:
+        features_extra = np.empty((len(rows), 0), dtype=np.float32)
+
+    return xyz, opacities, scales, rots, features_dc, features_extra.reshape((len(rows), 3, -1))
+
+
+""" Load a chunk-quantized compressed splat .ply file, decoded in vectorized batches (see decode_compressed_rows) """
+def load_compressed_ply(elements, batch_size=1 << 20):
+    nb_vertices = len(elements["vertex"])
+    sh = elements.get("sh")
+    nb_extra = len(get_sorted_names(sh.dtype.names, "f_rest_")) // 3 if sh is not None else 0
+
+    gaussians = tuple(np.empty((nb_vertices,) + shape, dtype=np.float32)
+                      for shape in [(3,), (1,), (3,), (4,), (3, 1), (3, nb_extra)])
+    for start in range(0, nb_vertices, batch_size):
+        end = min(start + batch_size, nb_vertices)
+        for array, values in zip(gaussians, decode_compressed_rows(elements, np.arange(start, end))):
+            array[start:end] = values
+
+    return gaussians
+
+
+""" Function to load the Gsplat model from the .ply file.
+    - binary little-endian files are memory-mapped and sliced into float32 views.
+    - compressed splat files are decoded in vectorized batches.
+    - the other encodings use plyfile.
+"""
 def load_ply(path):
+    elements = map_ply_elements(path)
+    if elements is None:
+        return load_ply_plyfile(path)
+    if "chunk" in elements and "packed_position" in elements["vertex"].dtype.names:
+        return load_compressed_ply(elements)
+
+    vertices = elements["vertex"]
+    names = vertices.dtype.names
+    nb_vertices = len(vertices)
+
+    xyz = get_ply_fields(vertices, ["x", "y", "z"])
+    opacities = get_ply_fields(vertices, ["opacity"])
+    features_dc = get_ply_fields(vertices, ["f_dc_0", "f_dc_1", "f_dc_2"])[..., np.newaxis]
+
+    extra_f_names = get_sorted_names(names, "f_rest_")
+    num_coeffs_per_channel = len(extra_f_names) // 3 + 1
+    sh_degree = int(np.sqrt(num_coeffs_per_channel) - 1)
+    assert len(extra_f_names) == 3 * ((sh_degree + 1) ** 2 - 1), "Invalid SH data length."
+
+    if extra_f_names:
+        features_extra = get_ply_fields(vertices, extra_f_names).reshape((nb_vertices, 3, -1))
+    else:
+        features_extra = np.zeros((nb_vertices, 3, 0), dtype=np.float32)
+
+    scales = get_ply_fields(vertices, get_sorted_names(names, "scale_"))
+    rots = get_ply_fields(vertices, get_sorted_names(names, "rot"))
+
+    return xyz, opacities, scales, rots, features_dc, features_extra
+
+
+""" Function to load the Gsplat model from the .ply file with plyfile (ascii and big-endian files) """
+def load_ply_plyfile(path):
     plydata = PlyData.read(path)
 
     xyz = np.stack((np.asarray(plydata.elements[0]["x"]),
@@ -47,20 +265,359 @@ def load_ply(path):
 
     return xyz, opacities, scales, rots, features_dc, features_extra
 
-def render_gsplat_image(data_path, device, image_path):
-    # Do the rendering of the 3DGS
-    xyz, opacities, scales, rots, features_dc, features_extra = load_ply(data_path)
+""" Reader of the gaussians of a .ply file by rows, without decoding the whole file.
+    The binary little-endian files are memory-mapped (see load_ply) and the compressed splat files are decoded for the
+    rows read only. The files read with plyfile (ascii, big-endian) are loaded entirely.
+"""
+class PlyReader:
+    def __init__(self, path):
+        elements = map_ply_elements(path)
+        self.elements = None
+        self.gaussians = None
+        if elements is not None and "chunk" in elements and "packed_position" in elements["vertex"].dtype.names:
+            self.elements = elements
+            self.nb_data = len(elements["vertex"])
+            sh = elements.get("sh")
+            nb_extra = len(get_sorted_names(sh.dtype.names, "f_rest_")) // 3 if sh is not None else 0
+        else:
+            self.gaussians = load_ply(path)
+            self.nb_data = len(self.gaussians[0])
+            nb_extra = self.gaussians[5].shape[-1]
+        self.sh_degree = int(math.sqrt(1 + nb_extra) - 1)
+
+    """ Read the positions [len(rows), 3] (float32) of rows (index array) """
+    def read_positions(self, rows):
+        if self.elements is not None:
+            return decode_compressed_positions(self.elements, rows)
+        return np.asarray(self.gaussians[0][rows], dtype=np.float32)
+
+    """ Read rows (index array) as the arrays of load_ply """
+    def read(self, rows):
+        if self.elements is not None:
+            return decode_compressed_rows(self.elements, rows)
+        return tuple(array[rows] for array in self.gaussians)
+
+
+# gsplat skips the fragments with an alpha lower than 1/255, so these gaussians never contribute to a pixel
+MIN_OPACITY = 1.0 / 255.0
+
+# Number of coarser level-of-detail tiers and grid resolution (along the largest axis) of the first one
+LOD_TIERS = 3
+LOD_RESOLUTION = 512
+
+
+""" Sigmoid and its inverse for the opacities stored in the .ply files """
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def logit(x):
+    return np.log(x / (1.0 - x))
+
+
+""" Convert normalized quaternions (w, x, y, z) to rotation matrices """
+def quat_to_rotmat(quats):
+    w, x, y, z = quats[:, 0], quats[:, 1], quats[:, 2], quats[:, 3]
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=-1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=-1),
+    ], axis=-2)
+
+
+""" Convert rotation matrices to quaternions (w, x, y, z), choosing the best conditioned candidate per matrix """
+def rotmat_to_quat(rotmats):
+    m00, m01, m02 = rotmats[:, 0, 0], rotmats[:, 0, 1], rotmats[:, 0, 2]
+    m10, m11, m12 = rotmats[:, 1, 0], rotmats[:, 1, 1], rotmats[:, 1, 2]
+    m20, m21, m22 = rotmats[:, 2, 0], rotmats[:, 2, 1], rotmats[:, 2, 2]
+
+    q_abs = np.sqrt(np.clip(np.stack([1 + m00 + m11 + m22,
+                                      1 + m00 - m11 - m22,
+                                      1 - m00 + m11 - m22,
+                                      1 - m00 - m11 + m22], axis=-1), 0.0, None))
+    candidates = np.stack([
+        np.stack([q_abs[:, 0] ** 2, m21 - m12, m02 - m20, m10 - m01], axis=-1),
+        np.stack([m21 - m12, q_abs[:, 1] ** 2, m10 + m01, m02 + m20], axis=-1),
+        np.stack([m02 - m20, m10 + m01, q_abs[:, 2] ** 2, m12 + m21], axis=-1),
+        np.stack([m10 - m01, m20 + m02, m21 + m12, q_abs[:, 3] ** 2], axis=-1),
+    ], axis=-2) / (2.0 * np.maximum(q_abs, 0.1))[:, :, np.newaxis]
+
+    return candidates[np.arange(len(rotmats)), np.argmax(q_abs, axis=-1)]
+
+
+""" Mask of the gaussians that are neither too transparent, too small nor too large (scales thresholds after exp) """
+def get_pruning_mask(gaussians, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None):
+    xyz, opacities, scales, rots, features_dc, features_extra = gaussians
+
+    keep = sigmoid(opacities[:, 0]) >= min_opacity
+    max_scales = np.exp(scales.max(axis=1))
+    if min_scale is not None:
+        keep &= max_scales >= min_scale
+    if max_scale is not None:
+        keep &= max_scales <= max_scale
+
+    return keep
+
+
+""" Remove the gaussians that are too transparent, too small or too large (see get_pruning_mask) """
+def prune_gaussians(gaussians, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None):
+    keep = get_pruning_mask(gaussians, min_opacity, min_scale, max_scale)
+    return tuple(array[keep] for array in gaussians)
+
+
+""" Cluster the gaussians by the cell of a regular grid containing their mean.
+    Returns the cluster of each gaussian [N], numbered from 0 by increasing cell.
+"""
+def get_grid_clusters(xyz, cell_size):
+    # One int64 key per occupied cell (21 bits per axis)
+    cells = np.floor((xyz - xyz.min(axis=0)) / cell_size).astype(np.int64)
+    keys = (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+    _, clusters = np.unique(keys, return_inverse=True)
+    return clusters.reshape(-1)
+
+
+""" Merge the gaussians falling in the same cell of a regular grid (see merge_clusters) """
+def merge_gaussians(gaussians, cell_size):
+    return merge_clusters(gaussians, get_grid_clusters(gaussians[0], cell_size))
+
+
+""" Merge the gaussians of each cluster (numbered from 0, see get_grid_clusters) into one gaussian.
+    - means and covariances are merged by moment matching, weighted by opacity times volume.
+    - the merged opacity is the opacity of the stacked gaussians, the SH coefficients are averaged.
+"""
+def merge_clusters(gaussians, clusters):
+    xyz, opacities, scales, rots, features_dc, features_extra = gaussians
+
+    order = np.argsort(clusters, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(clusters[order]) != 0])
+
+    def cluster_sum(values):
+        return np.add.reduceat(values[order], starts, axis=0)
+
+    alphas = sigmoid(opacities[:, 0])
+    sigmas = np.exp(scales)
+    rotmats = quat_to_rotmat(rots / np.linalg.norm(rots, axis=1, keepdims=True))
+    covars = (rotmats * (sigmas ** 2)[:, np.newaxis, :]) @ rotmats.transpose(0, 2, 1)
+
+    weights = alphas * np.prod(sigmas, axis=1) + 1e-12
+    total = cluster_sum(weights)
+
+    means = cluster_sum(weights[:, np.newaxis] * xyz) / total[:, np.newaxis]
+    diff = xyz - means[clusters]
+    second_moments = covars + diff[:, :, np.newaxis] * diff[:, np.newaxis, :]
+    merged_covars = cluster_sum(weights[:, np.newaxis, np.newaxis] * second_moments) / total[:, np.newaxis, np.newaxis]
+
+    # Back to the scale/rotation parametrization, with right-handed rotations
+    eigenvalues, eigenvectors = np.linalg.eigh(merged_covars)
+    eigenvectors[np.linalg.det(eigenvectors) < 0, :, 2] *= -1
+    merged_rots = rotmat_to_quat(eigenvectors)
+    merged_scales = 0.5 * np.log(np.clip(eigenvalues, 1e-12, None))
+
+    transparency = np.exp(cluster_sum(np.log1p(-np.clip(alphas, 0.0, 0.999))))
+    merged_opacities = logit(np.clip(1.0 - transparency, 1e-4, 0.999))[:, np.newaxis]
+
+    merged_dc = cluster_sum(weights[:, np.newaxis, np.newaxis] * features_dc) / total[:, np.newaxis, np.newaxis]
+    merged_extra = cluster_sum(weights[:, np.newaxis, np.newaxis] * features_extra) / total[:, np.newaxis, np.newaxis]
+
+    return tuple(array.astype(np.float32) for array in (means, merged_opacities, merged_scales, merged_rots,
+                                                         merged_dc, merged_extra))
+
+
+""" Path of the cached level-of-detail tier, next to the source file """
+def get_lod_path(path, lod):
+    return f"{os.path.splitext(path)[0]}.lod{lod}.npz"
+
+
+""" Load a cached level-of-detail tier. Returns None if it is missing or outdated """
+def load_lod(path, lod, thresholds):
+    lod_path = get_lod_path(path, lod)
+    if not os.path.exists(lod_path):
+        return None
+
+    stat = os.stat(path)
+    with np.load(lod_path) as data:
+        key = np.array([stat.st_size, stat.st_mtime] + thresholds, dtype=np.float64)
+        if data["key"].shape != key.shape or not np.array_equal(data["key"], key):
+            return None
+        return tuple(data[name] for name in ("xyz", "opacities", "scales", "rots", "features_dc", "features_extra"))
+
+
+""" Save a level-of-detail tier next to the source file """
+def save_lod(path, lod, thresholds, gaussians):
+    stat = os.stat(path)
+    key = np.array([stat.st_size, stat.st_mtime] + thresholds, dtype=np.float64)
+    xyz, opacities, scales, rots, features_dc, features_extra = gaussians
+    np.savez(get_lod_path(path, lod), key=key, xyz=xyz, opacities=opacities, scales=scales, rots=rots,
+             features_dc=features_dc, features_extra=features_extra)
+
+
+""" Load the gaussians of a .ply file, pruned by opacity and scale, at the requested level of detail.
+    - lod 0 is the pruned model, each coarser tier halves the merging grid resolution.
+    - the tiers are built once from the previous one and cached next to the source file.
+"""
+def load_gaussians(path, lod=0, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None):
+    if lod < 0 or lod > LOD_TIERS:
+        raise ValueError(f"Unknown level of detail: {lod}")
+
+    # Missing thresholds are stored as -1 in the cache key
+    thresholds = [float(min_opacity),
+                  -1.0 if min_scale is None else float(min_scale),
+                  -1.0 if max_scale is None else float(max_scale)]
+
+    if lod > 0:
+        gaussians = load_lod(path, lod, thresholds)
+        if gaussians is not None:
+            return gaussians
+
+    gaussians = prune_gaussians(load_ply(path), min_opacity, min_scale, max_scale)
+    extent = (gaussians[0].max(axis=0) - gaussians[0].min(axis=0)).max()
+    for tier in range(1, lod + 1):
+        cached = load_lod(path, tier, thresholds)
+        if cached is None:
+            cached = merge_gaussians(gaussians, extent / (LOD_RESOLUTION >> (tier - 1)))
+            save_lod(path, tier, thresholds, cached)
+        gaussians = cached
+
+    return gaussians
+
+
+""" Expand upper-triangular covariances [N, 6] to full covariance matrices [N, 3, 3] """
+def triu_to_covars(triu):
+    covars = triu[:, [0, 1, 2, 1, 3, 4, 2, 4, 5]]
+    return covars.reshape(-1, 3, 3)
+
+
+""" Reduce symmetric covariance matrices [N, 3, 3] to their upper-triangular values [N, 6] """
+def covars_to_triu(covars):
+    return covars.reshape(-1, 9)[:, [0, 1, 2, 4, 5, 8]]
+
+
+# The covariances whose jacobian is within JACOBIAN_TOLERANCE of the identity (per entry) are left unchanged: the
+# interpolation of the view deformations does not give back the identity exactly for the untouched gaussians
+JACOBIAN_TOLERANCE = 1e-6
+
+
+""" Transform upper-triangular covariances [N, 6] by jacobians [N, 3, 3] (J C J^T).
+    The full matrices are only built for the rows whose jacobian is not the identity, the others are returned as is.
+"""
+def transform_covars(triu, jacobians):
+    identity = torch.eye(3, device=jacobians.device, dtype=jacobians.dtype)
+    moved = torch.abs(jacobians - identity).reshape(-1, 9) > JACOBIAN_TOLERANCE
+    deformed = torch.nonzero(torch.any(moved, dim=1)).squeeze(1)
+    if len(deformed) == 0:
+        return triu
+    if len(deformed) == len(triu):
+        return covars_to_triu(jacobians @ triu_to_covars(triu) @ jacobians.transpose(1, 2))
+
+    deformed_jacobians = jacobians[deformed]
+    transformed = triu.clone()
+    transformed[deformed] = covars_to_triu(deformed_jacobians @ triu_to_covars(triu[deformed])
+                                           @ deformed_jacobians.transpose(1, 2))
+    return transformed
+
+
+""" Vector-quantize the higher-order SH coefficients [N, K, 3] with k-means.
+    The codebook is trained on a sample of the gaussians, then every gaussian is assigned to its closest code.
+"""
+def build_sh_codebook(shN, codebook_size=4096, iterations=10, batch_size=65536):
+    vectors = shN.reshape(len(shN), -1)
+    codebook_size = min(codebook_size, len(vectors))
+
+    def assign(points):
+        return torch.cat([torch.cdist(points[i:i + batch_size], codebook).argmin(dim=1)
+                          for i in range(0, len(points), batch_size)])
+
+    sample_ids = torch.randperm(len(vectors), generator=torch.Generator().manual_seed(0))[:codebook_size * 64]
+    sample = vectors[sample_ids.to(vectors.device)]
+    codebook = sample[:codebook_size].clone()
+
+    for _ in range(iterations):
+        codes = assign(sample)
+        sums = torch.zeros_like(codebook).index_add_(0, codes, sample)
+        counts = torch.bincount(codes, minlength=codebook_size)
+        used = counts > 0
+        codebook[used] = sums[used] / counts[used].unsqueeze(1)
+
+    codes = assign(vectors).type(torch.int32)
+    return codebook.reshape(codebook_size, *shN.shape[1:]).contiguous(), codes
+
+
+# Storages of the higher-order SH coefficients (see prepare_gaussians)
+SH_STORAGES = ("float32", "float16", "codebook")
+
+
+""" Prepare the gaussians of a .ply file for the rendering.
+    Returns a dict of tensors: means [N, 3], opacities [N] (after sigmoid), covars [N, 6] (upper-triangular),
+    and the SH coefficients, either colors [N, K, 3] or sh0 [N, 1, 3] with the compressed higher-order ones
+    (shN in float16, or sh_codebook and sh_codes). With reorder, the permutation of the gaussians is also returned.
+"""
+def prepare_gaussians(data_path, device, lod=0, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None, reorder=False,
+                      sh_storage="float32"):
+    xyz, opacities, scales, rots, features_dc, features_extra = load_gaussians(data_path, lod, min_opacity, min_scale,
+                                                                               max_scale)
     means = torch.tensor(xyz, dtype=torch.float32, device=device).contiguous()
     sh0 = torch.tensor(features_dc, dtype=torch.float32, device=device).transpose(1, 2).contiguous()
     shN = torch.tensor(features_extra, dtype=torch.float32, device=device).transpose(1, 2).contiguous()
-    opacities = torch.sigmoid(torch.tensor(opacities, dtype=torch.float32, device=device)).squeeze()
+    opacities = torch.sigmoid(torch.tensor(opacities, dtype=torch.float32, device=device)).squeeze(-1)
     scales = torch.exp(torch.tensor(scales, dtype=torch.float32, device=device)).contiguous()
     quats = torch.nn.functional.normalize(torch.tensor(rots, dtype=torch.float32, device=device)).contiguous()
 
+    gaussians = {}
+    if reorder:
+        permutation = morton_order(means)
+        means, sh0, shN = means[permutation].contiguous(), sh0[permutation].contiguous(), shN[permutation].contiguous()
+        opacities, scales, quats = opacities[permutation], scales[permutation], quats[permutation]
+        gaussians["permutation"] = permutation
+
+    # Normalization of the colors, each channel separately
     max_values_per_channel, _ = torch.max(sh0, dim=-1, keepdim=True)
-    max_values_per_channel = torch.clamp(max_values_per_channel, min=1.0)
+    max_values_per_channel = torch.clamp(max_values_per_channel, min=1.0)  # Prevent division by 0
     sh0 = sh0 / max_values_per_channel
-    colors = torch.cat((sh0, shN), dim=1)
+
+    gaussians["means"] = means
+    gaussians["opacities"] = opacities.contiguous()
+    gaussians["covars"], _ = quat_scale_to_covar_preci(quats.contiguous(), scales.contiguous(), compute_preci=False,
+                                                       triu=True)
+
+    # Keep a single copy of the SH coefficients
+    if sh_storage == "float32" or shN.shape[-2] == 0:
+        gaussians["colors"] = torch.cat((sh0, shN), dim=1)
+    elif sh_storage == "float16":
+        gaussians["sh0"], gaussians["shN"] = sh0, shN.half()
+    elif sh_storage == "codebook":
+        gaussians["sh0"] = sh0
+        gaussians["sh_codebook"], gaussians["sh_codes"] = build_sh_codebook(shN)
+    else:
+        raise ValueError(f"Unknown SH storage: {sh_storage}")
+
+    return gaussians
+
+
+""" Load the prepared gaussians (see prepare_gaussians) from the binary cache next to the .ply file.
+    The cache is keyed on the identity of the .ply file and the loading options, and is written on a miss.
+"""
+def load_prepared_gaussians(data_path, device, lod=0, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None,
+                            reorder=False, sh_storage="float32"):
+    options = {"lod": lod, "min_opacity": min_opacity, "min_scale": min_scale, "max_scale": max_scale,
+               "reorder": reorder, "sh_storage": sh_storage}
+    cache_path = get_cache_path(data_path, options)
+    key = dict(get_file_key(data_path), **options)
+
+    cached = read_cache(cache_path, key)
+    if cached is not None:
+        arrays, _ = cached
+        return {name: torch.from_numpy(array).to(device) for name, array in arrays.items()}
+
+    gaussians = prepare_gaussians(data_path, device, lod, min_opacity, min_scale, max_scale, reorder, sh_storage)
+    write_cache(cache_path, key, {name: tensor.cpu().numpy() for name, tensor in gaussians.items()})
+
+    return gaussians
+
+
+def render_gsplat_image(data_path, device, image_path, lod=0, min_opacity=MIN_OPACITY, min_scale=None, max_scale=None):
+    # Do the rendering of the 3DGS
+    gaussians = load_prepared_gaussians(data_path, device, lod, min_opacity, min_scale, max_scale)
+    colors = gaussians["colors"]
     sh_degree = int(math.sqrt(colors.shape[-2]) - 1)
 
     viewmats = torch.tensor([[[1, 0, 0, 0],
@@ -73,12 +630,13 @@ def render_gsplat_image(data_path, device, image_path):
                         [0, 0, 1]]], dtype=torch.float32).to(device)
 
     render_colors, _, _ = rasterization(
-        means, quats, scales, opacities, colors,
+        gaussians["means"], None, None, gaussians["opacities"], colors,
         viewmats, Ks, 256, 256,
         render_mode="RGB",
         backgrounds=torch.tensor([[1., 1., 1.]], device=device),
-        sh_degree=sh_degree
+        sh_degree=sh_degree,
+        covars=triu_to_covars(gaussians["covars"])
     )
     render_rgbs = render_colors[0, ..., 0:3].cpu().numpy()
     img = Image.fromarray((render_rgbs * 255).astype(np.uint8))
-    img.save(image_path)
\ No newline at end of file
+    img.save(image_path)
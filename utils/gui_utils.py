@@ -78,7 +78,7 @@ def draw_mesh(canvas, bbw_mesh: BbwMesh, show_mesh=False):
         index = int(index)
         vertex = bbw_mesh.new_vertices[index]
         selected_handle_index = np.where(bbw_mesh.handles_index == index)[0].item()
-        rotation = bbw_mesh.handles[selected_handle_index].rotation_matrix
+        rotation = bbw_mesh.handles.rotation_matrices[selected_handle_index]
 
         if selected_handle_index in bbw_mesh.selected_handles_index:
             draw_circle(canvas, vertex[0], vertex[1], color="yellow")
@@ -9,6 +9,7 @@ from deformation.mesh_view_deformation import MeshViewDeformation
 from deformation.mesh_view_deformer import MeshViewDeformer
 from rendering.gs_renderer import GaussianSplattingRenderer
 from rendering.mesh_renderer import MeshRenderer
+from utils.gsplat_utils import MIN_OPACITY
 
 
 """ Initialize the camera based on the model type """
@@ -21,12 +22,16 @@ def initialize_camera(renderer_type, width, height, azimuth=0.0, polar=0.0):
         raise ValueError(f"Unknown renderer type: {renderer_type}")
 
 
-""" Initialize the renderer based on the model type """
-def initialize_renderer(renderer_type, local_rank, world_rank, world_size, data_path, camera):
+""" Initialize the renderer based on the model type (lod, min_opacity, min_scale, max_scale, sh_storage and out_of_core
+    are only used by Gaussian models, shader_deformation by meshes) """
+def initialize_renderer(renderer_type, local_rank, world_rank, world_size, data_path, camera, lod=0,
+                        min_opacity=MIN_OPACITY, min_scale=None, max_scale=None, reorder=False, sh_storage="float32",
+                        out_of_core=False, shader_deformation=False):
     if renderer_type == "Gaussian":
-        return GaussianSplattingRenderer(data_path, local_rank, world_rank, world_size)
+        return GaussianSplattingRenderer(data_path, local_rank, world_rank, world_size, lod, min_opacity, min_scale,
+                                         max_scale, reorder, sh_storage, out_of_core)
     elif renderer_type == "Mesh":
-        return MeshRenderer(data_path, camera)
+        return MeshRenderer(data_path, camera, reorder, shader_deformation)
     else:
         raise ValueError(f"Unknown renderer type: {renderer_type}")
 
@@ -45,10 +50,13 @@ def initialize_view_deformer(renderer_type):
 def initialize_vd(camera: AbstractCamera, vd_data):
     displacements = torch.tensor(vd_data["displacements"], device="cuda")
 
-    # Gaussian Splatting Case
+    # Gaussian Splatting Case, with the deformed gaussians only (or all the gaussians for older models)
     if vd_data.get("jacobians") is not None:
         jacobians = torch.tensor(vd_data["jacobians"], device="cuda")
-        view_deformation = GsplatViewDeformation(camera, vd_data["nb_data"], displacements, jacobians)
+        indices = None
+        if vd_data.get("indices") is not None:
+            indices = torch.tensor(vd_data["indices"], dtype=torch.long, device="cuda")
+        view_deformation = GsplatViewDeformation(camera, vd_data["nb_data"], displacements, jacobians, indices)
     # Mesh Case
     else:
         view_deformation = MeshViewDeformation(camera, vd_data["nb_data"], displacements)
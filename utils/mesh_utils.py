@@ -1,8 +1,23 @@
+import igl
 import trimesh
 import numpy as np
 import pyrender
+import torch
 from PIL import Image
 
+from utils.cache_utils import get_cache_path, get_file_key, read_cache, write_cache
+
+
+# The cached textures are halved down to MIN_TEXTURE_SIZE pixels. The level uploaded is the smallest one with at least
+# TEXELS_PER_PIXEL texels per pixel of the largest side of the window
+MIN_TEXTURE_SIZE = 64
+TEXELS_PER_PIXEL = 2.0
+
+TEXTURE_SLOTS = ("baseColorTexture", "metallicRoughnessTexture", "normalTexture", "occlusionTexture",
+                 "emissiveTexture")
+MATERIAL_FIELDS = ("baseColorFactor", "metallicFactor", "roughnessFactor", "emissiveFactor", "alphaMode",
+                   "alphaCutoff", "doubleSided", "smooth", "wireframe")
+
 
 """ Function to load the Mesh model from the .glb file """
 def load_scene(data_path):
@@ -52,9 +67,262 @@ def load_scene(data_path):
     return new_scene
 
 
+""" Compute the area-weighted vertex normals [N, 3] of a triangle mesh by scatter-adding the face normals.
+    - moved: optional boolean mask [N] of the vertices that moved since normals [N, 3] were computed. Only the normals of
+      the vertices of the faces touching a moved vertex are recomputed (from all their faces), the others are kept.
+"""
+def compute_vertex_normals(vertices, faces, normals=None, moved=None):
+    affected = None
+    if moved is not None and normals is not None:
+        affected = torch.zeros(len(vertices), dtype=torch.bool, device=vertices.device)
+        affected[faces[moved[faces].any(dim=1)].flatten()] = True
+        faces = faces[affected[faces].any(dim=1)]
+
+    v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    face_normals = torch.linalg.cross(v1 - v0, v2 - v0)  # Norm is twice the area of the face
+    corners = faces.flatten()
+    contributions = face_normals.repeat_interleave(3, dim=0)
+
+    if affected is None:
+        accumulated = torch.zeros_like(vertices).index_add_(0, corners, contributions)
+        return torch.nn.functional.normalize(accumulated, dim=1)
+
+    # The faces around the affected vertices also touch unaffected vertices, which keep their normals
+    kept = affected[corners]
+    accumulated = torch.zeros_like(vertices).index_add_(0, corners[kept], contributions[kept])
+    normals = normals.clone()
+    normals[affected] = torch.nn.functional.normalize(accumulated[affected], dim=1)
+    return normals
+
+
+""" Decimate a triangle mesh down to about nb_faces faces (edge collapses, see igl.decimate).
+    Returns (vertices, faces) or None if the mesh can not be decimated (e.g. non edge-manifold).
+"""
+def decimate_mesh(vertices, faces, nb_faces):
+    try:
+        result = igl.decimate(np.asarray(vertices, dtype=np.float64), np.asarray(faces, dtype=np.int64), int(nb_faces))
+    except (RuntimeError, ValueError):
+        return None
+
+    # Older bindings return a success flag first: (success, U, G, J, I)
+    if len(result) == 5 and not result[0]:
+        return None
+    decimated_vertices, decimated_faces = result[-4], result[-3]
+    if len(decimated_faces) == 0:
+        return None
+    return decimated_vertices.astype(np.float32), decimated_faces.astype(np.int64)
+
+
+""" Barycentric coordinates [P, 3] of points in the triangles (a, b, c), clamped inside the triangles """
+def barycentric_coordinates(points, a, b, c):
+    v0, v1, v2 = b - a, c - a, points - a
+    d00 = np.sum(v0 * v0, axis=1)
+    d01 = np.sum(v0 * v1, axis=1)
+    d11 = np.sum(v1 * v1, axis=1)
+    d20 = np.sum(v2 * v0, axis=1)
+    d21 = np.sum(v2 * v1, axis=1)
+    denominator = d00 * d11 - d01 * d01
+    denominator = np.where(np.abs(denominator) < 1e-20, 1.0, denominator)  # Degenerate triangles
+
+    v = (d11 * d20 - d01 * d21) / denominator
+    w = (d00 * d21 - d01 * d20) / denominator
+    weights = np.clip(np.stack([1.0 - v - w, v, w], axis=1), 0.0, None)
+    return weights / np.clip(np.sum(weights, axis=1, keepdims=True), 1e-12, None)
+
+
+""" Map points onto a triangle mesh: the vertices [P, 3] of the closest triangle to each point and the barycentric
+    coordinates [P, 3] of the closest point in it. Values defined on the mesh vertices are transferred to the points
+    as the weighted sum of the values of these vertices.
+"""
+def get_barycentric_mapping(points, vertices, faces):
+    points = np.asarray(points, dtype=np.float64)
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    _, closest_faces, closest_points = igl.point_mesh_squared_distance(points, vertices, faces)
+
+    indices = faces[closest_faces]
+    weights = barycentric_coordinates(closest_points, vertices[indices[:, 0]], vertices[indices[:, 1]],
+                                      vertices[indices[:, 2]])
+    return indices, weights.astype(np.float32)
+
+
+""" Build the decimated proxies of primitives (lists of their positions and faces), with about proxy_faces faces in
+    total. Each proxy vertex is mapped to the closest point of its full resolution primitive (see
+    get_barycentric_mapping). Returns, for the index of each primitive with faces, the proxy
+    (vertices, faces, indices, weights).
+"""
+def build_mesh_proxies(positions, faces, proxy_faces):
+    ratio = proxy_faces / sum(len(prim_faces) for prim_faces in faces)
+    proxies = {}
+    for i, (prim_positions, prim_faces) in enumerate(zip(positions, faces)):
+        if len(prim_faces) == 0:
+            continue
+        decimated = decimate_mesh(prim_positions, prim_faces, max(int(len(prim_faces) * ratio), 4))
+        vertices, decimated_faces = decimated if decimated is not None else (prim_positions, prim_faces)
+        indices, weights = get_barycentric_mapping(vertices, prim_positions, prim_faces)
+        proxies[i] = (np.asarray(vertices, dtype=np.float32), np.asarray(decimated_faces, dtype=np.int64),
+                      indices, weights)
+    return proxies
+
+
+""" Load the proxies of the primitives of a mesh file (see build_mesh_proxies) from the binary cache next to the file,
+    one per proxy_faces, built on a miss. The arrays of the proxies are concatenated, the metadata keeps their ranges.
+"""
+def load_mesh_proxies(data_path, positions, faces, proxy_faces):
+    options = {"format": "mesh_proxies", "proxy_faces": proxy_faces}
+    cache_path = get_cache_path(data_path, options)
+    key = dict(get_file_key(data_path), **options)
+
+    cached = read_cache(cache_path, key)
+    if cached is None:
+        proxies = build_mesh_proxies(positions, faces, proxy_faces)
+        metadata = {"primitives": []}
+        nb_vertices, nb_faces = 0, 0
+        for i, (vertices, proxy_faces_array, _, _) in proxies.items():
+            metadata["primitives"].append({"primitive": i, "vertices": [nb_vertices, nb_vertices + len(vertices)],
+                                           "faces": [nb_faces, nb_faces + len(proxy_faces_array)]})
+            nb_vertices += len(vertices)
+            nb_faces += len(proxy_faces_array)
+        arrays = {name: np.concatenate([proxy[j] for proxy in proxies.values()])
+                  for j, name in enumerate(["vertices", "faces", "indices", "weights"])}
+        write_cache(cache_path, key, arrays, metadata)
+        return proxies
+
+    arrays, metadata = cached
+    return {prim["primitive"]: (arrays["vertices"][slice(*prim["vertices"])], arrays["faces"][slice(*prim["faces"])],
+                                arrays["indices"][slice(*prim["vertices"])], arrays["weights"][slice(*prim["vertices"])])
+            for prim in metadata["primitives"]}
+
+
+""" Get the mip levels of a texture source [H, W(, C)] uint8, box-filtered and halved down to MIN_TEXTURE_SIZE """
+def get_texture_mips(source):
+    mips = [np.ascontiguousarray(source)]
+    while max(mips[-1].shape[:2]) > MIN_TEXTURE_SIZE and min(mips[-1].shape[:2]) >= 2:
+        mip = mips[-1].astype(np.uint16)
+        height, width = mip.shape[0] // 2 * 2, mip.shape[1] // 2 * 2
+        mip = (mip[0:height:2, 0:width:2] + mip[1:height:2, 0:width:2] + mip[0:height:2, 1:width:2] +
+               mip[1:height:2, 1:width:2] + 2) // 4
+        mips.append(mip.astype(np.uint8))
+    return mips
+
+
+""" Select the mip level to upload for a window whose largest side is window_size pixels """
+def select_mip(mips, window_size):
+    level = 0
+    while level + 1 < len(mips) and max(mips[level + 1].shape[:2]) >= TEXELS_PER_PIXEL * window_size:
+        level += 1
+    return level
+
+
+""" Build the binary cache of the normalized scene of a mesh file (see load_scene and cache_utils).
+    The attributes of the primitives are concatenated over the whole scene, the metadata keeps the ranges of each
+    primitive and its material. The textures are stored with all their mip levels.
+"""
+def build_mesh_cache(data_path, cache_path, key):
+    scene = load_scene(data_path)
+
+    attributes = {"positions": [], "normals": [], "texcoords": [], "colors": [], "faces": []}
+    arrays = {}
+    textures = {}
+    meshes = []
+    nb_vertices, nb_faces = 0, 0
+    for name, geometry in scene.geometry.items():
+        primitives = []
+        for prim in pyrender.Mesh.from_trimesh(geometry).primitives:
+            nb_prim_vertices = len(prim.positions)
+            # The faces are kept in float32, the dtype in which pyrender stores them
+            faces = prim.indices if prim.indices is not None else np.arange(nb_prim_vertices).reshape(-1, 3)
+            attributes["positions"].append(prim.positions)
+            attributes["normals"].append(prim.normals if prim.normals is not None else
+                                         np.zeros((nb_prim_vertices, 3), dtype=np.float32))
+            attributes["texcoords"].append(prim.texcoord_0[:, :2] if prim.texcoord_0 is not None else
+                                           np.zeros((nb_prim_vertices, 2), dtype=np.float32))
+            attributes["colors"].append(prim.color_0 if prim.color_0 is not None else
+                                        np.ones((nb_prim_vertices, 4), dtype=np.float32))
+            attributes["faces"].append(np.asarray(faces, dtype=np.float32))
+
+            material = {field: np.asarray(getattr(prim.material, field)).tolist() for field in MATERIAL_FIELDS}
+            for slot in TEXTURE_SLOTS:
+                texture = getattr(prim.material, slot)
+                if texture is None or texture.source is None:
+                    material[slot] = None
+                    continue
+                if id(texture) not in textures:
+                    mips = get_texture_mips(texture.source)
+                    for level, mip in enumerate(mips):
+                        arrays[f"texture_{len(textures)}_{level}"] = mip
+                    textures[id(texture)] = (len(textures), {"channels": texture.source_channels,
+                                                             "levels": len(mips)})
+                material[slot] = textures[id(texture)][0]
+
+            primitives.append({"vertices": [nb_vertices, nb_vertices + nb_prim_vertices],
+                               "faces": [nb_faces, nb_faces + len(faces)],
+                               "normals": prim.normals is not None, "texcoords": prim.texcoord_0 is not None,
+                               "colors": prim.color_0 is not None, "material": material})
+            nb_vertices += nb_prim_vertices
+            nb_faces += len(faces)
+        meshes.append({"name": name, "primitives": primitives})
+
+    for name, values in attributes.items():
+        # The optional attributes are only stored if a primitive has them
+        if name in ("texcoords", "colors") and not any(prim[name] for mesh in meshes for prim in mesh["primitives"]):
+            continue
+        arrays[name] = np.concatenate(values).astype(np.float32)
+    metadata = {"meshes": meshes, "textures": [texture for _, texture in sorted(textures.values(),
+                                                                                key=lambda t: t[0])]}
+    write_cache(cache_path, key, arrays, metadata)
+
+
+""" Load the normalized scene of a mesh file as pyrender meshes, one per geometry in the order of load_scene.
+    The scene is read from the binary cache next to the file (built on a miss), so the vertex arrays are views of the
+    mapped file and only the mip level of each texture matched to window_size is loaded.
+    Returns the meshes and, for each texture, the (texture, mip levels) pair used to change its level (see select_mip).
+"""
+def load_mesh_assets(data_path, window_size):
+    options = {"format": "mesh", "min_texture_size": MIN_TEXTURE_SIZE}
+    cache_path = get_cache_path(data_path, options)
+    key = dict(get_file_key(data_path), **options)
+
+    cached = read_cache(cache_path, key)
+    if cached is None:
+        build_mesh_cache(data_path, cache_path, key)
+        cached = read_cache(cache_path, key)
+    arrays, metadata = cached
+
+    textures = []
+    for i, texture in enumerate(metadata["textures"]):
+        mips = [arrays[f"texture_{i}_{level}"] for level in range(texture["levels"])]
+        textures.append((pyrender.Texture(source=mips[select_mip(mips, window_size)],
+                                          source_channels=texture["channels"]), mips))
+
+    meshes = []
+    for mesh in metadata["meshes"]:
+        primitives = []
+        for prim in mesh["primitives"]:
+            start, end = prim["vertices"]
+            material = dict(prim["material"])
+            for slot in TEXTURE_SLOTS:
+                if material[slot] is not None:
+                    material[slot] = textures[material[slot]][0]
+            primitives.append(pyrender.Primitive(
+                positions=arrays["positions"][start:end],
+                normals=arrays["normals"][start:end] if prim["normals"] else None,
+                texcoord_0=arrays["texcoords"][start:end] if prim["texcoords"] else None,
+                color_0=arrays["colors"][start:end] if prim["colors"] else None,
+                indices=arrays["faces"][slice(*prim["faces"])],
+                material=pyrender.MetallicRoughnessMaterial(**material),
+                mode=pyrender.GLTF.TRIANGLES
+            ))
+        meshes.append(pyrender.Mesh(primitives=primitives, name=mesh["name"]))
+
+    return meshes, textures
+
+
 def render_mesh_image(data_path, image_path):
-    loaded_scene = load_scene(data_path)
-    scene = pyrender.Scene.from_trimesh_scene(loaded_scene)
+    meshes, _ = load_mesh_assets(data_path, 256)
+    scene = pyrender.Scene()
+    for mesh in meshes:
+        scene.add(mesh)
 
     camera = pyrender.PerspectiveCamera(yfov=np.radians(60))
     scene.add(camera, pose=[[1, 0, 0, 0],
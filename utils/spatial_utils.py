@@ -0,0 +1,156 @@
+import math
+
+import torch
+
+
+# Classification of the octree nodes against the view frustum
+OUTSIDE = 0
+INSIDE = 1
+STRADDLING = 2
+
+
+""" Spread the lower 10 bits of an integer tensor so that there are two zero bits between each bit """
+def part1by2(x):
+    x = x & 0x3FF
+    x = (x | (x << 16)) & 0x30000FF
+    x = (x | (x << 8)) & 0x300F00F
+    x = (x | (x << 4)) & 0x30C30C3
+    x = (x | (x << 2)) & 0x9249249
+    return x
+
+
+""" Compute the Morton (Z-order) code of each point, using bits per axis inside the bounding box of the points """
+def morton_codes(points, bits=10):
+    min_coords = points.min(dim=0).values
+    max_coords = points.max(dim=0).values
+    extent = torch.clamp(max_coords - min_coords, min=1e-12)
+
+    cells = (1 << bits) - 1
+    grid = ((points - min_coords) / extent * cells).round().long().clamp(0, cells)
+
+    return (part1by2(grid[:, 0]) << 2) | (part1by2(grid[:, 1]) << 1) | part1by2(grid[:, 2])
+
+
+""" Get the permutation sorting the points along the Morton (Z-order) curve """
+def morton_order(points, bits=10):
+    return torch.argsort(morton_codes(points, bits))
+
+
+""" Linear octree built over a point cloud (Gaussian means or mesh vertices).
+    - the points are sorted by Morton code so that every node covers a contiguous range of points.
+    - each level stores the bounding boxes of its nodes and the index of their parent.
+    - used to cull the primitives that can not be seen before running the view deformation.
+"""
+class Octree:
+    def __init__(self, points, leaf_size=64, max_depth=10):
+        self.device = points.device
+        self.nb_points = len(points)
+
+        # Choose the depth so that the leaves hold around leaf_size points
+        self.depth = int(min(max(math.ceil(math.log(max(self.nb_points / leaf_size, 1.0), 8)), 1), max_depth))
+
+        codes, self.order = torch.sort(morton_codes(points, self.depth))
+        sorted_points = points[self.order]
+
+        # Leaves are the occupied cells of the finest level
+        leaf_codes, self.leaf_counts = torch.unique_consecutive(codes, return_counts=True)
+        self.leaf_starts = torch.cumsum(self.leaf_counts, dim=0) - self.leaf_counts
+        nb_leaves = len(leaf_codes)
+
+        sorted_leaf = torch.repeat_interleave(torch.arange(nb_leaves, device=self.device), self.leaf_counts)
+        self.point_leaf = torch.empty_like(sorted_leaf)
+        self.point_leaf[self.order] = sorted_leaf
+
+        leaf_mins = self.reduce(sorted_points, sorted_leaf, nb_leaves, 'amin')
+        leaf_maxs = self.reduce(sorted_points, sorted_leaf, nb_leaves, 'amax')
+
+        # Build the levels from the leaves up to the root
+        self.mins = [leaf_mins]
+        self.maxs = [leaf_maxs]
+        self.parents = []
+        node_codes = leaf_codes
+        for _ in range(self.depth):
+            node_codes, parent = torch.unique_consecutive(node_codes >> 3, return_inverse=True)
+            self.parents.insert(0, parent)
+            self.mins.insert(0, self.reduce(self.mins[0], parent, len(node_codes), 'amin'))
+            self.maxs.insert(0, self.reduce(self.maxs[0], parent, len(node_codes), 'amax'))
+
+    """ Reduce the values of the children into their parent node """
+    @staticmethod
+    def reduce(values, parent, nb_nodes, reduce):
+        index = parent.unsqueeze(1).expand(-1, values.shape[1]) if values.dim() == 2 else parent
+        shape = (nb_nodes, values.shape[1]) if values.dim() == 2 else (nb_nodes,)
+        output = torch.zeros(shape, dtype=values.dtype, device=values.device)
+        return output.scatter_reduce(0, index, values, reduce, include_self=False)
+
+    """ Get the indices of the points that may project inside the image-space bounds of the camera.
+        - bounds: image-space rectangle (x_min, y_min, x_max, y_max).
+        - displacements: per-point displacements [N, 3] applied on top of the points used to build the tree.
+          The node boxes are grown by their largest displacement so that the culling stays conservative.
+    """
+    def cull(self, camera, bounds, displacements=None):
+        radius = [None] * (self.depth + 1)
+        if displacements is not None:
+            norms = torch.linalg.norm(displacements, dim=1)
+            radius[-1] = self.reduce(norms, self.point_leaf, len(self.leaf_counts), 'amax')
+            for level in range(self.depth, 0, -1):
+                radius[level - 1] = self.reduce(radius[level], self.parents[level - 1], len(self.mins[level - 1]),
+                                                'amax')
+
+        # Top-down traversal: only the children of straddling nodes are tested
+        state = None
+        for level in range(self.depth + 1):
+            mins, maxs = self.mins[level], self.maxs[level]
+            if radius[level] is not None:
+                mins = mins - radius[level].unsqueeze(1)
+                maxs = maxs + radius[level].unsqueeze(1)
+
+            if state is None:
+                state = torch.full((len(mins),), STRADDLING, dtype=torch.long, device=self.device)
+            else:
+                state = state[self.parents[level - 1]]
+
+            candidates = torch.nonzero(state == STRADDLING).squeeze(1)
+            if len(candidates) > 0:
+                state[candidates] = self.classify(camera, bounds, mins[candidates], maxs[candidates])
+
+        # Gather the points of the visible leaves
+        visible_leaves = torch.nonzero(state != OUTSIDE).squeeze(1)
+        counts = self.leaf_counts[visible_leaves]
+        starts = self.leaf_starts[visible_leaves]
+        offsets = torch.cumsum(counts, dim=0) - counts
+        positions = (torch.arange(int(counts.sum()), device=self.device)
+                     + torch.repeat_interleave(starts - offsets, counts))
+
+        return self.order[positions]
+
+    """ Classify axis-aligned boxes against the camera frustum restricted to the image-space bounds """
+    @staticmethod
+    def classify(camera, bounds, mins, maxs):
+        bits = torch.tensor([[(i >> k) & 1 for k in range(3)] for i in range(8)], dtype=torch.bool,
+                            device=mins.device)
+        corners = torch.where(bits.unsqueeze(0), maxs.unsqueeze(1), mins.unsqueeze(1))  # [K, 8, 3]
+
+        cam_corners = camera.world_to_cam(corners.reshape(-1, 3)).reshape(-1, 8, 3)
+        in_front = cam_corners[..., 2] > camera.z_near
+        all_front = in_front.all(dim=1)
+        all_behind = ~in_front.any(dim=1)
+
+        # Boxes crossing the near plane are kept as straddling, so the depth can be clamped for the projection
+        cam_corners[..., 2] = torch.clamp(cam_corners[..., 2], min=camera.z_near)
+        proj_corners, _ = camera.proj(cam_corners.reshape(-1, 3))
+        proj_corners = proj_corners.reshape(-1, 8, 2)
+        proj_min = proj_corners.min(dim=1).values
+        proj_max = proj_corners.max(dim=1).values
+
+        x_min, y_min, x_max, y_max = bounds
+        outside = ((proj_max[:, 0] < x_min) | (proj_min[:, 0] > x_max) |
+                   (proj_max[:, 1] < y_min) | (proj_min[:, 1] > y_max))
+        inside = ((proj_min[:, 0] >= x_min) & (proj_max[:, 0] <= x_max) &
+                  (proj_min[:, 1] >= y_min) & (proj_max[:, 1] <= y_max))
+
+        state = torch.full((len(mins),), STRADDLING, dtype=torch.long, device=mins.device)
+        state[all_front & inside] = INSIDE
+        state[all_behind | (all_front & outside)] = OUTSIDE
+
+        return state
@@ -4,6 +4,14 @@ import torch
 import triangle as tr
 
 
+VERTICES_PER_DIAGONAL_PIXEL = 2.0
+MESH_GRADING = 10.0
+MESH_AREA_FILL = 0.2
+MESH_REFINEMENTS = 3
+
+RASTER_SCALE = 2
+
+
 """ Computer cartesian coordinates based on polar coordinates """
 def get_cartesian_coordinates(r, azimuth, polar):
     azimuth = np.radians(azimuth)
@@ -39,8 +47,19 @@ def rotate_polar(polar, displacement):
     return polar
 
 
-""" Get the 2D mesh based on the rendered image """
-def get_contour_mesh(image):
+""" Get the vertex budget of the adaptive 2D mesh of an image of shape (height, width): the detail of the mesh is along
+    the contours, so the budget grows with the resolution (the image diagonal) rather than with the number of pixels """
+def get_vertex_budget(image_shape):
+    return int(VERTICES_PER_DIAGONAL_PIXEL * np.hypot(image_shape[0], image_shape[1]))
+
+
+""" Get the 2D mesh based on the rendered image.
+    epsilon is the tolerance of the simplification of the contours and max_area the maximum area of the triangles,
+    both in pixels: larger values give coarser meshes.
+    With a vertex_budget, the triangles are instead sized by the distance to the contours (fine along the contours,
+    coarse in the interior) to get about vertex_budget vertices, see get_vertex_budget.
+    report(progress) is called before each refinement (progress in [0, 1]), it may raise to stop the meshing """
+def get_contour_mesh(image, epsilon=1.0, max_area=60, vertex_budget=None, report=lambda progress: None):
     new_image = np.array(image)
     gray_image = cv2.cvtColor(new_image, cv2.COLOR_BGR2GRAY)
 
@@ -52,32 +71,200 @@ def get_contour_mesh(image):
     contours, _ = cv2.findContours(dilated_binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
     # Simplify contours using cv2.approxPolyDP
-    epsilon = 1.0  # Adjust this value to control the degree of simplification
     simplified_contours = [cv2.approxPolyDP(contour, epsilon, True) for contour in contours]
 
-    # Process each contour
-    vertices_list = [contour.reshape(-1, 2) for contour in simplified_contours]
-    vertices = [tuple(vertex.astype(float)) for contour in vertices_list for vertex in
-                contour]  # Ensure vertices are tuples of floats
-
-    # Build the list of edges (segments) that define the polygon
-    segments = []
-    vertex_offset = 0
-
-    for contour in vertices_list:
-        num_vertices = len(contour)
-        for i in range(num_vertices):
-            # Create a segment between consecutive vertices in the contour
-            segments.append((i + vertex_offset, (i + 1) % num_vertices + vertex_offset))
-        vertex_offset += num_vertices
-
-    a = dict(vertices=vertices, segments=segments)
-    b = tr.triangulate(a, 'pq32.5a60')
-
-    vertices = np.array(b['vertices'])
-    faces = b['triangles']
-
-    return vertices, faces
+    # Vertices of the contours and segments between consecutive vertices of each (closed) contour
+    vertices = np.concatenate([contour.reshape(-1, 2) for contour in simplified_contours]).astype(np.float64)
+    sizes = np.array([len(contour) for contour in simplified_contours])
+    starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    indices = np.arange(len(vertices))
+    segments = np.stack([indices, starts + (indices - starts + 1) % np.repeat(sizes, sizes)], axis=1)
+
+    if vertex_budget is None:
+        b = tr.triangulate(dict(vertices=vertices, segments=segments), f'pq32.5a{max_area}')
+        return np.array(b['vertices']), b['triangles']
+
+    # Maximum area of the triangles growing with the distance to the contours, scaled such that the mesh has about
+    # vertex_budget vertices (about two triangles per vertex, the graded refinement giving triangles of about
+    # MESH_AREA_FILL of their maximum area)
+    distances = cv2.distanceTransform(dilated_binary, cv2.DIST_L2, 5)
+    relative_areas = (1 + distances / MESH_GRADING) ** 2
+    scale = np.sum(1 / relative_areas[dilated_binary > 0]) / (2 * vertex_budget * MESH_AREA_FILL)
+
+    b = tr.triangulate(dict(vertices=vertices, segments=segments), f'pq32.5a{scale * relative_areas.max():.6f}')
+    for refinement in range(MESH_REFINEMENTS):
+        report(refinement / MESH_REFINEMENTS)
+        centroids = np.rint(b['vertices'][b['triangles']].mean(axis=1)).astype(np.int64)
+        centroids = np.clip(centroids, 0, np.array(distances.shape[::-1]) - 1)
+        b['triangle_max_area'] = scale * relative_areas[centroids[:, 1], centroids[:, 0]]
+        nb_vertices = len(b['vertices'])
+        b = tr.triangulate(b, 'rpq32.5a')
+        if len(b['vertices']) == nb_vertices:
+            break
+
+    return np.array(b['vertices']), b['triangles']
+
+
+""" Get the affine transforms [F, 2, 3] giving the barycentric coordinates (of the second and third corners) of a 2D
+    point (x, y, 1) in each triangle. Degenerate triangles give negative coordinates for all the points """
+def get_barycentric_transforms(vertices, faces):
+    corners = vertices[faces]
+    edges = np.stack([corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]], axis=-1)  # [F, 2, 2]
+    determinants = np.linalg.det(edges)
+    degenerate = np.abs(determinants) < 1e-12
+    edges[degenerate] = np.eye(2)
+
+    transforms = np.zeros((len(faces), 2, 3))
+    transforms[:, :, :2] = np.linalg.inv(edges)
+    transforms[:, :, 2] = -np.einsum("fij,fj->fi", transforms[:, :, :2], corners[:, 0])
+    transforms[degenerate] = [[0, 0, -1], [0, 0, -1]]
+
+    return transforms
+
+
+""" Get the faces around each vertex [V, max_valence], padded with -1 """
+def get_vertex_faces(faces, nb_vertices):
+    vertices = faces.ravel()
+    order = np.argsort(vertices, kind="stable")
+    valences = np.bincount(vertices, minlength=nb_vertices)
+    offsets = np.concatenate([[0], np.cumsum(valences)[:-1]])
+    ranks = np.arange(len(vertices)) - np.repeat(offsets, valences)
+
+    vertex_faces = np.full((nb_vertices, max(valences.max(), 1)), -1, dtype=np.int64)
+    vertex_faces[vertices[order], ranks] = order // 3
+
+    return vertex_faces
+
+
+""" Get the triangle of each point [P] among its candidate triangles [P, K] (-1 for none), with the barycentric
+    transforms of the triangles. Points outside all the candidates (beyond tolerance) get -1 """
+def select_triangles(points2d, candidates, transforms, tolerance=1e-6):
+    t = transforms[np.maximum(candidates, 0)]  # [P, K, 2, 3]
+    x, y = points2d[:, np.newaxis, 0], points2d[:, np.newaxis, 1]
+    b1 = t[..., 0, 0] * x + t[..., 0, 1] * y + t[..., 0, 2]
+    b2 = t[..., 1, 0] * x + t[..., 1, 1] * y + t[..., 1, 2]
+    scores = np.minimum(np.minimum(1 - b1 - b2, b1), b2)
+    scores[candidates < 0] = -np.inf
+
+    best = np.argmax(scores, axis=1)
+    rows = np.arange(len(candidates))
+    return np.where(scores[rows, best] >= -tolerance, candidates[rows, best], -1)
+
+
+# Number of pixels filled at once by rasterize_triangles
+RASTER_BATCH = 1 << 22
+
+
+""" Rasterize the triangle indices of a 2D mesh in a buffer of shape (height + 2, width + 2), padded with -1 on each
+    side, where the pixel centers are at the integer coordinates of vertices * scale.
+    All the triangles are scanned at once: each row of the bounding box of a triangle gets the span of pixel centers
+    where the three barycentric coordinates are non-negative, and the spans are filled by batches of about
+    RASTER_BATCH pixels. A pixel takes a triangle containing its center, -1 if there is none.
+"""
+def rasterize_triangles(vertices, faces, transforms, height, width, scale):
+    triangle_ids = np.full((height + 2, width + 2), -1, dtype=np.int32)
+
+    # Barycentric coordinates (1 - b1 - b2, b1, b2) of the pixel centers, affine in x and y. Each coordinate bounds the
+    # span of a row from the left (positive slope along x) or from the right, at a crossing affine in y
+    t = transforms / [[scale, scale, 1]]
+    x_slopes = np.stack([-t[:, 0, 0] - t[:, 1, 0], t[:, 0, 0], t[:, 1, 0]], axis=1)
+    y_slopes = np.stack([-t[:, 0, 1] - t[:, 1, 1], t[:, 0, 1], t[:, 1, 1]], axis=1)
+    constants = np.stack([1 - t[:, 0, 2] - t[:, 1, 2], t[:, 0, 2], t[:, 1, 2]], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossings, crossing_slopes = -constants / x_slopes, -y_slopes / x_slopes
+    left_crossings = np.where(x_slopes > 0, crossings, -np.inf)
+    left_slopes = np.where(x_slopes > 0, crossing_slopes, 0)
+    right_crossings = np.where(x_slopes < 0, crossings, np.inf)
+    right_slopes = np.where(x_slopes < 0, crossing_slopes, 0)
+
+    # One span per row of the bounding box of each triangle, none for the degenerate triangles
+    rows = vertices[faces][:, :, 1] * scale
+    top = np.clip(np.ceil(rows.min(axis=1)), 0, height).astype(np.int64)
+    bottom = np.clip(np.floor(rows.max(axis=1)), -1, height - 1).astype(np.int64)
+    nb_rows = np.where(np.any(x_slopes != 0, axis=1), np.clip(bottom - top + 1, 0, None), 0)
+
+    y = np.repeat(top - np.cumsum(nb_rows) + nb_rows, nb_rows) + np.arange(nb_rows.sum())
+    left = np.max(np.repeat(left_crossings, nb_rows, axis=0) + np.repeat(left_slopes, nb_rows, axis=0) * y[:, None],
+                  axis=1)
+    right = np.min(np.repeat(right_crossings, nb_rows, axis=0) + np.repeat(right_slopes, nb_rows, axis=0) * y[:, None],
+                   axis=1)
+    left = np.clip(np.ceil(left), 0, width).astype(np.int64)
+    lengths = np.clip(np.clip(np.floor(right), -1, width - 1).astype(np.int64) - left + 1, 0, None)
+
+    # The spans are filled by batches of pixels
+    face_ids = np.repeat(np.arange(len(faces), dtype=np.int32), nb_rows)
+    starts = (y + 1) * (width + 2) + left + 1
+    ends = np.cumsum(lengths)
+    flat_ids = triangle_ids.reshape(-1)
+    first = 0
+    while first < len(lengths):
+        last = max(int(np.searchsorted(ends, ends[first] - lengths[first] + RASTER_BATCH, side="right")), first + 1)
+        batch_lengths = lengths[first:last]
+        offsets = starts[first:last] - (ends[first:last] - batch_lengths)
+        flat_ids[np.repeat(offsets, batch_lengths) + np.arange(ends[first] - lengths[first], ends[last - 1])] = \
+            np.repeat(face_ids[first:last], batch_lengths)
+        first = last
+
+    return triangle_ids
+
+
+""" Locate 2D points [N, 2] in the triangles of a 2D mesh drawn in an image of shape (height, width).
+    The triangle indices are rasterized once in a buffer of the size of the image (supersampled by scale, which
+    narrows the edges of the triangles in the buffer, see rasterize_triangles): the points in pixels inside a triangle
+    take it directly, the points in pixels on the edges of the triangles (or of the mesh) are tested exactly against
+    the triangle of their pixel, then of the neighbouring pixels, then against the triangles around their corners for
+    the thin corners that cover no pixel.
+    Returns the triangle index of each point, -1 for the points outside the mesh (or not finite).
+"""
+def locate_points(points2d, vertices, faces, image_shape, scale=RASTER_SCALE):
+    height, width = image_shape[0] * scale, image_shape[1] * scale
+    transforms = get_barycentric_transforms(vertices, faces)
+    triangle_ids = rasterize_triangles(vertices, faces, transforms, height, width, scale)
+
+    # Pixels whose 3x3 neighbourhood is covered by more than one triangle (or by the background)
+    boundary = np.zeros_like(triangle_ids, dtype=bool)
+    centers = triangle_ids[1:height + 1, 1:width + 1]
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            boundary[1:height + 1, 1:width + 1] |= triangle_ids[1 + dy:height + 1 + dy, 1 + dx:width + 1 + dx] != centers
+
+    # Pixels (in the flattened padded buffer) of the points, not finite points are never inside
+    scaled_points = points2d * scale
+    inside = ((scaled_points[:, 0] > -0.5) & (scaled_points[:, 0] < width - 0.5) &
+              (scaled_points[:, 1] > -0.5) & (scaled_points[:, 1] < height - 0.5))
+    points = np.flatnonzero(inside)
+    pixels = np.rint(scaled_points[points]).astype(np.intp) + 1
+    pixels = pixels[:, 1] * (width + 2) + pixels[:, 0]
+    triangle_ids, boundary = triangle_ids.ravel(), boundary.ravel()
+
+    indices = np.full(len(points2d), -1, dtype=np.int64)
+    indices[points] = triangle_ids[pixels]
+
+    # Exact test against the triangle of the pixel
+    on_boundary = boundary[pixels]
+    points, pixels = points[on_boundary], pixels[on_boundary]
+    indices[points] = select_triangles(points2d[points], indices[points, np.newaxis], transforms)
+
+    # Then against the triangles of the neighbouring pixels
+    missed = indices[points] < 0
+    points, pixels = points[missed], pixels[missed]
+    neighbours = np.array([dy * (width + 2) + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+    candidates = triangle_ids[pixels[:, np.newaxis] + neighbours].astype(np.int64)
+    indices[points] = select_triangles(points2d[points], candidates, transforms)
+
+    # Then against the triangles around the closest corner of these triangles
+    missed = (indices[points] < 0) & np.any(candidates >= 0, axis=1)
+    if np.any(missed):
+        points, candidates = points[missed], candidates[missed]
+        corners = np.where(candidates[:, :, np.newaxis] >= 0, faces[np.maximum(candidates, 0)], -1)
+        corners = corners.reshape(len(points), -1)
+        distances = np.sum((vertices[np.maximum(corners, 0)] - points2d[points, np.newaxis]) ** 2, axis=-1)
+        distances[corners < 0] = np.inf
+        closest = corners[np.arange(len(points)), np.argmin(distances, axis=1)]
+        indices[points] = select_triangles(points2d[points], get_vertex_faces(faces, len(vertices))[closest],
+                                           transforms)
+
+    return indices
 
 
 """ Compute the bivariate gaussian with a period of 360 """
@@ -96,11 +283,20 @@ def gaussian(value, mean, variance):
     return torch.exp(-((value - mean) ** 2) / (2 * variance ** 2))
 
 
-""" Get interpolated displacements based on a set of view-deformations and the actual position of the camera """
+""" Find values [N] in a sorted tensor [M]: returns the positions of the values in the sorted tensor and the mask of
+    the values found in it """
+def find_sorted(sorted_values, values):
+    if len(sorted_values) == 0:
+        return torch.zeros_like(values), torch.zeros(len(values), dtype=torch.bool, device=values.device)
+    positions = torch.searchsorted(sorted_values, values).clamp_(max=len(sorted_values) - 1)
+    return positions, sorted_values[positions] == values
+
+
+""" Get interpolated displacements based on a set of view-deformations and the actual position of the camera.
+    The displacements of each view-deformation are given for the same nb_data primitives """
 def get_interpolated_displacements(x, y, gaussian_data, displacement_data, n, nb_data):
     if n == 0:
-        tensor_shape = (nb_data, 3)
-        return torch.zeros(tensor_shape, device='cuda')
+        return torch.zeros((nb_data, 3), device='cuda')
     else:
         n = n-1
         mu_x, mu_y, sigma_x, sigma_y = gaussian_data[n]
@@ -111,7 +307,8 @@ def get_interpolated_displacements(x, y, gaussian_data, displacement_data, n, nb
                 + (1 - gaussian_n) * interpolated_displacements)
 
 
-""" Get interpolated jacobians based on a set of view-deformations and the actual position of the camera """
+""" Get interpolated jacobians based on a set of view-deformations and the actual position of the camera.
+    The jacobians of each view-deformation are given for the same nb_data primitives """
 def get_interpolated_jacobians(x, y, gaussian_data, jacobian_data, n, nb_data):
     if n == 0:
         identities = torch.eye(3, device='cuda').repeat(nb_data, 1, 1)
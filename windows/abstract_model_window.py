@@ -17,6 +17,12 @@ class AbstractModelWindow(tk.Frame, ABC):
         self.render_type = render_type
         os.makedirs(self.image_dir, exist_ok=True)
 
+        # Options used to open the models (see get_open_options)
+        self.options = {}
+        self.options_frame = tk.Frame(self, bg="#1a1a1a")
+        self.options_frame.pack(side="top", fill="x")
+        self.create_options()
+
         self.canvas = tk.Canvas(self, bg="#1a1a1a", highlightthickness=0)
         self.scroll_frame = tk.Frame(self.canvas, bg="#1a1a1a")
         self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.canvas.yview)
@@ -85,7 +91,38 @@ class AbstractModelWindow(tk.Frame, ABC):
         text_overlay.pack(side="top", fill="x")
 
     def select_model(self, path):
-        RenderingWindow(self.master, path, self.render_type, None)
+        RenderingWindow(self.master, path, self.render_type, None, **self.get_open_options())
+
+    """ Add the controls of the options used to open the models, the options are keyword arguments of the rendering
+        window (see add_choice_option, add_check_option and add_scale_option) """
+    def create_options(self):
+        pass
+
+    """ Get the options to open a model as keyword arguments of the rendering window """
+    def get_open_options(self):
+        return {name: variable.get() for name, variable in self.options.items()}
+
+    """ Add an option chosen among values """
+    def add_choice_option(self, name, label, values, initial, variable_type=tk.StringVar):
+        self.options[name] = variable_type(value=initial)
+        tk.Label(self.options_frame, text=label, fg="white", bg="#1a1a1a").pack(side="left", padx=(10, 2))
+        menu = tk.OptionMenu(self.options_frame, self.options[name], *values)
+        menu.configure(bg="#444", fg="white", highlightthickness=0)
+        menu.pack(side="left")
+
+    """ Add an option switched on or off """
+    def add_check_option(self, name, label, initial=False):
+        self.options[name] = tk.BooleanVar(value=initial)
+        tk.Checkbutton(self.options_frame, text=label, variable=self.options[name], fg="white", bg="#1a1a1a",
+                       selectcolor="#444", activebackground="#1a1a1a").pack(side="left", padx=10)
+
+    """ Add a numeric option set with a slider """
+    def add_scale_option(self, name, label, from_, to, resolution, initial):
+        self.options[name] = tk.DoubleVar(value=initial)
+        tk.Label(self.options_frame, text=label, fg="white", bg="#1a1a1a").pack(side="left", padx=(10, 2))
+        tk.Scale(self.options_frame, variable=self.options[name], from_=from_, to=to, resolution=resolution,
+                 orient="horizontal", length=120, fg="white", bg="#1a1a1a", highlightthickness=0,
+                 troughcolor="#555").pack(side="left")
 
     @abstractmethod
     def render_model(self, model_path, image_path):
@@ -1,5 +1,7 @@
+import tkinter as tk
+
 import torch
-from utils.gsplat_utils import render_gsplat_image
+from utils.gsplat_utils import LOD_TIERS, MIN_OPACITY, SH_STORAGES, render_gsplat_image
 from windows.abstract_model_window import AbstractModelWindow
 
 
@@ -10,3 +12,21 @@ class GsplatWindow(AbstractModelWindow):
 
     def render_model(self, model_path, image_path):
         render_gsplat_image(model_path, self.device, image_path)
+
+    """ Level of detail (0 is the full model, each tier halves the merging grid), pruning opacity and scales, Morton
+        ordering and storage of the higher-order SH coefficients of the opened models, the coarser tiers are built once
+        and cached next to the .ply files """
+    def create_options(self):
+        self.add_choice_option("lod", "LOD tier", list(range(LOD_TIERS + 1)), 0, tk.IntVar)
+        self.add_scale_option("min_opacity", "Min opacity", 0.0, 0.2, 0.001, MIN_OPACITY)
+        self.add_scale_option("min_scale", "Min scale", 0.0, 0.01, 0.0001, 0.0)
+        self.add_scale_option("max_scale", "Max scale", 0.0, 1.0, 0.01, 0.0)
+        self.add_check_option("reorder", "Morton order", True)
+        self.add_choice_option("sh_storage", "SH storage", list(SH_STORAGES), "float32")
+
+    """ Get the options to open a model, a scale bound of 0 does not prune """
+    def get_open_options(self):
+        options = super().get_open_options()
+        options["min_scale"] = options["min_scale"] or None
+        options["max_scale"] = options["max_scale"] or None
+        return options
@@ -8,3 +8,9 @@ class MeshWindow(AbstractModelWindow):
 
     def render_model(self, model_path, image_path):
         render_mesh_image(model_path, image_path)
+
+    """ Morton ordering of the vertices of the opened models, and displacements applied in the vertex shader instead of
+        the vertex buffers """
+    def create_options(self):
+        self.add_check_option("reorder", "Morton order", True)
+        self.add_check_option("shader_deformation", "Shader deformation")
@@ -1,23 +1,31 @@
 import tkinter as tk
-from tkinter import ttk
+from tkinter import messagebox, ttk
 
 from camera.abstract_camera import AbstractCamera
+from deformation.weight_solvers import WEIGHT_SOLVERS
 from manager import Manager
+from utils.gsplat_utils import MIN_OPACITY
 from utils.gui_utils import create_view_deformation_widget
 
+# Interval (in ms) between two checks of the 2D meshes generated in the background
+MESH_POLL_INTERVAL = 100
+
 """ Rendering window for both Gsplat and Meshes including :
     - Functions to get the user actions on the screen
     - Have all the buttons to build the view-dependent model
 """
 class RenderingWindow:
-    def __init__(self, parent, data_path, renderer_type, data=None):
+    def __init__(self, parent, data_path, renderer_type, data=None, lod=0, min_opacity=MIN_OPACITY, min_scale=None,
+                 max_scale=None, reorder=True, sh_storage="float32", out_of_core=False, shader_deformation=False,
+                 weight_solver="bbw", multires_weights=False):
         self.window = tk.Toplevel(parent)
         self.window.title(f"Rendering Window - {data_path}")
         self.window.geometry("1200x700")
         self.window.configure(bg="#1a1a1a")
 
         # Initialize the manager for the rendering and the deformations
-        self.manager = Manager(data_path, renderer_type, data)
+        self.manager = Manager(data_path, renderer_type, data, lod, min_opacity, min_scale, max_scale, reorder,
+                               sh_storage, out_of_core, shader_deformation, weight_solver, multires_weights)
 
         # ---- GRID CONFIGURATION ----
         self.window.columnconfigure(0, weight=1)  # Big render area (Expands)
@@ -49,11 +57,13 @@ class RenderingWindow:
         self.scroll_frame.pack(fill="both", expand=True)
 
         self.view_deformation_widgets = []
+        self.mesh_polling = False
 
         # ---- Button Sections (BOTTOM) ----
-        self.create_button_section("Deformation Functions", ["New View Deformation", "Move Handles",
-                                                             "Save View Deformation", "Save model", "Show 2D mesh"],
-                                   row=1, columnspan=1)
+        button_texts = ["New View Deformation", "Move Handles", "Save View Deformation", "Save model", "Show 2D mesh",
+                        "Compare solvers"]
+        frame = self.create_button_section("Deformation Functions", button_texts, row=1, columnspan=1)
+        self.create_weight_options(frame, column=len(button_texts))
         self.create_button_section("Video Functions", [], row=2, columnspan=1)
 
         self.update_deformation_widgets()
@@ -79,6 +89,7 @@ class RenderingWindow:
     def update_deformation_widgets(self):
         for widget in self.view_deformation_widgets:
             widget.destroy()
+        self.view_deformation_widgets = []
 
         for i, view_deformation in enumerate(self.manager.view_deformer.view_deformations):
             widget = create_view_deformation_widget(
@@ -97,10 +108,30 @@ class RenderingWindow:
         self.manager.checkout_view_deformation(i)
         self.update()
 
-    """ Generate the 2D mesh for the ith view deformation """
+    """ Generate the 2D mesh for the ith view deformation (in the background) """
     def mesh_generation_callback(self, i):
         self.manager.mesh_generation_callback(i)
         self.update()
+        if not self.mesh_polling:
+            self.mesh_polling = True
+            self.poll_mesh_jobs()
+
+    """ Show the progress of the 2D meshes generated in the background and render them once they are ready (or show
+        why their generation failed), the window keeps rendering meanwhile """
+    def poll_mesh_jobs(self):
+        stopped, errors = self.manager.update_mesh_jobs()
+        for widget, view_deformation in zip(self.view_deformation_widgets,
+                                            self.manager.view_deformer.view_deformations):
+            widget.show_mesh_job(view_deformation.mesh_job)
+        if stopped:
+            self.update()
+        for error in errors:
+            messagebox.showerror("2D mesh generation", f"The generation of the 2D mesh failed: {error}")
+
+        if self.manager.has_mesh_jobs():
+            self.window.after(MESH_POLL_INTERVAL, self.poll_mesh_jobs)
+        else:
+            self.mesh_polling = False
 
     """ Create a button section """
     def create_button_section(self, title, button_texts, row, columnspan):
@@ -114,7 +145,8 @@ class RenderingWindow:
             "Move Handles": self.move_handles,
             "Save View Deformation": self.save_view_deformation,
             "Save model": self.save_model,
-            "Show 2D mesh": self.show_2d_mesh
+            "Show 2D mesh": self.show_2d_mesh,
+            "Compare solvers": self.compare_weight_solvers
         }
 
         for i, text in enumerate(button_texts):
@@ -122,6 +154,39 @@ class RenderingWindow:
                 btn = tk.Button(frame, text=text, command=button_functions[text], bg="#444", fg="white")
                 btn.grid(row=1, column=i, padx=5, pady=5, sticky="ew")
 
+        return frame
+
+    """ Create the choice of the weight solver and of the multiresolution weights, used by the 2D meshes generated
+        afterwards """
+    def create_weight_options(self, frame, column):
+        self.weight_solver = tk.StringVar(value=self.manager.weight_solver)
+        self.weight_solver.trace_add("write", lambda *args: setattr(self.manager, "weight_solver",
+                                                                    self.weight_solver.get()))
+        tk.Label(frame, text="Weights", fg="white", bg="#333").grid(row=1, column=column, padx=(10, 2))
+        menu = tk.OptionMenu(frame, self.weight_solver, *WEIGHT_SOLVERS)
+        menu.configure(bg="#444", fg="white", highlightthickness=0)
+        menu.grid(row=1, column=column + 1, pady=5)
+
+        self.multires_weights = tk.BooleanVar(value=self.manager.multires_weights)
+        self.multires_weights.trace_add("write", lambda *args: setattr(self.manager, "multires_weights",
+                                                                       self.multires_weights.get()))
+        tk.Checkbutton(frame, text="Multires weights", variable=self.multires_weights, fg="white", bg="#333",
+                       selectcolor="#444", activebackground="#333").grid(row=1, column=column + 2, padx=5, pady=5)
+
+    """ Show the comparison of the weight solvers on the 2D mesh and the handles of the edited view deformation """
+    def compare_weight_solvers(self):
+        comparison = self.manager.compare_weight_solvers()
+        if comparison is None:
+            messagebox.showinfo("Compare solvers", "Generate the 2D mesh of the edited view deformation and add "
+                                                   "handles first", parent=self.window)
+            return
+        messagebox.showinfo("Compare solvers",
+                            f"BBW: {comparison['bbw_time'] * 1000:.0f} ms\n"
+                            f"Fast: {comparison['fast_time'] * 1000:.0f} ms "
+                            f"(factorization {comparison['fast_factor_time'] * 1000:.0f} ms)\n"
+                            f"Weight difference: max {comparison['max_error']:.3f}, "
+                            f"mean {comparison['mean_error']:.4f}", parent=self.window)
+
     """ Save a view deformation allowing to move around the object """
     def save_view_deformation(self):
         if self.manager.view_deformation is not None:
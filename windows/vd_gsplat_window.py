@@ -21,15 +21,25 @@ class VDGsplatWindow(AbstractModelWindow):
 
         print(data_path)
 
-        render_gsplat_image(data_path, self.device, image_path)
+        # Models saved before the pruning was introduced keep all their gaussians
+        render_gsplat_image(data_path, self.device, image_path, data.get("lod", 0), data.get("min_opacity", 0.0),
+                            data.get("min_scale"), data.get("max_scale"))
 
     def select_model(self, path):
         if path.lower().endswith('.pkl'):
             with open(path, "rb") as file:
                 data = pickle.load(file)
             data_path = data["data_path"]
+            lod = data.get("lod", 0)
+            min_opacity = data.get("min_opacity", 0.0)
+            min_scale = data.get("min_scale")
+            max_scale = data.get("max_scale")
+            sh_storage = data.get("sh_storage", "float32")
+            out_of_core = data.get("out_of_core", False)
             data = data["view_deformations"]
         else:
             raise ValueError(f"Unknown data_path type")
 
-        RenderingWindow(self.master, data_path, self.render_type, data)
+        # The view deformations are stored per gaussian, so the model is reloaded with the same tier, pruning and mode
+        RenderingWindow(self.master, data_path, self.render_type, data, lod, min_opacity, min_scale, max_scale,
+                        sh_storage=sh_storage, out_of_core=out_of_core)
@@ -20,6 +20,10 @@ class VDMeshWindow(AbstractModelWindow):
 
         render_mesh_image(data_path, image_path)
 
+    """ Displacements applied in the vertex shader instead of the vertex buffers, the saved deformations are unchanged """
+    def create_options(self):
+        self.add_check_option("shader_deformation", "Shader deformation")
+
     def select_model(self, path):
         if path.lower().endswith('.pkl'):
             with open(path, "rb") as file:
@@ -29,4 +33,4 @@ class VDMeshWindow(AbstractModelWindow):
         else:
             raise ValueError(f"Unknown data_path type")
 
-        RenderingWindow(self.master, data_path, self.render_type, data)
+        RenderingWindow(self.master, data_path, self.render_type, data, **self.get_open_options())